@@ -1,14 +1,26 @@
 import os
+import io
+import re
 import json
 import base64
+import asyncio
+import functools
+import threading
 from typing import Dict, List, Tuple, Optional
 from dataclasses import dataclass
-from PIL import Image, ImageEnhance, ImageFilter
+from pydantic import BaseModel
+from PIL import Image, ImageFilter
 import numpy as np
 import cv2
 from google import genai
 from google.genai import types
 
+try:
+    # orjson parses LLM JSON several times faster and tolerates surrounding whitespace
+    from orjson import loads as json_loads
+except ImportError:
+    json_loads = json.loads
+
 
 @dataclass
 class BoundingBox:
@@ -23,15 +35,130 @@ class EditRequest:
     parameters: Dict
     bounding_box: Optional[BoundingBox] = None
 
+class ImageAnalysis(BaseModel):
+    """Response schema for structured_edit_analysis, built once at import"""
+    objects: List[str]
+    dominant_colors: List[str]
+    lighting: str
+    scene_type: str
+    quality_score: int
+    suggested_edits: List[str]
+
+ImageData = Tuple[bytes, int, int, str]
+
+# Let OpenCV spread inpaint/resize/LUT work over every core; it releases the GIL while it runs
+cv2.setUseOptimized(True)
+cv2.setNumThreads(os.cpu_count() or 1)
+
+# cv2.imdecode flags for IDCT-scaled decoding, keyed by downscale factor
+_DECODE_FLAGS = {
+    1: cv2.IMREAD_COLOR,
+    2: cv2.IMREAD_REDUCED_COLOR_2,
+    4: cv2.IMREAD_REDUCED_COLOR_4,
+    8: cv2.IMREAD_REDUCED_COLOR_8,
+}
+INPAINT_PADDING = 16
+# Below this mask/frame area ratio Navier-Stokes beats TELEA's fast-marching bookkeeping
+SMALL_MASK_RATIO = 0.01
+# Uploads to Gemini are capped to this long edge and re-encoded as JPEG
+UPLOAD_MAX_DIM = 1536
+UPLOAD_JPEG_QUALITY = 85
+IDENTITY_LUT = np.arange(256, dtype=np.uint8)
+# Per-channel (R, G, B) gains for the colour temperature presets
+TEMPERATURE_GAINS = {"warm": (1.1, 1.0, 0.9), "cold": (0.9, 1.0, 1.1)}
+
+@functools.lru_cache(maxsize=32)
+def _load_bytes(path: str, mtime: float, size: int) -> bytes:
+    """Read file bytes; mtime/size are part of the key so edits invalidate the entry"""
+    with open(path, 'rb') as f:
+        return f.read()
+
+def _prepare_upload_bytes(image_data: ImageData, max_dim: int = UPLOAD_MAX_DIM) -> Tuple[bytes, str]:
+    """Return (bytes, mime type) to upload, re-encoded as JPEG when the long edge exceeds max_dim.
+
+    Gemini resizes large inputs server-side anyway, so only the bandwidth is saved.
+    Bounding boxes come back as percentages, so they stay valid for the original.
+    """
+    data, width, height, fmt = image_data
+    long_edge = max(width, height)
+    if long_edge <= max_dim:
+        return data, Image.MIME.get(fmt, 'image/jpeg')
+    
+    # Let the decoder drop most of the pixels (IDCT scaling for JPEG), then resize the rest
+    scale = max(f for f in _DECODE_FLAGS if long_edge // f >= max_dim)
+    img = _decode(image_data, scale)
+    ratio = max_dim / max(img.shape[:2])
+    img = cv2.resize(img, None, fx=ratio, fy=ratio, interpolation=cv2.INTER_AREA)
+    ok, buf = cv2.imencode('.jpg', img, [cv2.IMWRITE_JPEG_QUALITY, UPLOAD_JPEG_QUALITY])
+    if not ok:
+        return data, Image.MIME.get(fmt, 'image/jpeg')
+    return buf.tobytes(), 'image/jpeg'
+
+@functools.lru_cache(maxsize=32)
+def _image_part(image_data: ImageData) -> types.Part:
+    """Build (and reuse) the immutable, upload-sized part for a given image"""
+    data, mime_type = _prepare_upload_bytes(image_data)
+    return types.Part.from_bytes(data=data, mime_type=mime_type)
+
+_CLIENTS: Dict[Optional[str], genai.Client] = {}
+_CLIENTS_LOCK = threading.Lock()
+
+def _get_client(api_key: Optional[str] = None) -> genai.Client:
+    """Return the process-wide client for api_key so all assistants share one connection pool"""
+    client = _CLIENTS.get(api_key)
+    if client is None:
+        with _CLIENTS_LOCK:
+            client = _CLIENTS.get(api_key)
+            if client is None:
+                # Without a key the SDK uses the GOOGLE_API_KEY environment variable
+                client = _CLIENTS[api_key] = genai.Client(api_key=api_key) if api_key else genai.Client()
+    return client
+
+def _saturation_matrix(s: float) -> np.ndarray:
+    """RGB matrix that scales chroma by s around Rec.601 luma (same blend as ImageEnhance.Color)"""
+    return np.array([
+        [0.299 + 0.701 * s, 0.587 - 0.587 * s, 0.114 - 0.114 * s],
+        [0.299 - 0.299 * s, 0.587 + 0.413 * s, 0.114 - 0.114 * s],
+        [0.299 - 0.299 * s, 0.587 - 0.587 * s, 0.114 + 0.886 * s],
+    ], dtype=np.float32)
+
+def _decode(image_data: ImageData, scale: int = 1) -> np.ndarray:
+    """Decode shared image bytes to a BGR array, optionally at 1/scale resolution"""
+    return cv2.imdecode(np.frombuffer(image_data[0], np.uint8), _DECODE_FLAGS[scale])
+
+def _read_once(path: str) -> ImageData:
+    """Read the file once and parse only its header (Image.open is lazy, no pixel decode)"""
+    stat = os.stat(path)
+    data = _load_bytes(path, stat.st_mtime, stat.st_size)
+    with Image.open(io.BytesIO(data)) as im:
+        return data, im.width, im.height, im.format
+
 class AgentRouter:
     """Routes requests to appropriate agents based on user intent"""
     
+    # Keyword rules for unambiguous prompts; compiled once for all instances
+    KEYWORD_ROUTES = (
+        ("global_edit", re.compile(r'\b(brighter|darker|contrast|saturat\w*|warm\w*|cold\w*|vibrant)\b', re.I)),
+        ("local_edit", re.compile(r'\b(remove|erase|delete|inpaint)\b', re.I)),
+        ("info", re.compile(r"\b(what|tell me|describe|info|analy[sz]e)\b", re.I)),
+    )
+    
     def __init__(self, client: genai.Client):
         self.client = client
     
-    def route_request(self, image_path: str, prompt: str) -> str:
+    def _keyword_route(self, prompt: str) -> Optional[str]:
+        """Return the action when exactly one keyword category matches"""
+        matches = [action for action, pattern in self.KEYWORD_ROUTES if pattern.search(prompt)]
+        return matches[0] if len(matches) == 1 else None
+    
+    async def route_request(self, image_path: str, prompt: str) -> str:
         """Determine which agent should handle the request"""
         
+        # Skip the LLM round trip when the keywords are unambiguous
+        action = self._keyword_route(prompt)
+        if action:
+            return action
+        
         routing_prompt = f"""
         Analyze this user request and determine the appropriate action:
         User prompt: "{prompt}"
@@ -45,7 +172,7 @@ class AgentRouter:
         Only respond with the action name.
         """
         
-        response = self.client.models.generate_content(
+        response = await self.client.aio.models.generate_content(
             model='gemini-2.0-flash-001',
             contents=routing_prompt
         )
@@ -57,24 +184,28 @@ class ImageInfoAgent:
     def __init__(self, client: genai.Client):
         self.client = client
     
-    def analyze_image(self, image_path: str, prompt: str) -> Dict:
-        """Extract comprehensive image information"""
+    async def analyze_image(self, image_path: str, prompt: str, image_data: Optional[ImageData] = None,
+                            chat=None) -> Dict:
+        """Extract comprehensive image information.
+
+        With chat set to an async session that already holds the image, only the text prompt is sent.
+        """
         
-        # Load image for technical analysis
-        img = Image.open(image_path)
+        # Read bytes once; metadata comes from the header, the same bytes feed the upload
+        image_data = image_data or _read_once(image_path)
+        image_bytes, width, height, fmt = image_data
+        with Image.open(io.BytesIO(image_bytes)) as img:
+            mode = img.mode
         
         # Basic metadata
         info = {
-            "resolution": f"{img.width}x{img.height}",
-            "format": img.format,
-            "mode": img.mode,
-            "file_size": os.path.getsize(image_path)
+            "resolution": f"{width}x{height}",
+            "format": fmt,
+            "mode": mode,
+            "file_size": len(image_bytes)
         }
         
         # Use Gemini for content analysis
-        with open(image_path, 'rb') as f:
-            image_bytes = f.read()
-        
         analysis_prompt = f"""
         Analyze this image and provide:
         1. Main subjects/objects
@@ -86,15 +217,15 @@ class ImageInfoAgent:
         User specific question: {prompt}
         """
         
-        image_part = types.Part.from_bytes(
-            data=image_bytes, 
-            mime_type='image/jpeg'
-        )
-        
-        response = self.client.models.generate_content(
-            model='gemini-2.0-flash-001',
-            contents=[analysis_prompt, image_part]
-        )
+        if chat is not None:
+            response = await chat.send_message(analysis_prompt)
+        else:
+            image_part = _image_part(image_data)
+            
+            response = await self.client.aio.models.generate_content(
+                model='gemini-2.0-flash-001',
+                contents=[analysis_prompt, image_part]
+            )
         
         info["analysis"] = response.text
         return info
@@ -105,8 +236,8 @@ class GlobalEditAgent:
     def __init__(self, client: genai.Client):
         self.client = client
     
-    def edit_image(self, image_path: str, prompt: str) -> str:
-        """Apply global edits based on prompt"""
+    def edit_image(self, image_path: str, prompt: str, image_data: Optional[ImageData] = None) -> Tuple[str, bytes]:
+        """Apply global edits based on prompt; returns the saved path and the encoded bytes"""
         
         # Parse editing intent
         edit_prompt = f"""
@@ -131,52 +262,50 @@ class GlobalEditAgent:
         )
         
         try:
-            params = json.loads(response.text.strip())
+            params = json_loads(response.text)
         except:
             params = {"brightness": 0, "contrast": 0, "saturation": 0, "temperature": "neutral"}
         
         # Apply edits
-        img = Image.open(image_path)
-        
-        # Brightness
-        if params.get("brightness", 0) != 0:
-            enhancer = ImageEnhance.Brightness(img)
-            factor = 1 + (params["brightness"] / 100)
-            img = enhancer.enhance(factor)
-        
-        # Contrast
-        if params.get("contrast", 0) != 0:
-            enhancer = ImageEnhance.Contrast(img)
-            factor = 1 + (params["contrast"] / 100)
-            img = enhancer.enhance(factor)
-        
-        # Saturation
+        img = Image.open(io.BytesIO((image_data or _read_once(image_path))[0]))
+        if img.mode != 'RGB':
+            img = img.convert('RGB')
+        img_rgb = np.asarray(img)
+
+        # Brightness + contrast as a single 256-entry LUT
+        bright_factor = 1 + (params.get("brightness", 0) / 100)
+        contrast_factor = 1 + (params.get("contrast", 0) / 100)
+        lut = IDENTITY_LUT
+        if bright_factor != 1 or contrast_factor != 1:
+            lut = np.clip(np.arange(256, dtype=np.float32) / 255 * bright_factor, 0, 1)
+            lut = np.clip(((lut - 0.5) * contrast_factor + 0.5) * 255, 0, 255).astype(np.uint8)
+        gains = TEMPERATURE_GAINS.get(params.get("temperature"))
+
+        # Saturation - one 3x3 colour matrix pass; it sits between tone and temperature,
+        # so a pending tone LUT has to be applied before it
         if params.get("saturation", 0) != 0:
-            enhancer = ImageEnhance.Color(img)
-            factor = 1 + (params["saturation"] / 100)
-            img = enhancer.enhance(factor)
-        
-        # Temperature adjustment
-        if params.get("temperature") == "warm":
-            img = self._adjust_temperature(img, 1.1, 0.9)
-        elif params.get("temperature") == "cold":
-            img = self._adjust_temperature(img, 0.9, 1.1)
+            if lut is not IDENTITY_LUT:
+                img_rgb = cv2.LUT(img_rgb, lut)
+                lut = IDENTITY_LUT
+            img_rgb = cv2.transform(img_rgb, _saturation_matrix(1 + (params["saturation"] / 100)))
+
+        # Temperature gains fused with any pending tone LUT into one per-channel sweep
+        if gains:
+            lut = cv2.merge([cv2.convertScaleAbs(lut, alpha=gain) for gain in gains]).reshape(256, 1, 3)
+        if lut is not IDENTITY_LUT:
+            img_rgb = cv2.LUT(img_rgb, lut)
+
+        img = Image.fromarray(img_rgb)
         
         # Save edited image
+        # Encode in memory, write those bytes, and hand them back for the next step
         output_path = image_path.replace('.', '_edited.')
-        img.save(output_path)
-        return output_path
-    
-    def _adjust_temperature(self, img: Image.Image, red_factor: float, blue_factor: float) -> Image.Image:
-        """Adjust color temperature"""
-        if img.mode != 'RGB':
-            img = img.convert('RGB')
-        
-        data = np.array(img)
-        data[:, :, 0] = np.clip(data[:, :, 0] * red_factor, 0, 255)  # Red
-        data[:, :, 2] = np.clip(data[:, :, 2] * blue_factor, 0, 255)  # Blue
-        
-        return Image.fromarray(data.astype(np.uint8))
+        buf = io.BytesIO()
+        img.save(buf, format=Image.registered_extensions().get(os.path.splitext(output_path)[1].lower(), 'PNG'))
+        data = buf.getvalue()
+        with open(output_path, 'wb') as f:
+            f.write(data)
+        return output_path, data
 
 class LocalEditAgent:
     """Handles object detection and local edits like inpainting"""
@@ -184,11 +313,11 @@ class LocalEditAgent:
     def __init__(self, client: genai.Client):
         self.client = client
     
-    def detect_objects(self, image_path: str, prompt: str) -> List[BoundingBox]:
+    async def detect_objects(self, image_path: str, prompt: str, image_data: Optional[ImageData] = None) -> List[BoundingBox]:
         """Detect objects using Gemini vision"""
         
-        with open(image_path, 'rb') as f:
-            image_bytes = f.read()
+        image_data = image_data or _read_once(image_path)
+        _, width, height, _ = image_data
         
         detection_prompt = f"""
         Identify and locate objects in this image based on: "{prompt}"
@@ -200,12 +329,9 @@ class LocalEditAgent:
         {{"objects": [{{"name": "object1", "bbox": [10, 20, 30, 40]}}, ...]}}
         """
         
-        image_part = types.Part.from_bytes(
-            data=image_bytes, 
-            mime_type='image/jpeg'
-        )
+        image_part = _image_part(image_data)
         
-        response = self.client.models.generate_content(
+        response = await self.client.aio.models.generate_content(
             model='gemini-2.0-flash-001',
             contents=[detection_prompt, image_part],
             config=types.GenerateContentConfig(
@@ -214,57 +340,73 @@ class LocalEditAgent:
         )
         
         try:
-            result = json.loads(response.text.strip())
-            bboxes = []
-            img = Image.open(image_path)
-            
-            for obj in result.get("objects", []):
-                bbox_percent = obj["bbox"]
-                bbox = BoundingBox(
-                    x=int(bbox_percent[0] * img.width / 100),
-                    y=int(bbox_percent[1] * img.height / 100),
-                    width=int(bbox_percent[2] * img.width / 100),
-                    height=int(bbox_percent[3] * img.height / 100)
-                )
-                bboxes.append(bbox)
-            
-            return bboxes
+            result = json_loads(response.text)
+            objects = result.get("objects", [])
+            if not objects:
+                return []
+
+            # Percent -> pixel coordinates for all boxes in one vector op
+            percents = np.array([obj["bbox"] for obj in objects], dtype=np.float32)
+            scale = np.array([width, height, width, height], dtype=np.float32) / 100
+            pixels = (percents * scale).astype(np.int32)
+
+            return [BoundingBox(*row) for row in pixels.tolist()]
         except:
             return []
     
-    def inpaint_region(self, image_path: str, bounding_box: BoundingBox, prompt: str) -> str:
-        """Simple inpainting by blurring/filling region"""
+    def inpaint_region(self, image_path: str, bounding_box: BoundingBox, prompt: str,
+                       image_data: Optional[ImageData] = None, scale: int = 1,
+                       decoded: Optional[np.ndarray] = None) -> Tuple[str, bytes]:
+        """Simple inpainting by blurring/filling region.
+
+        scale > 1 (2, 4 or 8) decodes at reduced resolution for previews.
+        decoded is an already-decoded BGR frame at that scale; it is modified in place.
+        Returns the saved path and the encoded bytes.
+        """
         
-        img = cv2.imread(image_path)
+        if decoded is not None:
+            img = decoded
+        else:
+            img = _decode(image_data or _read_once(image_path), scale)
         h, w = img.shape[:2]
         
+        # Bounding box in decoded-image coordinates
+        x1, y1 = bounding_box.x // scale, bounding_box.y // scale
+        x2 = (bounding_box.x + bounding_box.width) // scale
+        y2 = (bounding_box.y + bounding_box.height) // scale
+        
+        # Only inpaint a padded crop around the box, not the whole frame
+        rx1, ry1 = max(0, x1 - INPAINT_PADDING), max(0, y1 - INPAINT_PADDING)
+        rx2, ry2 = min(w, x2 + INPAINT_PADDING + 1), min(h, y2 + INPAINT_PADDING + 1)
+        roi = img[ry1:ry2, rx1:rx2]
+        
         # Create mask for the region
-        mask = np.zeros((h, w), dtype=np.uint8)
-        cv2.rectangle(mask, 
-                     (bounding_box.x, bounding_box.y),
-                     (bounding_box.x + bounding_box.width, 
-                      bounding_box.y + bounding_box.height),
-                     255, -1)
+        roi_mask = np.zeros(roi.shape[:2], dtype=np.uint8)
+        cv2.rectangle(roi_mask, (x1 - rx1, y1 - ry1), (x2 - rx1, y2 - ry1), 255, -1)
         
         # Simple inpainting using OpenCV
-        inpainted = cv2.inpaint(img, mask, 3, cv2.INPAINT_TELEA)
+        mask_ratio = ((x2 - x1 + 1) * (y2 - y1 + 1)) / (w * h)
+        method = cv2.INPAINT_NS if mask_ratio < SMALL_MASK_RATIO else cv2.INPAINT_TELEA
+        img[ry1:ry2, rx1:rx2] = cv2.inpaint(roi, roi_mask, 3, method)
+        inpainted = img
         
         # Save result
         output_path = image_path.replace('.', '_inpainted.')
-        cv2.imwrite(output_path, inpainted)
-        return output_path
+        ok, buf = cv2.imencode(os.path.splitext(output_path)[1], inpainted)
+        if not ok:
+            raise ValueError(f"Could not encode {output_path}")
+        data = buf.tobytes()
+        with open(output_path, 'wb') as f:
+            f.write(data)
+        return output_path, data
 
 class ImageEditingAssistant:
     """Main assistant coordinating all agents"""
     
     def __init__(self, api_key: str = None):
         api_key = os.getenv("GEMINI_API_KEY")
-        # Initialize client with API key or environment variable
-        if api_key:
-            self.client = genai.Client(api_key=api_key)
-        else:
-            # Uses GOOGLE_API_KEY environment variable
-            self.client = genai.Client()
+        # Shared client with API key or environment variable
+        self.client = _get_client(api_key)
         
         # Initialize agents
         self.router = AgentRouter(self.client)
@@ -274,32 +416,129 @@ class ImageEditingAssistant:
     
     def process_request(self, image_path: str, prompt: str) -> Dict:
         """Process user request through appropriate agents"""
+        return asyncio.run(self.process_request_async(image_path, prompt))
+
+    async def process_request_async(self, image_path: str, prompt: str) -> Dict:
+        """Async version of process_request for callers that already run an event loop"""
         
         try:
             # Route request
-            action = self.router.route_request(image_path, prompt)
+            action = await self.router.route_request(image_path, prompt)
+            
+            # Read the image once and share it between agents
+            image_data = None
+            if action in ("info", "global_edit", "local_edit"):
+                image_data = _read_once(image_path)
+
+            return await self._run_action(action, image_path, prompt, image_data)
+
+        except Exception as e:
+            return {"error": f"Processing failed: {str(e)}"}
+
+    async def _run_action(self, action: str, image_path: str, prompt: str,
+                          image_data: Optional[ImageData], chat=None) -> Dict:
+        """Dispatch a routed request to its agent"""
+
+        result = {"action": action}
+
+        if action == "info":
+            result["data"] = await self.info_agent.analyze_image(image_path, prompt, image_data, chat=chat)
+
+        elif action == "global_edit":
+            output_path, edited_bytes = self.global_agent.edit_image(image_path, prompt, image_data)
+            result["edited_image"] = output_path
+            result["edited_bytes"] = edited_bytes
+
+        elif action == "local_edit":
+            # Detect objects first
+            bboxes = await self.local_agent.detect_objects(image_path, prompt, image_data)
+            if bboxes:
+                # Use first detected object for inpainting
+                output_path, edited_bytes = await asyncio.to_thread(
+                    self.local_agent.inpaint_region, image_path, bboxes[0], prompt, image_data
+                )
+                result["edited_image"] = output_path
+                result["edited_bytes"] = edited_bytes
+                result["detected_objects"] = len(bboxes)
+            else:
+                result["error"] = "No objects detected for local editing"
+
+        elif action == "clarify":
+            result["message"] = "Please provide more specific details about what you'd like to do with the image."
+
+        return result
+
+    def process_batch(self, image_path: str, prompts: List[str]) -> List[Dict]:
+        """Process several prompts against one image, uploading it only once.
+
+        The image is sent as the first turn of a chat session; info questions
+        are then asked in that session as text. Edits still run locally.
+        """
+        return asyncio.run(self._process_batch(image_path, prompts))
+
+    async def _process_batch(self, image_path: str, prompts: List[str]) -> List[Dict]:
+        try:
+            image_data = _read_once(image_path)
+            chat = self.client.aio.chats.create(model='gemini-2.0-flash-001')
+            await chat.send_message([
+                "This is the image for the requests that follow.",
+                _image_part(image_data)
+            ])
+        except Exception as e:
+            return [{"error": f"Processing failed: {str(e)}"} for _ in prompts]
+
+        results = []
+        for prompt in prompts:
+            try:
+                action = await self.router.route_request(image_path, prompt)
+                results.append(await self._run_action(action, image_path, prompt, image_data, chat=chat))
+            except Exception as e:
+                results.append({"error": f"Processing failed: {str(e)}"})
+        return results
+
+    def process_request_parallel(self, image_path: str, prompt: str) -> Dict:
+        """Like process_request, but runs independent Gemini calls concurrently.
+
+        Routing and image analysis are fired together; for edits the analysis is
+        returned under "info". For local edits the full decode overlaps detection.
+        """
+        return asyncio.run(self._process_request_parallel(image_path, prompt))
+
+    async def _process_request_parallel(self, image_path: str, prompt: str) -> Dict:
+        try:
+            image_data = _read_once(image_path)
+            info_task = asyncio.create_task(self.info_agent.analyze_image(image_path, prompt, image_data))
+            action = await self.router.route_request(image_path, prompt)
             
             result = {"action": action}
             
             if action == "info":
-                result["data"] = self.info_agent.analyze_image(image_path, prompt)
+                result["data"] = await info_task
                 
             elif action == "global_edit":
-                output_path = self.global_agent.edit_image(image_path, prompt)
-                result["edited_image"] = output_path
+                # Pixel work goes to a worker thread so the analysis response keeps flowing
+                result["edited_image"], result["edited_bytes"] = await asyncio.to_thread(
+                    self.global_agent.edit_image, image_path, prompt, image_data
+                )
+                result["info"] = await info_task
                 
             elif action == "local_edit":
-                # Detect objects first
-                bboxes = self.local_agent.detect_objects(image_path, prompt)
+                bboxes, decoded = await asyncio.gather(
+                    self.local_agent.detect_objects(image_path, prompt, image_data),
+                    asyncio.to_thread(_decode, image_data)
+                )
                 if bboxes:
-                    # Use first detected object for inpainting
-                    output_path = self.local_agent.inpaint_region(image_path, bboxes[0], prompt)
-                    result["edited_image"] = output_path
+                    # Inpaint off the event loop so the analysis call keeps progressing
+                    result["edited_image"], result["edited_bytes"] = await asyncio.to_thread(
+                        self.local_agent.inpaint_region, image_path, bboxes[0], prompt, image_data, decoded=decoded
+                    )
                     result["detected_objects"] = len(bboxes)
                 else:
                     result["error"] = "No objects detected for local editing"
-                    
+                result["info"] = await info_task
+                
             elif action == "clarify":
+                info_task.cancel()
                 result["message"] = "Please provide more specific details about what you'd like to do with the image."
             
             return result
@@ -314,13 +553,7 @@ class AdvancedImageEditingAssistant(ImageEditingAssistant):
     def chat_based_editing(self, image_path: str, initial_prompt: str) -> Dict:
         """Multi-turn conversation for iterative editing"""
         
-        with open(image_path, 'rb') as f:
-            image_bytes = f.read()
-        
-        image_part = types.Part.from_bytes(
-            data=image_bytes, 
-            mime_type='image/jpeg'
-        )
+        image_part = _image_part(_read_once(image_path))
         
         # Create chat session
         chat = self.client.chats.create(model='gemini-2.0-flash-001')
@@ -340,24 +573,7 @@ class AdvancedImageEditingAssistant(ImageEditingAssistant):
     def structured_edit_analysis(self, image_path: str, prompt: str) -> Dict:
         """Get structured analysis using response schema"""
         
-        from pydantic import BaseModel
-        from typing import List as PyList
-        
-        class ImageAnalysis(BaseModel):
-            objects: PyList[str]
-            dominant_colors: PyList[str]
-            lighting: str
-            scene_type: str
-            quality_score: int
-            suggested_edits: PyList[str]
-        
-        with open(image_path, 'rb') as f:
-            image_bytes = f.read()
-        
-        image_part = types.Part.from_bytes(
-            data=image_bytes, 
-            mime_type='image/jpeg'
-        )
+        image_part = _image_part(_read_once(image_path))
         
         analysis_prompt = f"""
         Analyze this image comprehensively and provide:
@@ -380,7 +596,8 @@ class AdvancedImageEditingAssistant(ImageEditingAssistant):
             )
         )
         
-        return json.loads(response.text)
+        # Parse and validate in one pass inside pydantic-core
+        return ImageAnalysis.model_validate_json(response.text).model_dump()
 
 # Usage example
 def main():
@@ -401,10 +618,11 @@ def main():
         "Add more contrast"
     ]
     
-    for prompt in requests:
+    # One chat session for all requests - the image is uploaded once
+    results = assistant.process_batch(image_path, requests)
+    for prompt, result in zip(requests, results):
         print(f"\nPrompt: {prompt}")
-        result = assistant.process_request(image_path, prompt)
-        print(f"Result: {result}")
+        print(f"Result: { {k: v for k, v in result.items() if k != 'edited_bytes'} }")
     
     # Advanced structured analysis
     try:
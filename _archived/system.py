@@ -1,6 +1,5 @@
-from sentence_transformers import SentenceTransformer
-import pandas as pd
 import google.generativeai as genai
+from pydantic import BaseModel
 
 genai.configure(api_key="*") # change to your api
 safety_settings = [
@@ -27,17 +26,17 @@ safety_settings = [
 ]
 
 GEMINI = genai.GenerativeModel('gemini-2.5-flash-preview-05-20', safety_settings = safety_settings)
-response = GEMINI.generate_content("Hello")
 
 class DummyResponse:
     def __init__(self, text):
         self.text = text
 
+class RelevanceAnswer(BaseModel):
+    relevant: bool
+    answer: str
+
 def join_list_into_string(my_list):
-    result = ""
-    for i, item in enumerate(my_list):
-        result += f"{i+1}. {item}\n\n"
-    return result.rstrip()
+    return "\n\n".join(f"{i}. {item}" for i, item in enumerate(my_list, 1)).rstrip()
 
 
 def separate_last_user_query(conversation):
@@ -124,14 +123,10 @@ Note: Please answer using letters (A. or B.)
 
 def answer_query_with_context(query, conversation_text, contexts):
     string_context = join_list_into_string(contexts)
+    print(f"\n--------\nMESSAGE: {string_context}\n--------\n")
 
-    context_relevant = check_if_context_is_relevant(query, string_context)
-
-    if not context_relevant: return DummyResponse(text = "I am very sorry for the inconvenience, I cannot find the right information for your question")
-
-    else:
-        print(f"\n--------\nMESSAGE: {string_context}\n--------\n")
-        prompt = f"""You are an Assistant
+    # One structured call both judges the context and answers from it
+    prompt = f"""You are an Assistant
 Given the following conversation history, reformulated user's query and context.
 
 Conversation history:
@@ -143,10 +138,17 @@ Reformulated query:
 Retrieved Context:
 {string_context}
 
-Please answer the user based on the information in the context
-        """
-        response = GEMINI.generate_content(prompt)
-        return response
+First decide whether the context has relevant information to answer the query (relevant).
+If it does, answer the user based on the information in the context (answer); otherwise leave answer empty.
+    """
+    response = GEMINI.generate_content(
+        prompt,
+        generation_config={"response_mime_type": "application/json", "response_schema": RelevanceAnswer}
+    )
+    result = RelevanceAnswer.model_validate_json(response.text)
+
+    if not result.relevant: return DummyResponse(text = "I am very sorry for the inconvenience, I cannot find the right information for your question")
+    return DummyResponse(text = result.answer)
 
 
 def handle_conversation_turn(conversation_history):
@@ -1,9 +1,17 @@
-import gradio as gr
+from __future__ import annotations
+
 import numpy as np
 import os
+import atexit
+import asyncio
 import tempfile
 import shutil
+import hashlib
+import itertools
 import logging
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from PIL import Image
 from typing import Optional, Tuple, List
 from logic.assistant import ImageEditingAssistant
@@ -13,13 +21,94 @@ from logic.router_agent import ActionType
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# Chat turns handled at once; each runs in a worker thread off Gradio's event loop
+CHAT_CONCURRENCY_LIMIT = 4
+
+# Edited images reloaded into the editor are decoded at no more than this size (where the
+# format supports reduced decoding); the frame becomes the next turn's input, so keep it generous
+EDITOR_MAX_SIZE = (4096, 4096)
+# Formats the agents write; naming them skips Pillow's sniffing of every registered plugin
+EDITED_IMAGE_FORMATS = ("PNG", "JPEG", "WEBP")
+
+# Edit outputs kept on disk per session; older ones are deleted as new ones arrive
+MAX_TRACKED_OUTPUTS = 16
+
+# Oldest files in the session temp directory are evicted once it grows past this
+TEMP_DIR_MAX_BYTES = 512 * 1024 * 1024
+
+def _format_info(response) -> Optional[str]:
+    info = response.info_data
+    if not info:
+        return None
+    return f"📊 **Image Analysis**:\n\n{info.description}\n\n" \
+           f"**Dimensions**: {info.metadata.width}x{info.metadata.height}\n" \
+           f"**Format**: {info.metadata.format}\n" \
+           f"**Color Space**: {info.metadata.color_space}"
+
+def _format_global_edit(response) -> Optional[str]:
+    edit = response.edit_data
+    if not edit:
+        return None
+    return f"✨ **Global Edit Complete**:\n\n{edit.message}\n\n" \
+           f"**Edits Applied**: {', '.join(edit.edits_applied)}\n" \
+           f"📸 *Image updated in editor*"
+
+def _format_local_edit(response) -> Optional[str]:
+    edit = response.edit_data
+    if not edit:
+        return None
+    objects_info = ""
+    if edit.detected_objects:
+        objects_info = f"\n**Objects Detected**: {len(edit.detected_objects)} items"
+    
+    return f"🎯 **Local Edit Complete**:\n\n{edit.message}{objects_info}\n" \
+           f"📸 *Image updated in editor*"
+
+def _format_clarify(response) -> Optional[str]:
+    clarify = response.clarify_data
+    if not clarify:
+        return None
+    suggestions = ""
+    if clarify.suggested_prompts:
+        suggestions = "\n\n**Suggestions**:\n" + \
+                    "\n".join([f"• {prompt}" for prompt in clarify.suggested_prompts])
+    
+    return f"💭 {clarify.message}{suggestions}"
+
+def _format_answer(response) -> Optional[str]:
+    if not response.clarify_data:
+        return None
+    return f"💬 {response.clarify_data.message}"
+
+# One dict lookup per response instead of walking an if/elif chain
+_RESPONSE_FORMATTERS = {
+    ActionType.INFO: _format_info,
+    ActionType.GLOBAL_EDIT: _format_global_edit,
+    ActionType.LOCAL_EDIT: _format_local_edit,
+    ActionType.CLARIFY: _format_clarify,
+    ActionType.ANSWER: _format_answer,
+}
+
 class GradioImageEditingUI:
     """Gradio UI for the Image Editing Assistant"""
     
     def __init__(self, use_gemini_local_edit: bool = False):
         self.assistant = ImageEditingAssistant(use_gemini_local_edit=use_gemini_local_edit)
-        self.current_image_path: Optional[str] = None
-        self.temp_dir = tempfile.mkdtemp()
+        self.current_image: Optional[np.ndarray] = None
+        # Honor GRADIO_TEMP_DIR so operators can point scratch files at a dedicated volume
+        temp_root = os.environ.get("GRADIO_TEMP_DIR")
+        if temp_root:
+            os.makedirs(temp_root, exist_ok=True)
+        self.temp_dir = tempfile.mkdtemp(dir=temp_root)
+        # Remove the directory however the process exits, not only via main()'s finally
+        atexit.register(self.cleanup)
+        # Editor images are passed to the assistant in memory, with a path that only names
+        # edit outputs; every turn gets its own, so concurrent turns never share an output file
+        self._turn_ids = itertools.count()
+        # Held while deleting temp files and while a turn reads its edit output back
+        self._files_lock = threading.Lock()
+        # Edit outputs written to temp_dir, oldest first, so cleanup happens during the session
+        self._outputs: deque = deque()
         self.use_gemini_local_edit = use_gemini_local_edit
         logger.info(f"Temporary directory created: {self.temp_dir}")
         if use_gemini_local_edit:
@@ -27,61 +116,110 @@ class GradioImageEditingUI:
         else:
             logger.info("Gradio UI initialized with Standard Local Edit Agent")
     
-    def save_image_from_editor(self, image_data) -> Optional[str]:
-        """Save image from ImageEditor to temporary file"""
-        if image_data is None:
-            return None
+    def get_editor_array(self, image_data) -> Optional[np.ndarray]:
+        """Extract the image array from ImageEditor data"""
+        # Handle different image data formats
+        if isinstance(image_data, dict):
+            # ImageEditor returns dict with 'background' and 'layers'
+            img_array = image_data.get('background')
+        else:
+            img_array = image_data
         
+        return img_array if isinstance(img_array, np.ndarray) else None
+    
+    def array_to_image(self, img_array: np.ndarray) -> Image.Image:
+        """Wrap an editor array as a PIL image, copying only when the dtype or layout needs it"""
+        # ImageEditor(type="numpy") already hands back C-contiguous uint8
+        if img_array.dtype != np.uint8:
+            img_array = img_array.astype(np.uint8, copy=False)
+        return Image.fromarray(np.ascontiguousarray(img_array))
+    
+    def get_frame_key(self, img_array: np.ndarray) -> bytes:
+        """Cheap content hash of an editor frame, taken straight from its buffer"""
+        hasher = hashlib.blake2b(str(img_array.shape).encode(), digest_size=8)
+        hasher.update(np.ascontiguousarray(img_array))
+        return hasher.digest()
+    
+    def turn_image_path(self) -> str:
+        """A fresh output-naming path in temp_dir for one chat turn"""
+        return os.path.join(self.temp_dir, f"editor_{next(self._turn_ids)}.png")
+    
+    def enforce_temp_dir_limit(self, max_bytes: int = TEMP_DIR_MAX_BYTES):
+        """Evict the oldest temp files until the directory fits within max_bytes"""
+        with self._files_lock:
+            self._enforce_temp_dir_limit(max_bytes)
+    
+    def _enforce_temp_dir_limit(self, max_bytes: int):
         try:
-            # Handle different image data formats
-            if isinstance(image_data, dict):
-                # ImageEditor returns dict with 'background' and 'layers'
-                img_array = image_data.get('background')
-                if img_array is None:
-                    return None
-            else:
-                img_array = image_data
-            
-            # Convert numpy array to PIL Image
-            if isinstance(img_array, np.ndarray):
-                img = Image.fromarray(img_array.astype('uint8'))
-            else:
-                return None
-            
-            # Save to temporary file
-            temp_path = os.path.join(self.temp_dir, f"temp_image_{len(os.listdir(self.temp_dir))}.png")
-            img.save(temp_path)
-            return temp_path
-            
+            # scandir returns the stat info with each entry - one call per file
+            entries = [(entry.stat().st_mtime, entry.stat().st_size, entry.path)
+                       for entry in os.scandir(self.temp_dir) if entry.is_file()]
+            total = sum(size for _, size, _ in entries)
+            for _, size, path in sorted(entries):
+                if total <= max_bytes:
+                    break
+                os.remove(path)
+                total -= size
+                logger.info(f"Evicted temp file to cap disk usage: {path}")
         except Exception as e:
-            logger.error(f"Error saving image: {e}")
-            return None
+            logger.error(f"Error enforcing temp directory limit: {e}")
+    
+    def frame_changed(self, before: Optional[np.ndarray], after) -> bool:
+        """Cheap change test: identity, then shape, and only then a content hash of both frames"""
+        if after is before or not isinstance(after, np.ndarray):
+            # Unchanged editor payload handed back as-is
+            return False
+        if before is None or after.shape != before.shape:
+            return True
+        return self.get_frame_key(after) != self.get_frame_key(before)
+    
+    def track_output(self, path: str):
+        """Remember an edit output in temp_dir and delete the oldest beyond MAX_TRACKED_OUTPUTS
+
+        Call with _files_lock held.
+        """
+        if os.path.dirname(path) != self.temp_dir or path in self._outputs:
+            return
+        self._outputs.append(path)
+        while len(self._outputs) > MAX_TRACKED_OUTPUTS:
+            old_path = self._outputs.popleft()
+            try:
+                os.unlink(old_path)
+            except FileNotFoundError:
+                pass
     
     def process_chat_message(self, message: str, history: List, image_data) -> Tuple[List, str, Optional[np.ndarray]]:
         """Process chat message and return updated history and potentially updated image"""
         if not message.strip():
             return history, "", image_data
         
-        # Save current image if available
-        image_path = None
-        if image_data is not None:
-            image_path = self.save_image_from_editor(image_data)
-            self.current_image_path = image_path
-            logger.info(f"Image saved for processing: {image_path}")
+        # Pass the editor buffer through in memory instead of saving it every turn
+        img_array = self.get_editor_array(image_data) if image_data is not None else None
+        if img_array is not None:
+            self.current_image = img_array
+            logger.info(f"Using in-memory editor image for processing: {img_array.shape}")
         else:
-            logger.info("No image data provided, using current image path")
+            logger.info("No image data provided, using current image")
+        # This turn's own frame, or a local copy of the shared current image, which
+        # concurrent turns may replace meanwhile
+        image = img_array if img_array is not None else self.current_image
+        image_path = self.turn_image_path() if image is not None else None
+        
+        # Edit outputs land in temp_dir; keep it bounded before producing another
+        self.enforce_temp_dir_limit()
         
         # Add user message to history using messages format
         history = history or []
         history.append({"role": "user", "content": message})
         
         try:
-            logger.info(f"Processing request: '{message}' with image: {image_path or self.current_image_path}")
+            logger.info(f"Processing request: '{message}' with image: {image_path}")
             
             # Process request through assistant
             response = self.assistant.process_request(
-                image_path=image_path or self.current_image_path, 
-                prompt=message
+                image_path=image_path, 
+                prompt=message,
+                image=image
             )
             
             logger.info(f"Assistant response action: {response.action}")
@@ -92,13 +230,19 @@ class GradioImageEditingUI:
             # Add assistant response to history using messages format
             history.append({"role": "assistant", "content": assistant_response})
             
-            # Check if we have an edited image to replace the current one
-            updated_image = self.get_edited_image_from_response(response, image_data)
+            # Check if we have an edited image to replace the current one; other turns
+            # can't evict the output while it is read back
+            with self._files_lock:
+                updated_image = self.get_edited_image_from_response(response, image_data)
+                if response.edit_data:
+                    self.track_output(response.edit_data.edited_image_path)
             
-            if updated_image is not None and not np.array_equal(updated_image, image_data if image_data is not None else np.array([])):
-                logger.info("Image was updated by the assistant")
-            else:
-                logger.info("No image update from assistant")
+            # Change detection only feeds this log line, so skip it when INFO is off
+            if logger.isEnabledFor(logging.INFO):
+                if self.frame_changed(img_array, updated_image):
+                    logger.info("Image was updated by the assistant")
+                else:
+                    logger.info("No image update from assistant")
             
         except Exception as e:
             logger.error(f"Error processing message: {e}", exc_info=True)
@@ -120,8 +264,11 @@ class GradioImageEditingUI:
         # Load and return edited image if available
         if edited_path and os.path.exists(edited_path):
             try:
-                img = Image.open(edited_path)
-                return np.array(img)
+                # Decode once (reduced for oversized JPEGs) and view the pixel buffer instead of copying it
+                with Image.open(edited_path, formats=EDITED_IMAGE_FORMATS) as img:
+                    img.draft("RGB", EDITOR_MAX_SIZE)
+                    img.load()
+                    return np.asarray(img)
             except Exception as e:
                 logger.error(f"Error loading edited image: {e}")
         
@@ -132,41 +279,8 @@ class GradioImageEditingUI:
         if response.error:
             return f"❌ **Error**: {response.error.error}\n{response.error.details or ''}"
         
-        if response.action == ActionType.INFO and response.info_data:
-            info = response.info_data
-            return f"📊 **Image Analysis**:\n\n{info.description}\n\n" \
-                   f"**Dimensions**: {info.metadata.width}x{info.metadata.height}\n" \
-                   f"**Format**: {info.metadata.format}\n" \
-                   f"**Color Space**: {info.metadata.color_space}"
-        
-        elif response.action == ActionType.GLOBAL_EDIT and response.edit_data:
-            edit = response.edit_data
-            return f"✨ **Global Edit Complete**:\n\n{edit.message}\n\n" \
-                   f"**Edits Applied**: {', '.join(edit.edits_applied)}\n" \
-                   f"📸 *Image updated in editor*"
-        
-        elif response.action == ActionType.LOCAL_EDIT and response.edit_data:
-            edit = response.edit_data
-            objects_info = ""
-            if edit.detected_objects:
-                objects_info = f"\n**Objects Detected**: {len(edit.detected_objects)} items"
-            
-            return f"🎯 **Local Edit Complete**:\n\n{edit.message}{objects_info}\n" \
-                   f"📸 *Image updated in editor*"
-        
-        elif response.action == ActionType.CLARIFY and response.clarify_data:
-            clarify = response.clarify_data
-            suggestions = ""
-            if clarify.suggested_prompts:
-                suggestions = "\n\n**Suggestions**:\n" + \
-                            "\n".join([f"• {prompt}" for prompt in clarify.suggested_prompts])
-            
-            return f"💭 {clarify.message}{suggestions}"
-        
-        elif response.action == ActionType.ANSWER and response.clarify_data:
-            return f"💬 {response.clarify_data.message}"
-        
-        return "✅ Request processed successfully!"
+        formatter = _RESPONSE_FORMATTERS.get(response.action)
+        return (formatter and formatter(response)) or "✅ Request processed successfully!"
     
     def download_current_image(self, image_data) -> Optional[str]:
         """Prepare current image for download"""
@@ -183,7 +297,7 @@ class GradioImageEditingUI:
             if img_array is None:
                 return None
             
-            img = Image.fromarray(img_array.astype('uint8'))
+            img = self.array_to_image(img_array)
             download_path = os.path.join(self.temp_dir, "download_image.png")
             img.save(download_path)
             return download_path
@@ -194,10 +308,14 @@ class GradioImageEditingUI:
     
     def create_interface(self):
         """Create the Gradio interface"""
+        # Gradio is only needed once the interface is built, not to import this module
+        import gradio as gr
         
         with gr.Blocks(
             title="Image Editing Assistant",
             theme=gr.themes.Soft(),
+            # Purge Gradio's own cached files older than a day, checked hourly
+            delete_cache=(3600, 86400),
             css="""
             .gradio-container {
                 max-width: 1200px !important;
@@ -295,8 +413,16 @@ class GradioImageEditingUI:
                     )
             
             # Event handlers
-            def send_message(message, history, image_data):
-                return self.process_chat_message(message, history, image_data)
+            async def send_message(message, history, image_data):
+                # Show the user's turn with a status line right away, leaving the editor untouched
+                if message.strip():
+                    pending = list(history or []) + [
+                        {"role": "user", "content": message},
+                        {"role": "assistant", "content": "⏳ Working on it..."}
+                    ]
+                    yield pending, "", gr.update()
+                # LLM and model calls block, so run them in a thread and keep the event loop free
+                yield await asyncio.to_thread(self.process_chat_message, message, history, image_data)
             
             def prepare_download(image_data):
                 download_path = self.download_current_image(image_data)
@@ -308,13 +434,15 @@ class GradioImageEditingUI:
             send_btn.click(
                 fn=send_message,
                 inputs=[msg_input, chatbot, image_editor],
-                outputs=[chatbot, msg_input, image_editor]  # Now updates image_editor too
+                outputs=[chatbot, msg_input, image_editor],  # Now updates image_editor too
+                concurrency_limit=CHAT_CONCURRENCY_LIMIT
             )
             
             msg_input.submit(
                 fn=send_message,
                 inputs=[msg_input, chatbot, image_editor],
-                outputs=[chatbot, msg_input, image_editor]  # Now updates image_editor too
+                outputs=[chatbot, msg_input, image_editor],  # Now updates image_editor too
+                concurrency_limit=CHAT_CONCURRENCY_LIMIT
             )
             
             download_btn.click(
@@ -329,6 +457,7 @@ class GradioImageEditingUI:
                 outputs=[chatbot]
             )
         
+        demo.queue(default_concurrency_limit=CHAT_CONCURRENCY_LIMIT)
         return demo
     
     def launch(self, **kwargs):
@@ -338,8 +467,27 @@ class GradioImageEditingUI:
     
     def cleanup(self):
         """Clean up temporary files"""
+        # Registered with atexit as well as called from main(), so it may run twice
+        if not os.path.isdir(self.temp_dir):
+            return
         try:
-            shutil.rmtree(self.temp_dir)
+            # The directory is flat, so unlink the entries and remove it - no recursive walk.
+            # Unlinks are I/O-bound, so a few threads overlap them.
+            with os.scandir(self.temp_dir) as entries:
+                paths = [entry.path for entry in entries if not entry.is_dir(follow_symlinks=False)]
+            try:
+                with ThreadPoolExecutor(max_workers=8) as pool:
+                    list(pool.map(os.unlink, paths))
+            except RuntimeError:
+                # From atexit the interpreter is shutting down and refuses new threads
+                for path in paths:
+                    os.unlink(path)
+            try:
+                os.rmdir(self.temp_dir)
+            except OSError:
+                # Something created a subdirectory after all
+                shutil.rmtree(self.temp_dir)
+            self._outputs.clear()
             logger.info("Temporary directory cleaned up")
         except Exception as e:
             logger.error(f"Error cleaning up temp directory: {e}")
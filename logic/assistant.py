@@ -1,14 +1,63 @@
+from __future__ import annotations
+
+import asyncio
+import re
 import logging
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, List, Optional, Tuple, Union
+import numpy as np
+from PIL import Image, features
+from pydantic import TypeAdapter
 from logic.router_agent import AgentRouter, ActionType
 from logic.info_agent import ImageInfoAgent
 from logic.global_edit_agent import GlobalEditAgent
-from logic.local_edit_agent import LocalEditAgent
-from logic.gemini_local_edit_agent import GeminiLocalEditAgent
+from logic.image_context import ImageContext
+from logic.vision_cache import image_hash
+from model.prompt_cache import prompt_cache
 from logic.models import (
     BoundingBox, EditResponse, LocalEditResponse, 
     ClarifyResponse, ErrorResponse, AssistantResponse
 )
 
+# Maximum number of (image, prompt) responses kept per assistant
+RESPONSE_CACHE_SIZE = 128
+# Requests process_batch runs at once
+BATCH_MAX_WORKERS = 8
+
+# Fixed responses are built once; callers get a copy
+_DEFAULT_SUGGESTIONS = (
+    "Show me information about this image",
+    "Increase the brightness of this image",
+    "Remove the object in the center of the image"
+)
+_GREETING_RESPONSE = AssistantResponse(
+    action=ActionType.ANSWER,
+    clarify_data=ClarifyResponse(
+        message="Hello! How can I help you with your image today?",
+        suggested_prompts=list(_DEFAULT_SUGGESTIONS)
+    )
+)
+_CLARIFY_DATA = ClarifyResponse(
+    message="Please provide more specific details about what you'd like to do with the image.",
+    suggested_prompts=list(_DEFAULT_SUGGESTIONS)
+)
+_NO_IMAGE_RESPONSE = AssistantResponse(
+    action=ActionType.CLARIFY,
+    clarify_data=ClarifyResponse(
+        message="Please upload or load an image first so I can work on it.",
+        suggested_prompts=list(_DEFAULT_SUGGESTIONS)
+    )
+)
+
+# Validates a whole list of boxes in one call; BoundingBox instances pass through as-is
+_BOUNDING_BOXES = TypeAdapter(List[BoundingBox])
+
+# Trivial prompts answered without calling the LLM router
+_GREETINGS = frozenset({"hi", "hello", "hey", "hola"})
+_EDIT_KEYWORDS = re.compile(r"\b(brighten|darken|remove|contrast|filter|crop|rotate|inpaint|edit|mask)\b")
+
 class ImageEditingAssistant:
     """Main assistant coordinating all agents"""
     
@@ -16,23 +65,206 @@ class ImageEditingAssistant:
         # Initialize logging
         self.logger = logging.getLogger(__name__)
         
+        # Every request decodes and encodes images, so say when the fast codec path is missing
+        if not features.check('libjpeg_turbo'):
+            self.logger.warning("Pillow was built without libjpeg-turbo; JPEG decode/encode will be slower (see README)")
+        
         # Initialize agents (they don't need client anymore)
         self.router = AgentRouter()
         self.info_agent = ImageInfoAgent()
         self.global_agent = GlobalEditAgent()
         
-        # Choose local edit agent based on configuration
+        # Choose local edit agent based on configuration; import only the chosen one
+        # (the standard agent pulls in torch/transformers/diffusers)
         if use_gemini_local_edit:
+            from logic.gemini_local_edit_agent import GeminiLocalEditAgent
             self.local_agent = GeminiLocalEditAgent()
             self.logger.info("Using Gemini Local Edit Agent")
         else:
+            from logic.local_edit_agent import LocalEditAgent
             self.local_agent = LocalEditAgent()
             self.logger.info("Using Standard Local Edit Agent")
         
+        # LRU of finished responses keyed by (image content hash, normalized prompt), each
+        # stored with the content hash of its edit output (None for non-edits)
+        self._response_cache: OrderedDict[Tuple[Optional[str], str],
+                                          Tuple[AssistantResponse, Optional[str]]] = OrderedDict()
+        # Requests may run concurrently (UI worker threads, test pools)
+        self._response_cache_lock = threading.Lock()
+        
         self.logger.info("ImageEditingAssistant initialized with all agents")
     
-    def process_request(self, image_path: str, prompt: str) -> AssistantResponse:
-        """Process user request through appropriate agents"""
+    def warmup(self) -> None:
+        """Pay the agents' one-time local setup before the first request; makes no Gemini calls"""
+        for agent in (prompt_cache, self.global_agent, self.local_agent):
+            warmup = getattr(agent, "warmup", None)
+            if warmup is None:
+                continue
+            try:
+                warmup()
+            except Exception as e:
+                self.logger.warning(f"{type(agent).__name__} warm-up failed: {e}")
+    
+    @staticmethod
+    def _output_digest(response: AssistantResponse) -> Optional[str]:
+        """Content hash of an edit response's output file; None when it has none"""
+        path = response.edit_data.edited_image_path if response.edit_data else None
+        return image_hash(image_path=path) if path else None
+    
+    def _get_cached_response(self, key: Tuple[Optional[str], str]) -> Optional[AssistantResponse]:
+        """Return a cached response, dropping edits whose output file is gone or was overwritten
+        
+        Output names only depend on the input name and the edit, so another image edited
+        the same way (e.g. the UI's editor buffer) can replace the file a response points to.
+        """
+        with self._response_cache_lock:
+            entry = self._response_cache.get(key)
+        if entry is None:
+            return None
+        response, digest = entry
+        if response.edit_data and (digest is None or self._output_digest(response) != digest):
+            with self._response_cache_lock:
+                if self._response_cache.get(key) is entry:
+                    del self._response_cache[key]
+            return None
+        with self._response_cache_lock:
+            if key in self._response_cache:
+                self._response_cache.move_to_end(key)
+        # Deep, so callers can't reach the cached nested models and lists
+        return response.model_copy(deep=True)
+    
+    def _cache_response(self, key: Tuple[Optional[str], str], response: AssistantResponse) -> None:
+        """Remember a successful response, evicting the least recently used entry"""
+        if response.error:
+            return
+        digest = self._output_digest(response)
+        # The caller keeps the original; the cache holds its own copy
+        response = response.model_copy(deep=True)
+        with self._response_cache_lock:
+            self._response_cache[key] = (response, digest)
+            self._response_cache.move_to_end(key)
+            if len(self._response_cache) > RESPONSE_CACHE_SIZE:
+                self._response_cache.popitem(last=False)
+    
+    def process_request(self, image_path: str, prompt: str,
+                        image: Optional[Union[np.ndarray, Image.Image, ImageContext]] = None) -> AssistantResponse:
+        """Process user request through appropriate agents
+        
+        image is an optional in-memory copy of the image (e.g. the UI editor buffer).
+        When given, agents work on it directly and image_path is only used to name
+        output files, so the input never has to be written to disk. Either way the
+        image is read, decoded and hashed once and shared by all agents. Passing an
+        ImageContext shares that work across several requests about the same image.
+        """
+        
+        try:
+            normalized = prompt.strip().lower()
+            shortcut = self._shortcut_response(normalized, image_path, image)
+            if shortcut is not None:
+                return shortcut
+            
+            ctx = ImageContext.create(image_path, image)
+            
+            # Repeated prompts on an unchanged image skip routing and the agents entirely
+            cache_key = (ctx.sha256, normalized)
+            cached = self._get_cached_response(cache_key)
+            if cached is not None:
+                self.logger.info(f"Returning cached response for action: {cached.action}")
+                return cached
+            
+            response = self._process_uncached(image_path, prompt, ctx)
+            self._cache_response(cache_key, response)
+            return response
+            
+        except Exception as e:
+            return self._error_response(e)
+    
+    async def process_request_async(self, image_path: str, prompt: str,
+                                    image: Optional[Union[np.ndarray, Image.Image, ImageContext]] = None,
+                                    on_text: Optional[Callable[[str], None]] = None) -> AssistantResponse:
+        """Async version of process_request
+        
+        Gemini calls are awaited instead of blocking, independent work inside a
+        request runs concurrently, and blocking file or model work is moved to
+        worker threads, so several requests can share one event loop.
+        
+        on_text receives the image description chunk by chunk while Gemini streams it,
+        for callers that show it as it arrives; the response still carries the full text.
+        Cached responses aren't streamed.
+        """
+        
+        try:
+            normalized = prompt.strip().lower()
+            shortcut = self._shortcut_response(normalized, image_path, image)
+            if shortcut is not None:
+                return shortcut
+            
+            ctx = ImageContext.create(image_path, image)
+            
+            # Hashing reads the whole file
+            cache_key = (await asyncio.to_thread(lambda: ctx.sha256), normalized)
+            cached = self._get_cached_response(cache_key)
+            if cached is not None:
+                self.logger.info(f"Returning cached response for action: {cached.action}")
+                return cached
+            
+            response = await self._process_uncached_async(image_path, prompt, ctx, on_text)
+            self._cache_response(cache_key, response)
+            return response
+            
+        except Exception as e:
+            return self._error_response(e)
+    
+    def process_batch(self, image_path: str, prompts: List[str],
+                      image: Optional[Union[np.ndarray, Image.Image]] = None) -> List[AssistantResponse]:
+        """Process several prompts about one image, returning responses in prompt order
+        
+        The image is read, decoded and hashed once and shared by every request, and
+        the requests run concurrently since each one mostly waits on model calls.
+        """
+        ctx = self._batch_context(image_path, image)
+        with ThreadPoolExecutor(max_workers=max(1, min(len(prompts), BATCH_MAX_WORKERS))) as pool:
+            return list(pool.map(lambda prompt: self.process_request(image_path, prompt, ctx), prompts))
+    
+    async def process_batch_async(self, image_path: str, prompts: List[str],
+                                  image: Optional[Union[np.ndarray, Image.Image]] = None) -> List[AssistantResponse]:
+        """Async version of process_batch; Gemini's request semaphore bounds concurrency"""
+        ctx = await asyncio.to_thread(self._batch_context, image_path, image)
+        return list(await asyncio.gather(*(self.process_request_async(image_path, prompt, ctx)
+                                           for prompt in prompts)))
+    
+    @classmethod
+    def _batch_context(cls, image_path: str,
+                       image: Optional[Union[np.ndarray, Image.Image]]) -> Optional[ImageContext]:
+        """The context a batch shares, loaded up front so concurrent requests don't race to load it"""
+        if image is None and not image_path:
+            return None
+        ctx = ImageContext.create(image_path, image)
+        ctx.sha256
+        cls._prefetch_image(ctx)
+        return ctx
+    
+    def _shortcut_response(self, normalized: str, image_path: str,
+                           image: Optional[Union[np.ndarray, Image.Image, ImageContext]]) -> Optional[AssistantResponse]:
+        """Fixed response for prompts that need no routing, else None"""
+        # Greetings need no model call at all
+        if not normalized or normalized.rstrip("!.") in _GREETINGS:
+            self.logger.info("Greeting short-circuit, skipping router")
+            return _GREETING_RESPONSE.model_copy(deep=True)
+        
+        # Edit requests can't be served without an image, so don't route them
+        if image is None and not image_path and _EDIT_KEYWORDS.search(normalized):
+            self.logger.info("Edit request without an image, skipping router")
+            return _NO_IMAGE_RESPONSE.model_copy(deep=True)
+        return None
+    
+    def _error_response(self, e: Exception) -> AssistantResponse:
+        self.logger.error(f"Request processing failed: {str(e)}")
+        error_response = ErrorResponse(error=f"Processing failed", details=str(e))
+        return AssistantResponse(action=ActionType.CLARIFY, error=error_response)
+    
+    def _process_uncached(self, image_path: str, prompt: str, ctx: ImageContext) -> AssistantResponse:
+        """Route the request and run the selected agent"""
         
         try:
             # Route request using structured output
@@ -44,97 +276,124 @@ class ImageEditingAssistant:
             
             if action == ActionType.ANSWER:
                 self.logger.info("Processing ANSWER action")
-                # Handle simple questions directly
-                if prompt.lower() in ["hi", "hello", "hey"]:
-                    return AssistantResponse(
-                        action=ActionType.ANSWER,
-                        clarify_data=ClarifyResponse(
-                            message="Hello! How can I help you with your image today?",
-                            suggested_prompts=[
-                                "Show me information about this image",
-                                "Increase the brightness of this image",
-                                "Remove the object in the center of the image"
-                            ]
-                        )
-                    )
-                else:
-                    return AssistantResponse(
-                        action=ActionType.ANSWER,
-                        clarify_data=ClarifyResponse(
-                            message=f"I'm an image editing assistant. {prompt.capitalize() if prompt.endswith('?') else 'Can you please provide an image-related request?'}",
-                            suggested_prompts=[
-                                "Show me information about this image",
-                                "Increase the brightness of this image",
-                                "Remove the object in the center of the image"
-                            ]
-                        )
-                    )
+                return self._answer_response(prompt)
             
             elif action == ActionType.INFO:
                 self.logger.info("Calling info agent")
-                info_data = self.info_agent.analyze_image(image_path, prompt)
-                response.info_data = info_data
+                response.info_data = self.info_agent.analyze_image(image_path, prompt, ctx)
                 self.logger.info("Info agent completed")
                 
             elif action == ActionType.GLOBAL_EDIT:
                 self.logger.info("Calling global edit agent")
-                edit_result = self.global_agent.edit_image(image_path, prompt)
-                if "error" in edit_result:
-                    self.logger.error(f"Global edit failed: {edit_result['error']}")
-                    response.error = ErrorResponse(error=edit_result["error"])
-                else:
-                    self.logger.info("Global edit completed")
-                    edit_data = EditResponse(
-                        edited_image_path=edit_result["edited_image_path"],
-                        edits_applied=edit_result["edits_applied"],
-                        message=edit_result["message"]
-                    )
-                    response.edit_data = edit_data
+                self._add_global_edit(response, self.global_agent.edit_image(image_path, prompt, ctx))
                 
             elif action == ActionType.LOCAL_EDIT:
                 self.logger.info("Calling local edit agent")
                 # Process local edit with object detection and inpainting
-                local_result = self.local_agent.process_local_edit(image_path, prompt)
+                self._add_local_edit(response, self.local_agent.process_local_edit(image_path, prompt, ctx))
+                    
+            elif action == ActionType.CLARIFY:
+                self.logger.info("Processing CLARIFY action")
+                response.clarify_data = _CLARIFY_DATA.model_copy(deep=True)
+            
+            return response
+            
+        except Exception as e:
+            return self._error_response(e)
+    
+    async def _process_uncached_async(self, image_path: str, prompt: str, ctx: ImageContext,
+                                      on_text: Optional[Callable[[str], None]] = None) -> AssistantResponse:
+        """Async version of _process_uncached"""
+        
+        try:
+            # Almost every routed action needs the pixels, so decode the file (already
+            # read for the cache key) while the router call is in flight
+            if ctx.raw_bytes is not None:
+                action, _ = await asyncio.gather(
+                    self.router.route_request_async(image_path, prompt),
+                    asyncio.to_thread(self._prefetch_image, ctx)
+                )
+            else:
+                action = await self.router.route_request_async(image_path, prompt)
+            self.logger.info(f"Action determined: {action}")
+            
+            response = AssistantResponse(action=action)
+            
+            if action == ActionType.ANSWER:
+                self.logger.info("Processing ANSWER action")
+                return self._answer_response(prompt)
+            
+            elif action == ActionType.INFO:
+                self.logger.info("Calling info agent")
+                response.info_data = await self.info_agent.analyze_image_async(image_path, prompt, ctx, on_text)
+                self.logger.info("Info agent completed")
                 
-                # Convert to proper response format - handle both dict and BoundingBox objects
-                detected_objects = []
-                for obj in local_result.get("detected_objects", []):
-                    if isinstance(obj, BoundingBox):
-                        detected_objects.append(obj)
-                    else:
-                        detected_objects.append(BoundingBox(**obj))
-
-                edited_regions = []
-                for obj in local_result.get("edited_regions", []):
-                    if isinstance(obj, BoundingBox):
-                        edited_regions.append(obj)
-                    else:
-                        edited_regions.append(BoundingBox(**obj))
+            elif action == ActionType.GLOBAL_EDIT:
+                self.logger.info("Calling global edit agent")
+                self._add_global_edit(response, await self.global_agent.edit_image_async(image_path, prompt, ctx))
                 
-                local_edit_data = LocalEditResponse(
-                    edited_image_path=local_result["edited_image_path"],
-                    detected_objects=detected_objects,
-                    edited_regions=edited_regions,
-                    message=local_result["message"]
-                )
-                response.edit_data = local_edit_data
-                self.logger.info("Local edit completed")
+            elif action == ActionType.LOCAL_EDIT:
+                self.logger.info("Calling local edit agent")
+                if hasattr(self.local_agent, "process_local_edit_async"):
+                    local_result = await self.local_agent.process_local_edit_async(image_path, prompt, ctx)
+                else:
+                    # Detection and diffusion run on the local models; keep them off the loop
+                    local_result = await asyncio.to_thread(self.local_agent.process_local_edit, image_path, prompt, ctx)
+                self._add_local_edit(response, local_result)
                     
             elif action == ActionType.CLARIFY:
                 self.logger.info("Processing CLARIFY action")
-                clarify_data = ClarifyResponse(
-                    message="Please provide more specific details about what you'd like to do with the image.",
-                    suggested_prompts=[
-                        "Show me information about this image",
-                        "Increase the brightness of this image",
-                        "Remove the object in the center of the image"
-                    ]
-                )
-                response.clarify_data = clarify_data
+                response.clarify_data = _CLARIFY_DATA.model_copy(deep=True)
             
             return response
             
         except Exception as e:
-            self.logger.error(f"Request processing failed: {str(e)}")
-            error_response = ErrorResponse(error=f"Processing failed", details=str(e))
-            return AssistantResponse(action=ActionType.CLARIFY, error=error_response)
\ No newline at end of file
+            return self._error_response(e)
+    
+    @staticmethod
+    def _prefetch_image(ctx: ImageContext) -> None:
+        try:
+            ctx.pil_image.load()
+        except Exception:
+            # Whichever agent needs the image reports the failure
+            pass
+    
+    @staticmethod
+    def _answer_response(prompt: str) -> AssistantResponse:
+        # Handle simple questions directly
+        if prompt.strip().lower() in _GREETINGS:
+            return _GREETING_RESPONSE.model_copy(deep=True)
+        return AssistantResponse(
+            action=ActionType.ANSWER,
+            clarify_data=ClarifyResponse(
+                message=f"I'm an image editing assistant. {prompt.capitalize() if prompt.endswith('?') else 'Can you please provide an image-related request?'}",
+                suggested_prompts=list(_DEFAULT_SUGGESTIONS)
+            )
+        )
+    
+    def _add_global_edit(self, response: AssistantResponse, edit_result: dict) -> None:
+        if "error" in edit_result:
+            self.logger.error(f"Global edit failed: {edit_result['error']}")
+            response.error = ErrorResponse(error=edit_result["error"])
+        else:
+            self.logger.info("Global edit completed")
+            response.edit_data = EditResponse(
+                edited_image_path=edit_result["edited_image_path"],
+                edits_applied=edit_result["edits_applied"],
+                message=edit_result["message"]
+            )
+    
+    def _add_local_edit(self, response: AssistantResponse, local_result: dict) -> None:
+        # Convert to proper response format - handle both dict and BoundingBox objects
+        detected = local_result.get("detected_objects")
+        detected_objects = _BOUNDING_BOXES.validate_python(detected) if detected else []
+        regions = local_result.get("edited_regions")
+        edited_regions = _BOUNDING_BOXES.validate_python(regions) if regions else []
+        
+        response.edit_data = LocalEditResponse(
+            edited_image_path=local_result["edited_image_path"],
+            detected_objects=detected_objects,
+            edited_regions=edited_regions,
+            message=local_result["message"]
+        )
+        self.logger.info("Local edit completed")
@@ -1,22 +1,54 @@
-import json
 import os
-from typing import List, Dict, Any
+import asyncio
+from typing import List, Optional, Tuple
 import numpy as np
 from PIL import Image
 from io import BytesIO
 from pydantic import BaseModel
-from model.gemini import generate, generate_with_schema
+from model.gemini import generate_with_schema, generate_with_schema_async, _pil_part
 from logic.models import BoundingBox
+from logic.image_context import ImageContext, OUTPUT_PNG_COMPRESS_LEVEL
+from logic.vision_cache import vision_cache, prompt_key
 from google import genai
 from google.genai import types
 
+# Default number of local edits in flight at once in process_local_edit_many
+MAX_CONCURRENT_EDITS = 10
+
+IMAGE_EDIT_MODEL = "gemini-2.0-flash-preview-image-generation"
+
+# Long edge of the image sent for detection; boxes come back as percentages, so
+# more pixels don't make them more precise
+DETECTION_MAX_DIM = 1024
+
+# Invariant detection instructions, sent as the system instruction so every detection
+# request shares the same prefix and Gemini's implicit prompt caching can reuse it.
+# Only the short editing request and the image vary per call.
+DETECTION_INSTRUCTIONS = """
+            Analyze the image and identify objects that are relevant to the user's editing request.
+
+            For each relevant object, provide a descriptive label, its bounding box (x1, y1, x2, y2)
+            as percentages of the image dimensions (0-100), and a confidence score (0-1).
+
+            Only include objects that are clearly relevant to the editing request.
+            """
+
+class DetectedObject(BaseModel):
+    """One detection, with the box in percent of the image size"""
+    label: str
+    x1: float
+    y1: float
+    x2: float
+    y2: float
+    confidence: float
+
 class DetectionResult(BaseModel):
     """Schema for object detection results from Gemini"""
-    objects: List[Dict[str, Any]]
+    objects: List[DetectedObject]
 
 class GeminiLocalEditAgent:
     """Handles object detection and local edits using Gemini API"""
-    
+
     def __init__(self, client=None):
         """Initialize the Gemini local edit agent"""
         try:
@@ -26,175 +58,367 @@ class GeminiLocalEditAgent:
         except Exception as e:
             print(f"Failed to initialize Gemini client: {e}")
             raise ValueError(f"Failed to initialize Gemini client: {e}")
-    
-    def process_local_edit(self, image_path: str, prompt: str) -> dict:
-        """Process local edit request with Gemini-based object detection and editing"""
+
+    def process_local_edit(self, image_path: str, prompt: str, ctx: Optional[ImageContext] = None) -> dict:
+        """Process local edit request with Gemini-based object detection and editing
+
+        ctx is the request's shared image context; image_path then only names the output file.
+        """
+        ctx = ctx or ImageContext.from_path(image_path)
         try:
             # Step 1: Detect objects and get bounding boxes
-            detected_objects = self._detect_objects_with_gemini(image_path, prompt)
-            
+            detected_objects = self._detect_objects_with_gemini(image_path, prompt, ctx)
+
             if not detected_objects:
-                return {
-                    "edited_image_path": image_path,
-                    "detected_objects": [],
-                    "edited_regions": [],
-                    "message": "No objects detected for local editing. Please be more specific about what you want to edit."
-                }
-            
+                return self._no_objects_result(image_path)
+
             # Step 2: Edit the image using Gemini's image generation
-            edited_path = self._edit_image_with_gemini(image_path, prompt, detected_objects)
-            
-            return {
-                "edited_image_path": edited_path,
-                "detected_objects": detected_objects,
-                "edited_regions": detected_objects,  # For now, assume all detected objects are edited
-                "message": f"Successfully processed local edit request: '{prompt}'"
-            }
-            
+            edited_path = self._edit_image_with_gemini(image_path, prompt, detected_objects, ctx)
+
+            return self._edit_result(image_path, prompt, edited_path, detected_objects)
+
         except Exception as e:
             print(f"Error in process_local_edit: {e}")
-            return {
-                "edited_image_path": image_path,
-                "detected_objects": [],
-                "edited_regions": [],
-                "message": f"Error processing local edit: {str(e)}"
-            }
-    
-    def _detect_objects_with_gemini(self, image_path: str, prompt: str) -> List[BoundingBox]:
+            return self._failed_result(image_path, e)
+
+    async def process_local_edit_async(self, image_path: str, prompt: str, ctx: Optional[ImageContext] = None) -> dict:
+        """Async version of process_local_edit; both Gemini calls are awaited instead of blocking"""
+        ctx = ctx or ImageContext.from_path(image_path)
+        try:
+            detected_objects = await self._detect_objects_with_gemini_async(image_path, prompt, ctx)
+
+            if not detected_objects:
+                return self._no_objects_result(image_path)
+
+            edited_path = await self._edit_image_with_gemini_async(image_path, prompt, detected_objects, ctx)
+
+            return self._edit_result(image_path, prompt, edited_path, detected_objects)
+
+        except Exception as e:
+            print(f"Error in process_local_edit_async: {e}")
+            return self._failed_result(image_path, e)
+
+    async def process_local_edit_many(self, requests: List[Tuple[str, str]],
+                                      max_concurrency: int = MAX_CONCURRENT_EDITS) -> List[dict]:
+        """Run many (image_path, prompt) local edits concurrently, at most max_concurrency at a time
+
+        Results are returned in request order.
+        """
+        semaphore = asyncio.Semaphore(max_concurrency)
+
+        async def run(image_path: str, prompt: str) -> dict:
+            async with semaphore:
+                return await self.process_local_edit_async(image_path, prompt)
+
+        return await asyncio.gather(*(run(image_path, prompt) for image_path, prompt in requests))
+
+    def process_local_edit_batch(self, requests: List[Tuple[str, str]], batch_edits: bool = False) -> List[dict]:
+        """Process many (image_path, prompt) local edits through Gemini batch prediction
+
+        Detection for every request is submitted as one batch job, which is slower per request
+        but far cheaper and higher-throughput than one online call each. Edits are run with
+        single calls by default since batch image generation can be lower quality; pass
+        batch_edits=True to submit them as a second batch job too. Results are in request order.
+        """
+        from model.gemini_batch import build_inline_request, run_batch
+
+        try:
+            contexts = [ImageContext.from_path(image_path) for image_path, _ in requests]
+
+            # Step 1: Detect objects for all requests in one batch job
+            detection_requests = [
+                build_inline_request(
+                    prompt=self._detection_prompt(prompt),
+                    image=ctx.gemini_image(DETECTION_MAX_DIM),
+                    system_instruction=DETECTION_INSTRUCTIONS,
+                    response_schema=DetectionResult,
+                    response_mime_type='application/json'
+                )
+                for (image_path, prompt), ctx in zip(requests, contexts)
+            ]
+            detection_responses = run_batch(detection_requests, display_name="local-edit-detection")
+
+            detections = []
+            for ctx, response in zip(contexts, detection_responses):
+                try:
+                    detections.append(self._parse_detections(response.text, ctx) if response else [])
+                except Exception as e:
+                    print(f"Error in object detection: {e}")
+                    detections.append([])
+
+            # Step 2: Edit every image that had detections
+            to_edit = [i for i, detected in enumerate(detections) if detected]
+            edited_paths = {}
+            if batch_edits and to_edit:
+                edit_requests = []
+                for i in to_edit:
+                    image_path, prompt = requests[i]
+                    editing_prompt, original_image = self._prepare_edit(prompt, detections[i], contexts[i])
+                    edit_requests.append(build_inline_request(
+                        prompt=editing_prompt,
+                        image=original_image,
+                        response_modalities=['TEXT', 'IMAGE'],
+                        model=IMAGE_EDIT_MODEL
+                    ))
+                edit_responses = run_batch(edit_requests, model=IMAGE_EDIT_MODEL, display_name="local-edit-generation")
+                for i, response in zip(to_edit, edit_responses):
+                    image_path = requests[i][0]
+                    try:
+                        edited_paths[i] = self._save_edited_image(response, image_path) if response else image_path
+                    except Exception as e:
+                        print(f"Error in image editing: {e}")
+                        edited_paths[i] = image_path
+            else:
+                for i in to_edit:
+                    image_path, prompt = requests[i]
+                    edited_paths[i] = self._edit_image_with_gemini(image_path, prompt, detections[i], contexts[i])
+
+            results = []
+            for i, (image_path, prompt) in enumerate(requests):
+                if i in edited_paths:
+                    results.append(self._edit_result(image_path, prompt, edited_paths[i], detections[i]))
+                else:
+                    results.append(self._no_objects_result(image_path))
+            return results
+
+        except Exception as e:
+            print(f"Error in process_local_edit_batch: {e}")
+            return [self._failed_result(image_path, e) for image_path, _ in requests]
+
+    def _no_objects_result(self, image_path: str) -> dict:
+        return {
+            "edited_image_path": image_path,
+            "detected_objects": [],
+            "edited_regions": [],
+            "message": "No objects detected for local editing. Please be more specific about what you want to edit."
+        }
+
+    def _edit_result(self, image_path: str, prompt: str, edited_path: str, detected_objects: List[BoundingBox]) -> dict:
+        return {
+            "edited_image_path": edited_path,
+            "detected_objects": detected_objects,
+            "edited_regions": detected_objects,  # For now, assume all detected objects are edited
+            "message": f"Successfully processed local edit request: '{prompt}'"
+        }
+
+    def _failed_result(self, image_path: str, error: Exception) -> dict:
+        return {
+            "edited_image_path": image_path,
+            "detected_objects": [],
+            "edited_regions": [],
+            "message": f"Error processing local edit: {str(error)}"
+        }
+
+    def _detection_prompt(self, prompt: str) -> str:
+        """Create the per-request part of the detection prompt (the rest is DETECTION_INSTRUCTIONS)"""
+        return f'Editing request: "{prompt}"'
+
+    def _parse_detections(self, response: str, ctx: ImageContext) -> List[BoundingBox]:
+        """Turn Gemini's percentage boxes into BoundingBox objects in pixel coordinates"""
+        # Structured output guarantees JSON matching the schema, so no fence stripping or guessing
+        detection_data = DetectionResult.model_validate_json(response)
+
+        # Image dimensions (header only, from the shared context)
+        img_width, img_height = ctx.size
+
+        objects = detection_data.objects
+        if not objects:
+            return []
+
+        # Convert percentage coordinates to absolute coordinates for all boxes at once
+        # (truncated towards zero like int())
+        scale = np.array([img_width, img_height, img_width, img_height], dtype=np.float64)
+        coords = np.array([[obj.x1, obj.y1, obj.x2, obj.y2] for obj in objects], dtype=np.float64)
+        coords = np.trunc(coords / 100.0 * scale)
+
+        # Ensure coordinates are within image bounds, with x2 >= x1 and y2 >= y1
+        np.clip(coords, 0, scale, out=coords)
+        np.maximum(coords[:, 2:], coords[:, :2], out=coords[:, 2:])
+
+        # Convert to BoundingBox objects with absolute coordinates
+        bounding_boxes = []
+        for obj, (x1, y1, x2, y2) in zip(objects, coords.astype(int).tolist()):
+            bbox = BoundingBox(
+                x1=x1,
+                y1=y1,
+                x2=x2,
+                y2=y2,
+                label=obj.label,
+                confidence=obj.confidence
+            )
+            bounding_boxes.append(bbox)
+            print(f"Detected {obj.label} with confidence {obj.confidence:.3f} at ({x1}, {y1}, {x2}, {y2})")
+
+        return bounding_boxes
+
+    def _cached_detections(self, prompt: str,
+                           ctx: ImageContext) -> Tuple[Optional[str], Optional[List[BoundingBox]]]:
+        """Look up detections for this image and prompt; returns (cache key, cached boxes or None)"""
+        image_key = ctx.sha256
+        if image_key is None:
+            return None, None
+        key = prompt_key(image_key, prompt)
+        cached = vision_cache.get(('detections', key))
+        if cached is not None:
+            print(f"Using cached detections ({len(cached)} objects)")
+            return key, list(cached)
+        return key, None
+
+    def _cache_detections(self, key: Optional[str], boxes: List[BoundingBox]) -> List[BoundingBox]:
+        """Remember non-empty detections (empty results may be transient failures)"""
+        if key is not None and boxes:
+            vision_cache.set(('detections', key), tuple(boxes))
+        return boxes
+
+    def _detect_objects_with_gemini(self, image_path: str, prompt: str, ctx: Optional[ImageContext] = None) -> List[BoundingBox]:
         """Use Gemini to detect objects in the image and return bounding boxes"""
+        ctx = ctx or ImageContext.from_path(image_path)
         try:
-            # Create a detection prompt
-            detection_prompt = f"""
-            Analyze this image and identify objects that are relevant to this editing request: "{prompt}"
-            
-            For each relevant object, provide:
-            1. A descriptive label
-            2. Bounding box coordinates (x1, y1, x2, y2) as percentages of image dimensions (0-100)
-            3. Confidence score (0-1)
-            
-            Return the results as a JSON object with this structure:
-            {{
-                "objects": [
-                    {{
-                        "label": "object_name",
-                        "x1": 10.5,
-                        "y1": 20.3,
-                        "x2": 45.7,
-                        "y2": 60.8,
-                        "confidence": 0.95
-                    }}
-                ]
-            }}
-            
-            Only include objects that are clearly relevant to the editing request.
-            """
-            
+            key, cached = self._cached_detections(prompt, ctx)
+            if cached is not None:
+                return cached
+
             # Call Gemini for object detection
-            response = generate(
-                prompt=detection_prompt,
-                image=image_path,
-                response_mime_type='application/json'
+            response = generate_with_schema(
+                prompt=self._detection_prompt(prompt),
+                image=ctx.gemini_image(DETECTION_MAX_DIM),
+                schema_class=DetectionResult,
+                system_instruction=DETECTION_INSTRUCTIONS,
+                # Parsed detections are cached in vision_cache; a second reply cache could disagree
+                no_cache=True
             )
-            
-            # Parse the response
-            detection_data = json.loads(response.strip())
-            
-            # Load image to get dimensions
-            with Image.open(image_path) as img:
-                img_width, img_height = img.size
-            
-            # Convert to BoundingBox objects with absolute coordinates
-            bounding_boxes = []
-            for obj in detection_data.get("objects", []):
-                # Convert percentage coordinates to absolute coordinates
-                x1 = int((obj["x1"] / 100.0) * img_width)
-                y1 = int((obj["y1"] / 100.0) * img_height)
-                x2 = int((obj["x2"] / 100.0) * img_width)
-                y2 = int((obj["y2"] / 100.0) * img_height)
-                
-                # Ensure coordinates are within image bounds
-                x1 = max(0, min(x1, img_width))
-                y1 = max(0, min(y1, img_height))
-                x2 = max(x1, min(x2, img_width))
-                y2 = max(y1, min(y2, img_height))
-                
-                bbox = BoundingBox(
-                    x1=x1,
-                    y1=y1,
-                    x2=x2,
-                    y2=y2,
-                    label=obj["label"],
-                    confidence=obj["confidence"]
-                )
-                bounding_boxes.append(bbox)
-                print(f"Detected {obj['label']} with confidence {obj['confidence']:.3f} at ({x1}, {y1}, {x2}, {y2})")
-            
-            return bounding_boxes
-            
+
+            return self._cache_detections(key, self._parse_detections(response, ctx))
+
         except Exception as e:
             print(f"Error in object detection: {e}")
             return []
-    
-    def _edit_image_with_gemini(self, image_path: str, prompt: str, detected_objects: List[BoundingBox]) -> str:
-        """Use Gemini's image generation to edit the image"""
+
+    async def _detect_objects_with_gemini_async(self, image_path: str, prompt: str,
+                                                ctx: Optional[ImageContext] = None) -> List[BoundingBox]:
+        """Async version of _detect_objects_with_gemini"""
+        ctx = ctx or ImageContext.from_path(image_path)
         try:
-            # Load the original image
-            with Image.open(image_path) as original_image:
-                original_image = original_image.convert('RGB')
-            
-            # Create editing prompt
-            object_descriptions = [obj.label for obj in detected_objects]
-            editing_prompt = f"""
+            key, cached = self._cached_detections(prompt, ctx)
+            if cached is not None:
+                return cached
+
+            response = await generate_with_schema_async(
+                prompt=self._detection_prompt(prompt),
+                image=ctx.gemini_image(DETECTION_MAX_DIM),
+                schema_class=DetectionResult,
+                system_instruction=DETECTION_INSTRUCTIONS,
+                # Parsed detections are cached in vision_cache; a second reply cache could disagree
+                no_cache=True
+            )
+
+            return self._cache_detections(key, self._parse_detections(response, ctx))
+
+        except Exception as e:
+            print(f"Error in object detection: {e}")
+            return []
+
+    def _prepare_edit(self, prompt: str, detected_objects: List[BoundingBox],
+                      ctx: ImageContext) -> Tuple[str, Image.Image]:
+        """Build the editing prompt and get the RGB image to send with it"""
+        # The SDK only reads the image, so an RGB input is sent without a copy
+        original_image = ctx.pil_image
+        if original_image.mode != 'RGB':
+            original_image = original_image.convert('RGB')
+
+        # Create editing prompt
+        object_descriptions = [obj.label for obj in detected_objects]
+        editing_prompt = f"""
             {prompt}
-            
+
             Focus on editing these detected objects: {', '.join(object_descriptions)}
-            
+
             Please edit the image according to the request while maintaining the overall composition and quality.
             Make sure the edits look natural and blend well with the rest of the image.
             """
-            
-            # Save original image temporarily for Gemini API
-            temp_path = image_path.replace('.', '_temp.')
-            original_image.save(temp_path)
-            
-            try:
-                # Call Gemini's image generation model
-                response = self.client.models.generate_content(
-                    model="gemini-2.0-flash-preview-image-generation",
-                    contents=[editing_prompt, original_image],
-                    config=types.GenerateContentConfig(
-                        response_modalities=['TEXT', 'IMAGE']
-                    )
+        return editing_prompt, original_image
+
+    def _prepare_edit_part(self, prompt: str, detected_objects: List[BoundingBox],
+                           ctx: ImageContext) -> Tuple[str, types.Part]:
+        """_prepare_edit with the image already encoded for the request"""
+        editing_prompt, original_image = self._prepare_edit(prompt, detected_objects, ctx)
+        return editing_prompt, _pil_part(original_image)
+
+    def _save_edited_image(self, response, image_path: str) -> str:
+        """Save the image part of a generation response next to image_path"""
+        # Extract the generated image
+        inline_data = None
+        for part in response.candidates[0].content.parts:
+            if part.inline_data is not None:
+                inline_data = part.inline_data
+                break
+
+        if inline_data is None:
+            print("No image generated by Gemini")
+            return image_path
+
+        # Save the edited image
+        base_name, ext = os.path.splitext(image_path)
+        output_path = f"{base_name}_gemini_edited{ext}"
+        if Image.MIME.get(Image.registered_extensions().get(ext.lower())) == inline_data.mime_type:
+            # Already encoded in the target format - write the bytes, no decode/re-encode
+            with open(output_path, 'wb') as f:
+                f.write(inline_data.data)
+        else:
+            edited_image = Image.open(BytesIO(inline_data.data))
+            edited_image.save(output_path, quality=95 if ext.lower() in ['.jpg', '.jpeg'] else None,
+                              compress_level=OUTPUT_PNG_COMPRESS_LEVEL)
+        print(f"Saved Gemini-edited image to {output_path}")
+
+        return output_path
+
+    def _edit_image_with_gemini(self, image_path: str, prompt: str, detected_objects: List[BoundingBox],
+                                ctx: Optional[ImageContext] = None) -> str:
+        """Use Gemini's image generation to edit the image"""
+        ctx = ctx or ImageContext.from_path(image_path)
+        try:
+            editing_prompt, original_image = self._prepare_edit(prompt, detected_objects, ctx)
+
+            # Call Gemini's image generation model (the PIL image is sent directly, no temp file)
+            response = self.client.models.generate_content(
+                model=IMAGE_EDIT_MODEL,
+                contents=[editing_prompt, original_image],
+                config=types.GenerateContentConfig(
+                    response_modalities=['TEXT', 'IMAGE']
+                )
+            )
+
+            return self._save_edited_image(response, image_path)
+
+        except Exception as e:
+            print(f"Error in image editing: {e}")
+            return image_path
+
+    async def _edit_image_with_gemini_async(self, image_path: str, prompt: str, detected_objects: List[BoundingBox],
+                                            ctx: Optional[ImageContext] = None) -> str:
+        """Async version of _edit_image_with_gemini"""
+        ctx = ctx or ImageContext.from_path(image_path)
+        try:
+            # Decoding and PNG-encoding the image is CPU work the SDK would otherwise
+            # do on the event loop; build the Part in a worker thread, as generate_async does
+            editing_prompt, image_part = await asyncio.to_thread(
+                self._prepare_edit_part, prompt, detected_objects, ctx)
+
+            response = await self.client.aio.models.generate_content(
+                model=IMAGE_EDIT_MODEL,
+                contents=[editing_prompt, image_part],
+                config=types.GenerateContentConfig(
+                    response_modalities=['TEXT', 'IMAGE']
                 )
-                
-                # Extract the generated image
-                edited_image = None
-                for part in response.candidates[0].content.parts:
-                    if part.inline_data is not None:
-                        edited_image = Image.open(BytesIO(part.inline_data.data))
-                        break
-                
-                if edited_image is None:
-                    print("No image generated by Gemini")
-                    return image_path
-                
-                # Save the edited image
-                base_name, ext = os.path.splitext(image_path)
-                output_path = f"{base_name}_gemini_edited{ext}"
-                edited_image.save(output_path, quality=95 if ext.lower() in ['.jpg', '.jpeg'] else None)
-                print(f"Saved Gemini-edited image to {output_path}")
-                
-                return output_path
-                
-            finally:
-                # Clean up temporary file
-                if os.path.exists(temp_path):
-                    os.remove(temp_path)
-            
+            )
+
+            # Decoding and saving is local CPU/disk work; keep it off the event loop
+            return await asyncio.to_thread(self._save_edited_image, response, image_path)
+
         except Exception as e:
             print(f"Error in image editing: {e}")
             return image_path
-    
+
     def detect_and_edit(self, image_path: str, prompt: str) -> str:
         """Combined function for object detection and editing (for compatibility)"""
         result = self.process_local_edit(image_path, prompt)
@@ -1,8 +1,17 @@
 import os
+import asyncio
+from io import BytesIO
+from typing import Optional
 import numpy as np
-from PIL import Image, ImageEnhance
+from PIL import Image, ImageStat
 from pydantic import BaseModel
-from model.gemini import generate_with_schema
+from model.gemini import generate_with_schema, generate_with_schema_async
+from logic.image_context import ImageContext, OUTPUT_PNG_COMPRESS_LEVEL
+
+try:
+    from numba import njit, prange
+except ImportError:  # numba is optional; saturation then runs as NumPy array passes
+    njit = None
 
 class EditParameters(BaseModel):
     brightness: int = 0  # -100 to 100
@@ -10,6 +19,35 @@ class EditParameters(BaseModel):
     saturation: int = 0  # -100 to 100
     temperature: str = "neutral"  # cold/neutral/warm
 
+# Output file name parts: (parameter, name when lowered, name when raised)
+TASK_NAME_PARTS = (
+    ("brightness", "darker", "brighter"),
+    ("contrast", "lowcontrast", "highcontrast"),
+    ("saturation", "desaturated", "vibrant"),
+)
+TEMPERATURE_TASK_NAMES = {"warm": "warm", "cold": "cool"}
+
+if njit is not None:
+    @njit(parallel=True, cache=True)
+    def _saturation_kernel(data, factor):
+        """Single-pass, row-parallel version of the NumPy saturation blend (same float32 steps, same result)"""
+        height, width = data.shape[0], data.shape[1]
+        out = np.empty_like(data)
+        for y in prange(height):
+            for x in range(width):
+                grey = np.float32((np.uint32(data[y, x, 0]) * np.uint32(19595)
+                                   + np.uint32(data[y, x, 1]) * np.uint32(38470)
+                                   + np.uint32(data[y, x, 2]) * np.uint32(7471)
+                                   + np.uint32(0x8000)) >> 16)
+                for c in range(3):
+                    value = (np.float32(data[y, x, c]) - grey) * factor + grey
+                    out[y, x, c] = np.uint8(min(max(value, np.float32(0)), np.float32(255)))
+        return out
+else:
+    _saturation_kernel = None
+
+EDIT_PARAMETER_INSTRUCTIONS = "You are an image editing parameter analyzer. Always respond with valid JSON containing the editing parameters."
+
 class GlobalEditAgent:
     """Handles global image adjustments"""
     
@@ -17,11 +55,52 @@ class GlobalEditAgent:
         # Client is not needed since we use the generate functions
         pass
     
-    def edit_image(self, image_path: str, prompt: str) -> dict:
-        """Apply global edits based on prompt"""
+    def warmup(self) -> None:
+        """Compile (or load from numba's cache) the saturation kernel on a tiny image"""
+        if _saturation_kernel is not None:
+            self._adjust_saturation(Image.new('RGB', (2, 2)), 1.5)
+    
+    def edit_image(self, image_path: str, prompt: str, ctx: Optional[ImageContext] = None,
+                   return_bytes: bool = False, write_file: bool = True) -> dict:
+        """Apply global edits based on prompt
+        
+        ctx is the request's shared image context; image_path then only names the output file.
+        With return_bytes the encoded result is also returned as a BytesIO under "edited_bytes",
+        for callers that serve it directly; write_file=False then skips the disk write
+        entirely and "edited_image_path" is None.
+        """
+        ctx = ctx or ImageContext.from_path(image_path)
         
         # Parse editing intent using structured output
-        edit_prompt = f"""
+        try:
+            response = generate_with_schema(
+                prompt=self._edit_prompt(prompt),
+                schema_class=EditParameters,
+                system_instruction=EDIT_PARAMETER_INSTRUCTIONS
+            )
+        except Exception as e:
+            return self._failed_result(image_path, f"Failed to determine editing parameters: {str(e)}")
+        return self._apply_edits(image_path, self._parse_params(response), ctx, return_bytes, write_file)
+    
+    async def edit_image_async(self, image_path: str, prompt: str, ctx: Optional[ImageContext] = None,
+                               return_bytes: bool = False, write_file: bool = True) -> dict:
+        """Async version of edit_image; the pixel work runs on a worker thread"""
+        ctx = ctx or ImageContext.from_path(image_path)
+        
+        try:
+            response = await generate_with_schema_async(
+                prompt=self._edit_prompt(prompt),
+                schema_class=EditParameters,
+                system_instruction=EDIT_PARAMETER_INSTRUCTIONS
+            )
+        except Exception as e:
+            return self._failed_result(image_path, f"Failed to determine editing parameters: {str(e)}")
+        return await asyncio.to_thread(
+            self._apply_edits, image_path, self._parse_params(response), ctx, return_bytes, write_file)
+    
+    @staticmethod
+    def _edit_prompt(prompt: str) -> str:
+        return f"""
         Based on this request: "{prompt}"
         
         Determine the editing parameters:
@@ -37,25 +116,22 @@ class GlobalEditAgent:
         - "warmer tone" -> temperature: "warm"
         - "make it darker and cooler" -> brightness: -30, temperature: "cold"
         """
-        
+    
+    @staticmethod
+    def _parse_params(response: str) -> dict:
         try:
-            response = generate_with_schema(
-                prompt=edit_prompt,
-                schema_class=EditParameters,
-                system_instruction="You are an image editing parameter analyzer. Always respond with valid JSON containing the editing parameters."
-            )
-            
-            params = EditParameters.model_validate_json(response)
-            params_dict = params.model_dump()
-            
+            return EditParameters.model_validate_json(response).model_dump()
         except Exception as e:
             print(f"Parameter parsing error: {e}")
             # Default safe parameters
-            params_dict = {"brightness": 0, "contrast": 0, "saturation": 0, "temperature": "neutral"}
-        
+            return {"brightness": 0, "contrast": 0, "saturation": 0, "temperature": "neutral"}
+    
+    def _apply_edits(self, image_path: str, params_dict: dict, ctx: ImageContext,
+                     return_bytes: bool, write_file: bool) -> dict:
+        """Apply parsed edit parameters to the context's image and save the result"""
         try:
             # Apply edits
-            img = Image.open(image_path)
+            img = ctx.pil_image
             original_mode = img.mode
             
             # Convert to RGB for processing if needed
@@ -64,38 +140,46 @@ class GlobalEditAgent:
             
             edits_applied = []
             
+            # Brightness and contrast are folded into one 256-entry tone LUT; temperature is
+            # folded in too when no saturation pass sits between them. Each LUT is built by
+            # running the same ImageEnhance blend on a 0..255 ramp, so values match exactly.
+            tone_lut = np.arange(256, dtype=np.uint8)
+            
             # Brightness
             if params_dict.get("brightness", 0) != 0:
-                enhancer = ImageEnhance.Brightness(img)
                 factor = 1 + (params_dict["brightness"] / 100)
                 factor = max(0.1, min(3.0, factor))  # Clamp to reasonable range
-                img = enhancer.enhance(factor)
+                tone_lut = self._blend_lut(tone_lut, 0, factor)
                 edits_applied.append(f"brightness {'+' if params_dict['brightness'] > 0 else ''}{params_dict['brightness']}")
             
-            # Contrast
+            # Contrast (around the mean luminance of the brightened image, as ImageEnhance.Contrast)
             if params_dict.get("contrast", 0) != 0:
-                enhancer = ImageEnhance.Contrast(img)
                 factor = 1 + (params_dict["contrast"] / 100)
                 factor = max(0.1, min(3.0, factor))  # Clamp to reasonable range
-                img = enhancer.enhance(factor)
+                tone_lut = self._blend_lut(tone_lut, self._mean_luminance(img, tone_lut), factor)
                 edits_applied.append(f"contrast {'+' if params_dict['contrast'] > 0 else ''}{params_dict['contrast']}")
             
-            # Saturation
+            # Saturation mixes channels, so the pending tone LUT is applied before it
             if params_dict.get("saturation", 0) != 0:
-                enhancer = ImageEnhance.Color(img)
                 factor = 1 + (params_dict["saturation"] / 100)
                 factor = max(0.0, min(3.0, factor))  # Clamp to reasonable range
-                img = enhancer.enhance(factor)
+                img = self._adjust_saturation(img.point(tone_lut.tolist() * 3), factor)
+                tone_lut = np.arange(256, dtype=np.uint8)
                 edits_applied.append(f"saturation {'+' if params_dict['saturation'] > 0 else ''}{params_dict['saturation']}")
             
             # Temperature adjustment
+            red_lut = blue_lut = tone_lut
             if params_dict.get("temperature") == "warm":
-                img = self._adjust_temperature(img, 1.1, 0.9)
+                red_lut, blue_lut = self._temperature_luts(tone_lut, 1.1, 0.9)
                 edits_applied.append("warmer temperature")
             elif params_dict.get("temperature") == "cold":
-                img = self._adjust_temperature(img, 0.9, 1.1)
+                red_lut, blue_lut = self._temperature_luts(tone_lut, 0.9, 1.1)
                 edits_applied.append("cooler temperature")
             
+            # One per-channel lookup applies everything still pending
+            if red_lut is not tone_lut or not self._is_identity(tone_lut):
+                img = img.point(red_lut.tolist() + tone_lut.tolist() + blue_lut.tolist())
+            
             # Convert back to original mode if needed
             if original_mode != 'RGB' and original_mode in ['L', 'P', 'RGBA']:
                 if original_mode == 'L':
@@ -111,55 +195,104 @@ class GlobalEditAgent:
             # Save edited image with task name
             base_name, ext = os.path.splitext(image_path)
             output_path = f"{base_name}_{task_name}{ext}"
-            img.save(output_path, quality=95 if ext.lower() in ['.jpg', '.jpeg'] else None)
+            quality = 95 if ext.lower() in ['.jpg', '.jpeg'] else None
             
-            return {
+            result = {
                 "edited_image_path": output_path,
                 "edits_applied": edits_applied,
                 "message": f"Applied global edits: {', '.join(edits_applied) if edits_applied else 'no changes needed'}"
             }
             
+            if return_bytes:
+                # Encode once in memory; the file (if wanted) gets the same bytes
+                buf = BytesIO()
+                img.save(buf, format=Image.registered_extensions().get(ext.lower(), 'PNG'), quality=quality,
+                         compress_level=OUTPUT_PNG_COMPRESS_LEVEL)
+                if write_file:
+                    with open(output_path, 'wb') as f:
+                        f.write(buf.getbuffer())
+                else:
+                    result["edited_image_path"] = None
+                buf.seek(0)
+                result["edited_bytes"] = buf
+            else:
+                img.save(output_path, quality=quality, compress_level=OUTPUT_PNG_COMPRESS_LEVEL)
+            
+            return result
+            
         except Exception as e:
-            return {
-                "error": f"Failed to apply edits: {str(e)}",
-                "edited_image_path": image_path,
-                "edits_applied": [],
-                "message": "Global edit failed"
-            }
+            return self._failed_result(image_path, f"Failed to apply edits: {str(e)}")
     
-    def _adjust_temperature(self, img: Image.Image, red_factor: float, blue_factor: float) -> Image.Image:
-        """Adjust color temperature"""
-        if img.mode != 'RGB':
-            img = img.convert('RGB')
-        
-        data = np.array(img)
-        data[:, :, 0] = np.clip(data[:, :, 0] * red_factor, 0, 255)  # Red
-        data[:, :, 2] = np.clip(data[:, :, 2] * blue_factor, 0, 255)  # Blue
-        
-        return Image.fromarray(data.astype(np.uint8))
+    @staticmethod
+    def _failed_result(image_path: str, error: str) -> dict:
+        return {
+            "error": error,
+            "edited_image_path": image_path,
+            "edits_applied": [],
+            "message": "Global edit failed"
+        }
+    
+    @staticmethod
+    def _is_identity(lut: np.ndarray) -> bool:
+        return bool((lut == np.arange(256)).all())
+    
+    @staticmethod
+    def _blend_lut(lut: np.ndarray, degenerate: int, factor: float) -> np.ndarray:
+        """Compose lut with an ImageEnhance blend towards a flat degenerate value"""
+        ramp = Image.frombytes('L', (256, 1), lut.tobytes())
+        flat = Image.new('L', (256, 1), degenerate)
+        return np.frombuffer(Image.blend(flat, ramp, factor).tobytes(), dtype=np.uint8)
+    
+    @staticmethod
+    def _mean_luminance(img: Image.Image, lut: np.ndarray) -> int:
+        """Rounded mean of L for img after lut, the pivot ImageEnhance.Contrast uses"""
+        if not GlobalEditAgent._is_identity(lut):
+            img = img.point(lut.tolist() * 3)
+        return int(ImageStat.Stat(img.convert('L')).mean[0] + 0.5)
+    
+    @staticmethod
+    def _adjust_saturation(img: Image.Image, factor: float) -> Image.Image:
+        """Blend each pixel with its own grey value in one vectorised pass (ImageEnhance.Color)"""
+        if _saturation_kernel is not None:
+            return Image.fromarray(_saturation_kernel(np.asarray(img), np.float32(factor)))
+        # Planar channels (split by Pillow's C code) keep every array pass contiguous
+        # instead of striding over interleaved RGB
+        red, green, blue = (np.asarray(band) for band in img.split())
+        # Same fixed-point weights Pillow uses for RGB -> L
+        grey = red * np.uint32(19595)
+        grey += green * np.uint32(38470)
+        grey += blue * np.uint32(7471)
+        grey += np.uint32(0x8000)
+        grey >>= 16
+        grey = grey.astype(np.float32)
+        bands = []
+        for channel in (red, green, blue):
+            # One float32 buffer per channel, updated in place
+            out = channel.astype(np.float32)
+            out -= grey
+            out *= np.float32(factor)
+            out += grey
+            np.clip(out, 0, 255, out=out)
+            bands.append(Image.fromarray(out.astype(np.uint8)))
+        return Image.merge('RGB', bands)
+    
+    @staticmethod
+    def _temperature_luts(lut: np.ndarray, red_factor: float, blue_factor: float):
+        """Red and blue channel LUTs for a colour temperature shift applied after lut"""
+        red = np.clip(lut * red_factor, 0, 255).astype(np.uint8)
+        blue = np.clip(lut * blue_factor, 0, 255).astype(np.uint8)
+        return red, blue
     
     def _create_task_name(self, params: dict) -> str:
         """Create descriptive task name based on edit parameters"""
         task_parts = []
+        for param, lower, higher in TASK_NAME_PARTS:
+            value = params.get(param, 0)
+            if value:
+                task_parts.append(higher if value > 0 else lower)
         
-        if params.get("brightness", 0) > 0:
-            task_parts.append("brighter")
-        elif params.get("brightness", 0) < 0:
-            task_parts.append("darker")
-            
-        if params.get("contrast", 0) > 0:
-            task_parts.append("highcontrast")
-        elif params.get("contrast", 0) < 0:
-            task_parts.append("lowcontrast")
-            
-        if params.get("saturation", 0) > 0:
-            task_parts.append("vibrant")
-        elif params.get("saturation", 0) < 0:
-            task_parts.append("desaturated")
-            
-        if params.get("temperature") == "warm":
-            task_parts.append("warm")
-        elif params.get("temperature") == "cold":
-            task_parts.append("cool")
+        temperature = TEMPERATURE_TASK_NAMES.get(params.get("temperature"))
+        if temperature:
+            task_parts.append(temperature)
         
         return "_".join(task_parts) if task_parts else "global_edit"
\ No newline at end of file
@@ -0,0 +1,169 @@
+import os
+import mimetypes
+from dataclasses import dataclass, field
+from io import BytesIO
+from typing import Dict, Optional, Union
+import numpy as np
+from PIL import Image
+from google.genai import types
+from logic.vision_cache import image_hash
+
+try:
+    from turbojpeg import TurboJPEG, TJPF_RGB, TJCS_YCbCr
+except ImportError:  # PyTurboJPEG is optional; Pillow decodes JPEGs without it
+    TurboJPEG = None
+
+DOWNSCALE_JPEG_QUALITY = 85
+# zlib level for edited PNGs. Encoding, not the disk write, is what makes saves slow;
+# level 1 is several times faster than Pillow's default of 6 for slightly larger files
+OUTPUT_PNG_COMPRESS_LEVEL = 1
+
+_turbojpeg = None
+
+def _turbo_decoder():
+    """Shared TurboJPEG handle (decodes and encodes), or None when PyTurboJPEG or libturbojpeg is missing"""
+    global _turbojpeg
+    if _turbojpeg is None and TurboJPEG is not None:
+        try:
+            _turbojpeg = TurboJPEG()
+        except (OSError, RuntimeError):  # the shared library could not be found
+            _turbojpeg = False
+    return _turbojpeg or None
+
+def encode_jpeg(rgb: np.ndarray, quality: int) -> Optional[bytes]:
+    """Encode an RGB uint8 array as JPEG with TurboJPEG; None when it isn't available"""
+    encoder = _turbo_decoder()
+    if encoder is None:
+        return None
+    return encoder.encode(np.ascontiguousarray(rgb), quality=quality, pixel_format=TJPF_RGB)
+
+def _decode_jpeg_rgb(data: bytes) -> Optional[np.ndarray]:
+    """Decode colour JPEG bytes straight to an RGB array with TurboJPEG, else None"""
+    decoder = _turbo_decoder()
+    if decoder is None or not data.startswith(b'\xff\xd8'):
+        return None
+    try:
+        # Greyscale and CMYK files keep going through Pillow so their mode is preserved
+        if decoder.decode_header(data)[3] != TJCS_YCbCr:
+            return None
+        return decoder.decode(data, pixel_format=TJPF_RGB)
+    except (OSError, ValueError):
+        return None
+
+@dataclass
+class ImageContext:
+    """The image behind one request, read, decoded and hashed at most once
+
+    Built once per request and handed to every agent. Everything is loaded lazily,
+    so requests that never look at the pixels don't read the file at all. When the
+    context wraps an in-memory image (e.g. the UI editor buffer), that image is the
+    source of truth and path only names output files.
+    """
+    path: Optional[str] = None
+    _raw_bytes: Optional[bytes] = field(default=None, repr=False)
+    _pil_image: Optional[Image.Image] = field(default=None, repr=False)
+    _rgb: Optional[np.ndarray] = field(default=None, repr=False)
+    _sha256: Optional[str] = field(default=None, repr=False)
+    _downscaled: Dict[int, types.Part] = field(default_factory=dict, repr=False)
+
+    @classmethod
+    def from_path(cls, path: Optional[str]) -> "ImageContext":
+        return cls(path=path)
+
+    @classmethod
+    def from_image(cls, image: Union[np.ndarray, Image.Image], path: Optional[str] = None) -> "ImageContext":
+        if isinstance(image, np.ndarray):
+            rgb = image if image.dtype == np.uint8 and image.ndim == 3 and image.shape[2] == 3 else None
+            return cls(path=path, _pil_image=Image.fromarray(image), _rgb=rgb)
+        return cls(path=path, _pil_image=image)
+
+    @classmethod
+    def create(cls, path: Optional[str],
+               image: Optional[Union[np.ndarray, Image.Image, "ImageContext"]] = None) -> "ImageContext":
+        """Context for an agent entry point's (image_path, image) arguments
+
+        An existing context is passed through, so callers sending several requests
+        about one image can load it once and share it.
+        """
+        if isinstance(image, ImageContext):
+            return image
+        return cls.from_path(path) if image is None else cls.from_image(image, path)
+
+    @property
+    def raw_bytes(self) -> Optional[bytes]:
+        """Encoded file bytes, or None for an in-memory image"""
+        if self._raw_bytes is None and self._pil_image is None and self.path and os.path.isfile(self.path):
+            with open(self.path, 'rb') as f:
+                self._raw_bytes = f.read()
+        return self._raw_bytes
+
+    @property
+    def pil_image(self) -> Image.Image:
+        if self._pil_image is None:
+            data = self.raw_bytes
+            if data is None:
+                raise FileNotFoundError(f"Image file not found: {self.path}")
+            rgb = _decode_jpeg_rgb(data)
+            if rgb is None:
+                self._pil_image = Image.open(BytesIO(data))
+            else:
+                # Same pixels Pillow would produce, decoded once and shared as the RGB view
+                rgb.setflags(write=False)
+                self._rgb = rgb
+                self._pil_image = Image.fromarray(rgb)
+                self._pil_image.format = 'JPEG'
+        return self._pil_image
+
+    @property
+    def np_array_rgb_uint8(self) -> np.ndarray:
+        """Read-only RGB view of the image"""
+        if self._rgb is None:
+            img = self.pil_image
+            self._rgb = np.asarray(img if img.mode == 'RGB' else img.convert('RGB'))
+        return self._rgb
+
+    @property
+    def sha256(self) -> Optional[str]:
+        """Content hash shared by the response and vision caches; None without an image"""
+        if self._sha256 is None:
+            data = self.raw_bytes
+            self._sha256 = image_hash(image=self._pil_image if data is None else None, data=data)
+        return self._sha256
+
+    @property
+    def size(self):
+        return self.pil_image.size
+
+    def gemini_image(self, max_dim: Optional[int] = None) -> Union[types.Part, Image.Image]:
+        """What to send to Gemini: the original file bytes when there are any, else the PIL image
+
+        With max_dim, images whose long edge exceeds it are sent as a downscaled JPEG
+        instead (built once per context and size).
+        """
+        if max_dim is not None and max(self.size) > max_dim:
+            part = self._downscaled.get(max_dim)
+            if part is None:
+                part = self._downscaled[max_dim] = self._downscaled_part(max_dim)
+            return part
+        data = self.raw_bytes
+        if data is None:
+            return self.pil_image
+        mime_type = Image.MIME.get(self.pil_image.format) or mimetypes.guess_type(self.path)[0] or 'image/jpeg'
+        return types.Part.from_bytes(data=data, mime_type=mime_type)
+
+    def _downscaled_part(self, max_dim: int) -> types.Part:
+        data = self.raw_bytes
+        if data is not None:
+            # Separate decoder so the shared full-size image is left alone; for JPEG,
+            # draft() lets the decoder skip most of the pixels
+            img = Image.open(BytesIO(data))
+            img.draft('RGB', (max_dim, max_dim))
+        else:
+            img = self.pil_image
+        if img.mode != 'RGB':
+            img = img.convert('RGB')
+        scale = max_dim / max(img.size)
+        size = (max(1, round(img.width * scale)), max(1, round(img.height * scale)))
+        buffer = BytesIO()
+        img.resize(size, Image.LANCZOS, reducing_gap=3.0).save(buffer, format='JPEG', quality=DOWNSCALE_JPEG_QUALITY)
+        return types.Part.from_bytes(data=buffer.getvalue(), mime_type='image/jpeg')
@@ -1,8 +1,20 @@
+import asyncio
 import logging
-from typing import List
-from PIL import Image, ImageStat
-from model.gemini import generate
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, List, Optional
+import numpy as np
+from PIL import Image
+from model.gemini import generate, generate_async, generate_stream_async
 from logic.models import InfoResponse, ImageMetadata, HistogramData
+from logic.image_context import ImageContext
+from logic.vision_cache import vision_cache
+
+# Upper bound on k-means refinement steps for the dominant colour palette
+KMEANS_ITERATIONS = 10
+# Long edge of the thumbnail the palette is computed from
+THUMBNAIL_SIZE = 100
+
+ANALYSIS_INSTRUCTIONS = "You are an expert image analyst. Provide concise, accurate descriptions in exactly one paragraph. Be direct and informative without unnecessary elaboration."
 
 class ImageInfoAgent:
     """Provides detailed information about images"""
@@ -13,31 +25,77 @@ class ImageInfoAgent:
         # Client is not needed since we use the generate functions
         pass
     
-    def analyze_image(self, image_path: str, prompt: str) -> InfoResponse:
-        """Extract comprehensive image information"""
+    def analyze_image(self, image_path: str, prompt: str, ctx: Optional[ImageContext] = None) -> InfoResponse:
+        """Extract comprehensive image information
+        
+        ctx is the request's shared image context; without one, image_path is read.
+        """
+        ctx = ctx or ImageContext.from_path(image_path)
         
         try:
-            # Load image for technical analysis
-            img = Image.open(image_path)
+            # The Gemini call is network-bound and independent of the local stats, so it
+            # runs on a worker thread while the stats are computed here. The context
+            # reads the file once; the same bytes are sent to Gemini as-is
+            self.logger.info("Calling Gemini for image analysis")
+            with ThreadPoolExecutor(max_workers=1) as pool:
+                description_future = pool.submit(
+                    generate,
+                    prompt=self._analysis_prompt(prompt),
+                    image=ctx.gemini_image(),
+                    system_instruction=ANALYSIS_INSTRUCTIONS
+                )
+                
+                stats = self._image_stats(ctx)
+                description = description_future.result()
             
-            # Calculate histogram data
-            histogram_data = self._calculate_histogram(img)
+            return self._info_response(stats, description)
             
-            # Extract dominant colors
-            dominant_colors = self._extract_dominant_colors(img)
+        except Exception as e:
+            return self._fallback_info(ctx, e)
+    
+    async def analyze_image_async(self, image_path: str, prompt: str, ctx: Optional[ImageContext] = None,
+                                  on_text: Optional[Callable[[str], None]] = None) -> InfoResponse:
+        """Async version of analyze_image; the description and the local stats run concurrently
+        
+        With on_text, the description is streamed and each chunk is passed to it as it arrives.
+        """
+        ctx = ctx or ImageContext.from_path(image_path)
+        
+        try:
+            self.logger.info("Calling Gemini for image analysis")
+            # Reading the file is blocking I/O; once the context holds it, the stats
+            # thread and the Gemini call share it without racing to load it
+            image = await asyncio.to_thread(ctx.gemini_image)
+            if on_text is None:
+                description = generate_async(
+                    prompt=self._analysis_prompt(prompt),
+                    image=image,
+                    system_instruction=ANALYSIS_INSTRUCTIONS
+                )
+            else:
+                description = self._stream_description(prompt, image, on_text)
+            stats, description = await asyncio.gather(asyncio.to_thread(self._image_stats, ctx), description)
             
-            # Create metadata object
-            metadata = ImageMetadata(
-                width=img.width,
-                height=img.height,
-                format=img.format or "unknown",
-                color_space=img.mode,
-                channels=len(img.getbands()),
-                bit_depth=8  # Assuming standard 8-bit depth, could be calculated more precisely
-            )
+            return self._info_response(stats, description)
             
-            # Use Gemini for content analysis with optimized prompt for concise response
-            analysis_prompt = f"""
+        except Exception as e:
+            return self._fallback_info(ctx, e)
+    
+    async def _stream_description(self, prompt: str, image, on_text: Callable[[str], None]) -> str:
+        chunks = []
+        async for text in generate_stream_async(
+            prompt=self._analysis_prompt(prompt),
+            image=image,
+            system_instruction=ANALYSIS_INSTRUCTIONS
+        ):
+            on_text(text)
+            chunks.append(text)
+        return "".join(chunks)
+    
+    @staticmethod
+    def _analysis_prompt(prompt: str) -> str:
+        # Optimized prompt for a concise response
+        return f"""
             Analyze this image and provide a concise, accurate description in ONE paragraph only.
             
             Focus on: main subjects, scene context, lighting/mood, and key visual elements.
@@ -45,119 +103,179 @@ class ImageInfoAgent:
             
             Keep response under 150 words and directly address the user's specific question while covering essential image details.
             """
-            
-            self.logger.info("Calling Gemini for image analysis")
-            description = generate(
-                prompt=analysis_prompt,
-                image=image_path,
-                system_instruction="You are an expert image analyst. Provide concise, accurate descriptions in exactly one paragraph. Be direct and informative without unnecessary elaboration."
+    
+    def _info_response(self, stats, description: str) -> InfoResponse:
+        metadata, histogram_data, dominant_colors = stats
+        self.logger.info("Image analysis completed")
+        
+        # Return structured InfoResponse
+        return InfoResponse(
+            metadata=metadata.model_copy(),
+            histogram=histogram_data.model_copy(deep=True),
+            dominant_colors=list(dominant_colors),
+            description=description.strip()
+        )
+    
+    def _fallback_info(self, ctx: ImageContext, e: Exception) -> InfoResponse:
+        """Basic info when analysis fails"""
+        self.logger.error(f"Image analysis failed: {str(e)}", exc_info=True)
+        try:
+            img = ctx.pil_image
+            metadata = ImageMetadata(
+                width=img.width,
+                height=img.height,
+                format=img.format or "unknown",
+                color_space=img.mode,
+                channels=len(img.getbands()),
+                bit_depth=8
             )
-            
-            self.logger.info("Image analysis completed")
-            
-            # Return structured InfoResponse
             return InfoResponse(
                 metadata=metadata,
-                histogram=histogram_data,
-                dominant_colors=dominant_colors,
-                description=description.strip()
+                histogram=HistogramData(red=[], green=[], blue=[], luminance=[]),
+                dominant_colors=["#000000"],
+                description=f"Image analysis failed: {str(e)}"
+            )
+        except:
+            # Fallback if image can't be loaded
+            self.logger.error("Failed to load image for fallback analysis")
+            metadata = ImageMetadata(
+                width=0, height=0, format="unknown", 
+                color_space="unknown", channels=0, bit_depth=0
+            )
+            return InfoResponse(
+                metadata=metadata,
+                histogram=HistogramData(red=[], green=[], blue=[], luminance=[]),
+                dominant_colors=["#000000"],
+                description=f"Failed to load image: {str(e)}"
             )
-            
-        except Exception as e:
-            self.logger.error(f"Image analysis failed: {str(e)}", exc_info=True)
-            # Return basic info if analysis fails
-            try:
-                img = Image.open(image_path)
-                metadata = ImageMetadata(
-                    width=img.width,
-                    height=img.height,
-                    format=img.format or "unknown",
-                    color_space=img.mode,
-                    channels=len(img.getbands()),
-                    bit_depth=8
-                )
-                return InfoResponse(
-                    metadata=metadata,
-                    histogram=HistogramData(red=[], green=[], blue=[], luminance=[]),
-                    dominant_colors=["#000000"],
-                    description=f"Image analysis failed: {str(e)}"
-                )
-            except:
-                # Fallback if image can't be loaded
-                self.logger.error("Failed to load image for fallback analysis")
-                metadata = ImageMetadata(
-                    width=0, height=0, format="unknown", 
-                    color_space="unknown", channels=0, bit_depth=0
-                )
-                return InfoResponse(
-                    metadata=metadata,
-                    histogram=HistogramData(red=[], green=[], blue=[], luminance=[]),
-                    dominant_colors=["#000000"],
-                    description=f"Failed to load image: {str(e)}"
-                )
+    
+    def _image_stats(self, ctx: ImageContext):
+        """Metadata, histogram and dominant colours; prompt-independent, so cached per image"""
+        stats_key = ctx.sha256
+        cached_stats = vision_cache.get(('info_stats', stats_key)) if stats_key else None
+        if cached_stats is not None:
+            self.logger.info("Using cached image statistics")
+            return cached_stats
+        
+        img = ctx.pil_image
+        
+        # Calculate histogram data
+        histogram_data = self._calculate_histogram(img)
+        
+        # Extract dominant colors
+        dominant_colors = self._extract_dominant_colors(img)
+        
+        # Create metadata object
+        metadata = ImageMetadata(
+            width=img.width,
+            height=img.height,
+            format=img.format or "unknown",
+            color_space=img.mode,
+            channels=len(img.getbands()),
+            bit_depth=8  # Assuming standard 8-bit depth, could be calculated more precisely
+        )
+        
+        if stats_key and histogram_data.red:
+            vision_cache.set(('info_stats', stats_key), (metadata, histogram_data, dominant_colors))
+        return metadata, histogram_data, dominant_colors
     
     def _calculate_histogram(self, img: Image.Image) -> HistogramData:
         """Calculate image histogram data"""
         try:
-            # Convert to RGB if not already
-            if img.mode != 'RGB':
-                img = img.convert('RGB')
-                
-            # Get histogram data for each channel
-            hist = img.histogram()
+            # Get histogram data for each channel, without an RGB copy where the
+            # bins can be read or derived directly
+            if img.mode == 'L':
+                # Grey: every channel (and luminance) is the one band
+                hist = img.histogram()
+                return HistogramData.model_construct(red=hist, green=list(hist), blue=list(hist), luminance=list(hist))
+            if img.mode == 'P':
+                # Map palette-index counts through the palette
+                counts = np.asarray(img.histogram(), dtype=np.int64)
+                palette = np.asarray(img.getpalette() or [], dtype=np.intp).reshape(-1, 3)
+                counts = counts[:len(palette)]
+                palette = palette[:len(counts)]
+                hist = [int(c) for channel in palette.T
+                        for c in np.bincount(channel, weights=counts, minlength=256).astype(np.int64)]
+                # Each palette entry's luma (Pillow's fixed-point RGB -> L), counted per pixel
+                luma = (palette @ np.array([19595, 38470, 7471]) + 0x8000) >> 16
+                lum_hist = np.bincount(luma, weights=counts, minlength=256).astype(np.int64).tolist()
+            else:
+                if img.mode in ('RGB', 'RGBA', 'RGBX'):
+                    # Extra bands come after R, G, B and are ignored
+                    hist = img.histogram()
+                else:
+                    hist = img.convert('RGB').histogram()
+                # Luminance needs each pixel's luma; it can't be derived from the channel histograms
+                lum_hist = img.convert('L').histogram()
             r_hist = hist[0:256]
             g_hist = hist[256:512]
             b_hist = hist[512:768]
             
-            # Calculate luminance histogram
-            lum_img = img.convert('L')
-            lum_hist = lum_img.histogram()
-            
-            # Convert to lists with integers
-            return HistogramData(
-                red=list(map(int, r_hist)),
-                green=list(map(int, g_hist)),
-                blue=list(map(int, b_hist)),
-                luminance=list(map(int, lum_hist))
+            # PIL histograms are already lists of ints, so skip pydantic's per-element validation
+            return HistogramData.model_construct(
+                red=r_hist,
+                green=g_hist,
+                blue=b_hist,
+                luminance=lum_hist
             )
         except Exception as e:
             # Return empty histograms if calculation fails
             return HistogramData(red=[], green=[], blue=[], luminance=[])
     
     def _extract_dominant_colors(self, img: Image.Image, num_colors: int = 5) -> List[str]:
-        """Extract dominant colors from image"""
+        """Extract dominant colors from image with k-means on a thumbnail, largest cluster first"""
         try:
-            # Resize for faster processing
-            img_small = img.resize((100, 100))
+            # Shrink to fit 100x100 for faster processing, keeping the aspect ratio so the
+            # pixel counts (and thus cluster sizes) aren't skewed. BOX averages each source
+            # area, which is also the cheapest filter for large reductions. Computing the
+            # size and resizing avoids thumbnail()'s full-size copy of the shared image
+            scale = min(1.0, THUMBNAIL_SIZE / max(img.size))
+            size = (max(1, round(img.width * scale)), max(1, round(img.height * scale)))
+            img_small = img.resize(size, Image.Resampling.BOX) if size != img.size else img
             if img_small.mode != 'RGB':
                 img_small = img_small.convert('RGB')
             
-            # Simple approach: use average color and create variations
-            avg_color = ImageStat.Stat(img_small).mean
-            rgb = tuple(map(int, avg_color[:3]))
-            
-            # Return as hex colors  
-            dominant_color = f"#{rgb[0]:02x}{rgb[1]:02x}{rgb[2]:02x}"
+            pixels = np.asarray(img_small, dtype=np.float32).reshape(-1, 3)
+            centers, counts = self._kmeans(pixels, num_colors)
             
-            # Create some variations of the average for a more diverse palette
-            colors = [dominant_color]
-            
-            # Create darker and lighter variations
-            for i in range(1, min(num_colors, 4)):
-                if i <= 2:
-                    # Darker variations
-                    factor = 0.7 - (i * 0.2)
-                else:
-                    # Lighter variations
-                    factor = 1.3 + ((i-2) * 0.2)
-                    
-                r = max(0, min(255, int(rgb[0] * factor)))
-                g = max(0, min(255, int(rgb[1] * factor)))
-                b = max(0, min(255, int(rgb[2] * factor)))
-                colors.append(f"#{r:02x}{g:02x}{b:02x}")
+            # Return as hex colors, most common first
+            colors = []
+            for k in np.argsort(-counts, kind='stable'):
+                if counts[k] == 0:
+                    continue
+                r, g, b = np.clip(np.rint(centers[k]), 0, 255).astype(int)
+                color = f"#{r:02x}{g:02x}{b:02x}"
+                if color not in colors:
+                    colors.append(color)
             
             return colors[:num_colors]
             
         except Exception as e:
             # Return basic black color if extraction fails
-            return ["#000000"]
\ No newline at end of file
+            return ["#000000"]
+    
+    @staticmethod
+    def _kmeans(pixels: np.ndarray, k: int, iterations: int = KMEANS_ITERATIONS):
+        """Plain vectorised k-means; returns (centers, cluster sizes)
+
+        Seeded so the same image always gives the same palette.
+        """
+        rng = np.random.default_rng(0)
+        unique = np.unique(pixels, axis=0)
+        k = min(k, len(unique))
+        centers = unique[rng.choice(len(unique), k, replace=False)]
+        
+        for _ in range(iterations):
+            # Squared distance via |p|^2 - 2 p.c + |c|^2 keeps the temporary at N x k
+            dists = (pixels ** 2).sum(1)[:, None] - 2 * pixels @ centers.T + (centers ** 2).sum(1)
+            labels = dists.argmin(1)
+            counts = np.bincount(labels, minlength=k)
+            sums = np.zeros_like(centers)
+            np.add.at(sums, labels, pixels)
+            # Empty clusters keep their previous center
+            new_centers = np.where(counts[:, None] > 0, sums / np.maximum(counts, 1)[:, None], centers)
+            if np.allclose(new_centers, centers):
+                break
+            centers = new_centers
+        
+        return centers, np.bincount(labels, minlength=k)
@@ -1,235 +1,649 @@
-import json
-import os
-from typing import List, Dict, Any
-import numpy as np
-import cv2
-from PIL import Image
-from pydantic import BaseModel
-from model.gemini import generate,generate_with_schema
-from PIL import Image
-import torch
-from transformers import Owlv2Processor, Owlv2ForObjectDetection
-from diffusers import StableDiffusionInstructPix2PixPipeline, EulerAncestralDiscreteScheduler
-
-class BoundingBox(BaseModel):
-    x: float
-    y: float
-    width: float
-    height: float
-    label: str
-    confidence: float
-    action_prompt: str
-
-class DetectionPromptResult(BaseModel):
-    name: List[str]
-    action_prompt: List[str]
-
-from diffusers import StableDiffusionXLImg2ImgPipeline
-from diffusers.utils import load_image
-
-class LocalEditAgent:
-    """Handles object detection and local edits like inpainting"""
-    def __init__(self, client=None):
-
-        self.processor = Owlv2Processor.from_pretrained("google/owlv2-base-patch16-ensemble")
-        self.model = Owlv2ForObjectDetection.from_pretrained("google/owlv2-base-patch16-ensemble")
-     
-        # Check CUDA availability and set device accordingly
-        self.device = "cuda" if torch.cuda.is_available() else "cpu"
-        print(f"Using device: {self.device}")
-        
-        if self.device == "cuda":
-            self.pipe_pix2pix = StableDiffusionInstructPix2PixPipeline.from_pretrained(
-                "timbrooks/instruct-pix2pix", 
-                torch_dtype=torch.float16, 
-                safety_checker=None
-            )
-            self.pipe_pix2pix.to("cuda")
-            self.pipe_pix2pix.scheduler = EulerAncestralDiscreteScheduler.from_config(self.pipe_pix2pix.scheduler.config)
-      
-            self.pipe = StableDiffusionXLImg2ImgPipeline.from_pretrained(
-                "stabilityai/stable-diffusion-xl-refiner-1.0", 
-                torch_dtype=torch.float16, 
-                variant="fp16", 
-                use_safetensors=True
-            )
-            self.pipe = self.pipe.to("cuda")
-        else:
-            # CPU fallback with float32
-            self.pipe_pix2pix = StableDiffusionInstructPix2PixPipeline.from_pretrained(
-                "timbrooks/instruct-pix2pix", 
-                torch_dtype=torch.float32, 
-                safety_checker=None
-            )
-            self.pipe_pix2pix.scheduler = EulerAncestralDiscreteScheduler.from_config(self.pipe_pix2pix.scheduler.config)
-      
-            self.pipe = StableDiffusionXLImg2ImgPipeline.from_pretrained(
-                "stabilityai/stable-diffusion-xl-refiner-1.0", 
-                torch_dtype=torch.float32, 
-                use_safetensors=True
-            )
-            print("Warning: Running on CPU. This will be significantly slower than GPU.")
-
-    """
-    def __init__(self, client=None):
-        # Client is not needed since we use the generate functions
-        pass
-    """
-    def process_local_edit(self, image_path: str, prompt: str) -> dict:
-        """Process local edit request with object detection and inpainting"""
-        try:
-            # Use the merged function
-            edited_path = self.detect_and_inpaint(image_path, prompt)
-            
-            # Check if editing was successful
-            if edited_path == image_path:
-                return {
-                    "edited_image_path": image_path,
-                    "detected_objects": [],
-                    "edited_regions": [],
-                    "message": "No objects detected for local editing. Please be more specific about what you want to edit."
-                }
-            else:
-                return {
-                    "edited_image_path": edited_path,
-                    "detected_objects": [],  # Could extract this info if needed
-                    "edited_regions": [],    # Could extract this info if needed
-                    "message": f"Successfully processed local edit request: '{prompt}'"
-                }
-
-        except Exception as e:
-            return {
-                "edited_image_path": image_path,
-                "detected_objects": [],
-                "edited_regions": [],
-                "message": f"Local edit failed: {str(e)}"
-            }
-
-    def detect_and_inpaint(self, image_path: str, prompt: str) -> str:
-        """Detect objects and inpaint them in one function"""
-        print("Starting detection and inpainting process...")
-        
-        # DETECTION PHASE
-        detection_prompt = f"""
-        Analyze this prompt to identify an object class to be detected based on this request: "{prompt}"
-
-        Look for objects that the user wants to edit, remove, or modify.
-        For each relevant object, provide:
-        - A descriptive name of class, and action to do with this class
-        Examples:
-        - "remove the person" -> object class is person, object action is remove
-        - "delete the car" -> object class is vehicles, object action is delete
-        - "remove the person and delete the car" -> two object classes, object class is person and object class is vehicle, object action is remove and delete
-
-        Respond in JSON format:
-        {{"name": ["person","vehicle"], "action_prompt":["remove the person", "delete the car"]}}
-        """
-        
-        try:
-            # Generate detection schema
-            response = generate_with_schema(
-                prompt=detection_prompt,
-                schema_class=DetectionPromptResult,
-                system_instruction="You are an object detection assistant. Analyze this prompt and always respond with valid JSON."
-            )
-
-            # Load image
-            image = Image.open(image_path)
-            img_width, img_height = image.size
-            
-            # Parse detection results
-            result = json.loads(response.strip())
-            list_object_class = result["name"]
-            list_action_prompt = result["action_prompt"]
-
-            texts = [["a photo of " + str(object_)] for object_ in list_object_class]
-            action_prompts = [[str(object_)] for object_ in list_action_prompt]
-
-            # Run object detection
-            inputs = self.processor(text=texts, images=image, return_tensors="pt")
-
-            with torch.no_grad():
-                outputs = self.model(**inputs)
-
-            # Process detection results
-            target_sizes = torch.Tensor([image.size[::-1]])
-            results = self.processor.post_process_object_detection(
-                outputs=outputs, 
-                target_sizes=target_sizes, 
-                threshold=0.5
-            )
-            
-            # Extract bounding boxes
-            i = 0  # First image
-            bboxes = []
-            text = texts[i]
-            action_prompt = action_prompts[i]
-            boxes, scores, labels = results[i]["boxes"], results[i]["scores"], results[i]["labels"]
-            
-            for box, score, label in zip(boxes, scores, labels):
-                bbox = BoundingBox(
-                    x=int(box[0]),
-                    y=int(box[1]),
-                    width=int(abs(box[0] - box[2])),
-                    height=int(abs(box[1] - box[3])),
-                    label=str(label),
-                    confidence=score,
-                    action_prompt=action_prompt[label]
-                )
-                bboxes.append(bbox)
-                print(f"Detected {text[label]} with confidence {round(score.item(), 3)} at location {box} with action prompt: {action_prompt[label]}")
-
-            print(f"Detected {len(bboxes)} objects")
-            
-            # Check if any objects were detected
-            if len(bboxes) < 1:
-                print("No objects detected for inpainting")
-                return image_path
-
-            # INPAINTING PHASE
-            print("Starting inpainting phase...")
-            
-            # Work with the same PIL image
-            img_pil = image.copy()  # Create a copy to avoid modifying original
-            w, h = img_pil.size
-            
-            for bounding_box in bboxes:
-                # Validate bounding box
-                x = max(0, min(bounding_box.x, w-1))
-                y = max(0, min(bounding_box.y, h-1))
-                width = max(1, min(bounding_box.width, w - x))
-                height = max(1, min(bounding_box.height, h - y))
-                
-                print(f"Processing region: ({x}, {y}, {width}, {height}) with prompt: {bounding_box.action_prompt}")
-                
-                # Crop the region using PIL
-                img_bbox = img_pil.crop((int(x), int(y), int(x+width), int(y+height)))
-
-                # Apply the diffusion model
-              
-                images = self.pipe_pix2pix(
-                    bounding_box.action_prompt, 
-                    image=img_bbox, 
-                    num_inference_steps=10, 
-                    image_guidance_scale=1
-                ).images
-           
-
-
-                # Paste the edited region back
-                img_pil.paste(images[0], (int(x), int(y)))
-                print(f"Applied edit for: {bounding_box.action_prompt}")
-
-
-            img_pil = self.pipe("make this image more realistic", image=img_pil).images[0]
-            # Save the result
-            task_name = "detect_inpaint_"
-            base_name, ext = os.path.splitext(image_path)
-            output_path = f"{base_name}_{task_name}{ext}"
-            img_pil.save(output_path, quality=95 if ext.lower() in ['.jpg', '.jpeg'] else None)
-            print(f"Saved edited image to {output_path}")
-            return output_path
-
-        except Exception as e:
-            print(f"Detection and inpainting error: {e}")
+import copy
+import json
+import math
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Optional, Tuple
+from pydantic import BaseModel
+from model.gemini import generate_with_schema
+from logic.image_context import ImageContext, encode_jpeg, OUTPUT_PNG_COMPRESS_LEVEL
+from logic.models import BoundingBox
+import numpy as np
+import torch
+from PIL import Image
+from transformers import Owlv2Processor, Owlv2ForObjectDetection
+from transformers.models.owlv2.modeling_owlv2 import Owlv2ObjectDetectionOutput
+from logic.vision_cache import VisionCache, vision_cache
+from diffusers import StableDiffusionInstructPix2PixPipeline, StableDiffusionXLImg2ImgPipeline, DPMSolverMultistepScheduler
+from diffusers.models.attention_processor import AttnProcessor2_0
+
+try:
+    from optimum.quanto import quantize, freeze, qfloat8_e4m3fn
+except ImportError:  # optimum-quanto is optional; without it the UNets stay in 16-bit
+    quantize = None
+
+try:
+    from torchao.quantization import quantize_ as quantize_int8, Int8DynamicActivationInt8WeightConfig
+except ImportError:  # torchao is optional; only the opt-in int8 CPU detector needs it
+    quantize_int8 = None
+
+class DetectionPromptResult(BaseModel):
+    name: List[str]
+    action_prompt: List[str]
+
+# Denoising steps per bbox edit (DPM-Solver++ needs about half of Euler's), and the
+# square size every crop is resized to so all bboxes go through pix2pix as one batch
+# (also the compiled UNets' warmup size)
+PIX2PIX_STEPS = 5
+PIX2PIX_SIZE = 512
+PIX2PIX_SEED = 0
+
+OUTPUT_JPEG_QUALITY = 95
+
+# Input shapes (batch sizes) captured as CUDA graphs for an uncompiled pix2pix UNet
+MAX_CUDA_GRAPHS = 4
+
+# Optional SDXL refiner pass: denoising steps and how much of the image it may change
+REFINER_STEPS = 15
+REFINER_STRENGTH = 0.3
+# Larger images are refined in overlapping tiles of at most this size (SDXL's native
+# resolution) so UNet memory stays bounded; overlaps are feathered together
+REFINER_TILE_SIZE = 1024
+REFINER_TILE_OVERLAP = 128
+
+# Distinct class sets whose OWLv2 text embeddings are kept on the device
+TEXT_EMBED_CACHE_SIZE = 64
+
+# Layers kept in 16-bit when the UNet weights are quantized to FP8. If a sample
+# generation comes out black/NaN, the attention output projections are excluded too.
+FP8_EXCLUDE = ["*norm*", "*bias*"]
+FP8_SENSITIVE_EXCLUDE = ["*to_out.0", "*attn2.to_out*", "*proj_out"]
+
+# Opt-in (QUANTIZE_CPU_DETECTOR=1, needs torchao): on CPU the OWLv2 vision and text
+# transformers (nearly all nn.Linear) run with int8 weights and dynamically quantized
+# activations; the box and class heads stay fp32. Detections may shift slightly.
+QUANTIZE_CPU_DETECTOR = os.getenv("QUANTIZE_CPU_DETECTOR", "").lower() in ("1", "true", "yes")
+
+def _inference_dtype(device: str) -> torch.dtype:
+    """bf16 on Ampere (SM80) and newer, whose wider exponent avoids the fp16
+    overflows that turn diffusion outputs black; fp16 on older GPUs, fp32 on CPU"""
+    if device != "cuda":
+        return torch.float32
+    return torch.bfloat16 if torch.cuda.get_device_capability()[0] >= 8 else torch.float16
+
+def _is_valid_sample(sample) -> bool:
+    """False for the all-black / NaN output an overflowing FP8 layer produces"""
+    sample = np.asarray(sample)
+    return bool(np.isfinite(sample).all() and sample.max() > 0)
+
+def _quantize_unet(pipeline, sample):
+    """Quantize pipeline.unet weights to FP8 (e4m3) and check the result with sample()
+
+    sample() runs a short generation and returns it as an array. A copy of the 16-bit
+    UNet is kept on the CPU until a sample passes, so a bad quantization can be retried
+    with more layers excluded, or undone.
+    """
+    original = copy.deepcopy(pipeline.unet).to("cpu")
+    for exclude in (FP8_EXCLUDE, FP8_EXCLUDE + FP8_SENSITIVE_EXCLUDE):
+        try:
+            quantize(pipeline.unet, weights=qfloat8_e4m3fn, exclude=exclude)
+            freeze(pipeline.unet)
+            with torch.inference_mode():
+                valid = _is_valid_sample(sample())
+            if valid:
+                print(f"Quantized UNet weights to FP8 (excluding {exclude})")
+                return
+            print(f"FP8 UNet produced an invalid sample with exclude={exclude}")
+        except Exception as e:
+            print(f"FP8 quantization failed ({e})")
+        pipeline.unet = copy.deepcopy(original).to(pipeline.device)
+    print("Keeping the unquantized UNet")
+
+def _pix2pix_scheduler(pipeline):
+    """Second-order DPM-Solver++ with Karras sigmas, good at PIX2PIX_STEPS steps"""
+    return DPMSolverMultistepScheduler.from_config(
+        pipeline.scheduler.config, algorithm_type="dpmsolver++", use_karras_sigmas=True)
+
+def _to_channels_last(pipeline):
+    """NHWC layout for the conv-heavy UNet and VAE (faster convs on tensor cores and oneDNN)"""
+    pipeline.unet.to(memory_format=torch.channels_last)
+    pipeline.vae.to(memory_format=torch.channels_last)
+
+def _enable_fast_attention(pipeline):
+    """Use fused attention kernels in the UNet
+
+    Prefers torch's SDPA (flash / memory-efficient kernels), which torch.compile can
+    trace; xFormers ops would break the compiled graph, so they are only the
+    fallback for torch builds without SDPA.
+    """
+    if hasattr(torch.nn.functional, "scaled_dot_product_attention"):
+        pipeline.unet.set_attn_processor(AttnProcessor2_0())
+    else:
+        try:
+            pipeline.enable_xformers_memory_efficient_attention()
+        except Exception as e:
+            print(f"No fused attention available ({e})")
+    processors = {type(processor).__name__ for processor in pipeline.unet.attn_processors.values()}
+    print(f"{type(pipeline).__name__} attention: {', '.join(sorted(processors))}")
+
+def _compile_unet(pipeline, warmup, fullgraph=True) -> bool:
+    """Compile pipeline.unet with TorchInductor and trigger the compile with warmup()
+
+    reduce-overhead also captures CUDA graphs, which removes the Python dispatch
+    cost of every denoising step. If the UNet doesn't trace as a single graph,
+    fall back to fullgraph=False; if compilation fails altogether, keep eager mode
+    and return False.
+    """
+    unet = pipeline.unet
+    try:
+        pipeline.unet = torch.compile(unet, mode="reduce-overhead", fullgraph=fullgraph)
+        # Same grad mode as detect_and_inpaint, so the request path reuses this graph
+        with torch.inference_mode():
+            warmup()
+        return True
+    except Exception as e:
+        pipeline.unet = unet
+        if fullgraph:
+            print(f"Full-graph compile failed ({e}); retrying with graph breaks")
+            return _compile_unet(pipeline, warmup, fullgraph=False)
+        print(f"torch.compile failed ({e}); using the eager UNet")
+        return False
+
+class _CUDAGraphUNet(torch.nn.Module):
+    """Eager UNet whose denoising step is replayed from a captured CUDA graph
+
+    Used when torch.compile isn't available, so the fixed-size pix2pix steps still
+    skip per-kernel launch overhead. One graph is captured per input shape (the
+    batch grows with the number of boxes), up to max_graphs; calls that don't fit
+    the captured signature run eagerly.
+    """
+
+    def __init__(self, unet, max_graphs: int = MAX_CUDA_GRAPHS):
+        super().__init__()
+        self.unet = unet
+        self.max_graphs = max_graphs
+        self._graphs = {}
+        self._pool = torch.cuda.graph_pool_handle()
+
+    def __getattr__(self, name):
+        # config, dtype, in_channels, ... are read by the pipeline
+        try:
+            return super().__getattr__(name)
+        except AttributeError:
+            if name == "unet":
+                raise
+            return getattr(self.unet, name)
+
+    def forward(self, sample, timestep, encoder_hidden_states, *args, return_dict=True, **kwargs):
+        inputs = (sample, timestep, encoder_hidden_states)
+        key = tuple((t.shape, t.dtype) for t in inputs if torch.is_tensor(t))
+        if (args or return_dict or any(v is not None for v in kwargs.values()) or len(key) < 3
+                or timestep.device != sample.device):
+            return self.unet(sample, timestep, encoder_hidden_states, *args, return_dict=return_dict, **kwargs)
+
+        if key not in self._graphs:
+            if len(self._graphs) >= self.max_graphs:
+                return self.unet(sample, timestep, encoder_hidden_states, return_dict=False)
+            return self._capture(key, inputs)
+        entry = self._graphs[key]
+        if entry is None:  # capture failed for this shape
+            return self.unet(sample, timestep, encoder_hidden_states, return_dict=False)
+
+        graph, static_inputs, static_output = entry
+        for buffer, value in zip(static_inputs, inputs):
+            buffer.copy_(value)
+        graph.replay()
+        # The next replay overwrites static_output
+        return (static_output.clone(),)
+
+    def _capture(self, key, inputs):
+        static_inputs = tuple(t.clone() for t in inputs)
+        # Capture needs a warm-up run on a side stream; its result answers this call
+        stream = torch.cuda.Stream()
+        stream.wait_stream(torch.cuda.current_stream())
+        with torch.cuda.stream(stream):
+            output = self.unet(*static_inputs, return_dict=False)[0]
+        torch.cuda.current_stream().wait_stream(stream)
+
+        graph = torch.cuda.CUDAGraph()
+        try:
+            with torch.cuda.graph(graph, pool=self._pool):
+                static_output = self.unet(*static_inputs, return_dict=False)[0]
+            self._graphs[key] = (graph, static_inputs, static_output)
+        except RuntimeError as e:
+            print(f"CUDA graph capture failed ({e}); running this shape eagerly")
+            self._graphs[key] = None
+        return (output,)
+
+DETECTION_PROMPT_TEMPLATE = """
+        Analyze this prompt to identify an object class to be detected based on this request: "{prompt}"
+
+        Look for objects that the user wants to edit, remove, or modify.
+        For each relevant object, provide:
+        - A descriptive name of class, and action to do with this class
+        Examples:
+        - "remove the person" -> object class is person, object action is remove
+        - "delete the car" -> object class is vehicles, object action is delete
+        - "remove the person and delete the car" -> two object classes, object class is person and object class is vehicle, object action is remove and delete
+
+        Respond in JSON format:
+        {{"name": ["person","vehicle"], "action_prompt":["remove the person", "delete the car"]}}
+        """
+
+OWLV2_MODEL = "google/owlv2-base-patch16-ensemble"
+PIX2PIX_MODEL = "timbrooks/instruct-pix2pix"
+REFINER_MODEL = "stabilityai/stable-diffusion-xl-refiner-1.0"
+
+# Loaded once per process and shared by every LocalEditAgent (see _get_models)
+_models = {}
+_models_lock = threading.Lock()
+# The diffusion pipelines keep per-call state (scheduler timesteps, captured CUDA
+# graphs), so concurrent requests take turns on them; detection, the Gemini calls
+# and pre/post-processing of other requests overlap with the running pipeline
+_pipeline_lock = threading.Lock()
+
+def _load_detector(device: str, dtype: torch.dtype):
+    processor = Owlv2Processor.from_pretrained(OWLV2_MODEL)
+    model = Owlv2ForObjectDetection.from_pretrained(OWLV2_MODEL).to(device).eval()
+    if device == "cuda":
+        model = model.to(dtype)
+    elif QUANTIZE_CPU_DETECTOR and quantize_int8 is None:
+        print("QUANTIZE_CPU_DETECTOR needs torchao; using the fp32 detector")
+    elif QUANTIZE_CPU_DETECTOR:
+        try:
+            for encoder in (model.owlv2.vision_model, model.owlv2.text_model):
+                quantize_int8(encoder, Int8DynamicActivationInt8WeightConfig())
+            print("Quantized OWLv2 encoder weights to int8")
+        except Exception as e:
+            print(f"int8 quantization failed ({e}); using the fp32 detector")
+    return processor, model
+
+def _load_pix2pix(device: str, dtype: torch.dtype):
+    if device == "cuda":
+        pipe = StableDiffusionInstructPix2PixPipeline.from_pretrained(
+            PIX2PIX_MODEL, 
+            torch_dtype=dtype, 
+            safety_checker=None
+        )
+        pipe.to("cuda")
+    else:
+        # CPU fallback with float32
+        pipe = StableDiffusionInstructPix2PixPipeline.from_pretrained(
+            PIX2PIX_MODEL, 
+            torch_dtype=torch.float32, 
+            safety_checker=None
+        )
+    pipe.scheduler = _pix2pix_scheduler(pipe)
+    if device == "cuda":
+        _enable_fast_attention(pipe)
+    _to_channels_last(pipe)
+    if device != "cuda":
+        return pipe
+
+    dummy = Image.new("RGB", (PIX2PIX_SIZE, PIX2PIX_SIZE), (128, 128, 128))
+    def warmup(**kwargs):
+        return pipe("", image=dummy, num_inference_steps=PIX2PIX_STEPS, image_guidance_scale=1, **kwargs)
+    if quantize is not None:
+        _quantize_unet(pipe, lambda: warmup(output_type="np").images)
+    # Pay the one-time compile / capture cost here rather than on the first request
+    if not (hasattr(torch, "compile") and _compile_unet(pipe, warmup)):
+        pipe.unet = _CUDAGraphUNet(pipe.unet)
+        with torch.inference_mode():
+            warmup()
+    return pipe
+
+def _run_refiner(pipe, image, steps: int, **kwargs):
+    """Light whole-image SDXL refiner pass"""
+    return pipe(
+        "make this image more realistic",
+        image=image,
+        num_inference_steps=steps,
+        strength=REFINER_STRENGTH,
+        **kwargs
+    ).images
+
+def _tile_spans(length: int, tile: int, overlap: int) -> List[Tuple[int, int]]:
+    """(start, end) spans covering length with the fewest tiles of at most tile pixels
+
+    The tile length is shrunk until the tiles split the side evenly (kept a multiple
+    of 8 for the VAE), rather than padding the last tile or mostly repeating it.
+    """
+    if length <= tile:
+        return [(0, length)]
+    count = math.ceil((length - overlap) / (tile - overlap))
+    size = min(tile, (math.ceil((length + (count - 1) * overlap) / count) + 7) // 8 * 8)
+    starts = np.linspace(0, length - size, count).round().astype(int).tolist()
+    return [(start, start + size) for start in starts]
+
+def _feather(size: int, overlap: int) -> np.ndarray:
+    """1-D blend weights ramping up over the first and down over the last overlap pixels"""
+    ramp = np.minimum(np.arange(1, size + 1), np.arange(size, 0, -1))
+    return np.minimum(ramp, overlap).astype(np.float32) / overlap
+
+def _run_refiner_tiled(pipe, image: Image.Image, steps: int) -> Image.Image:
+    """_run_refiner over overlapping tiles of a large image, blended back together"""
+    width, height = image.size
+    out = np.zeros((height, width, 3), dtype=np.float32)
+    weights = np.zeros((height, width, 1), dtype=np.float32)
+    for top, bottom in _tile_spans(height, REFINER_TILE_SIZE, REFINER_TILE_OVERLAP):
+        for left, right in _tile_spans(width, REFINER_TILE_SIZE, REFINER_TILE_OVERLAP):
+            tile = _run_refiner(pipe, image.crop((left, top, right, bottom)), steps)[0]
+            if tile.size != (right - left, bottom - top):
+                tile = tile.resize((right - left, bottom - top), Image.LANCZOS)
+            weight = np.outer(_feather(bottom - top, REFINER_TILE_OVERLAP),
+                              _feather(right - left, REFINER_TILE_OVERLAP))[..., None]
+            out[top:bottom, left:right] += np.asarray(tile.convert("RGB"), dtype=np.float32) * weight
+            weights[top:bottom, left:right] += weight
+    out /= weights
+    return Image.fromarray(np.clip(np.rint(out), 0, 255).astype(np.uint8))
+
+def _load_refiner(device: str, dtype: torch.dtype):
+    if device == "cuda":
+        pipe = StableDiffusionXLImg2ImgPipeline.from_pretrained(
+            REFINER_MODEL, 
+            torch_dtype=dtype,  # fp16 weights, cast on load when bf16
+            variant="fp16", 
+            use_safetensors=True
+        )
+        pipe = pipe.to("cuda")
+        _enable_fast_attention(pipe)
+        # The refiner decodes the whole image; tiling caps VAE memory on large inputs
+        pipe.vae.enable_tiling()
+    else:
+        pipe = StableDiffusionXLImg2ImgPipeline.from_pretrained(
+            REFINER_MODEL, 
+            torch_dtype=torch.float32, 
+            use_safetensors=True
+        )
+    _to_channels_last(pipe)
+    if device != "cuda":
+        return pipe
+
+    dummy = Image.new("RGB", (PIX2PIX_SIZE, PIX2PIX_SIZE), (128, 128, 128))
+    if quantize is not None:
+        _quantize_unet(pipe, lambda: _run_refiner(pipe, dummy, REFINER_STEPS, output_type="np"))
+    if hasattr(torch, "compile"):
+        _compile_unet(pipe, lambda: _run_refiner(pipe, dummy, REFINER_STEPS))
+    return pipe
+
+def _get_models(enable_refiner: bool = False) -> dict:
+    """The process-wide detector and diffusion pipelines, loaded on first use
+
+    Loading, quantizing and compiling takes tens of seconds, so it happens once no
+    matter how many agents are created. The lock makes concurrent first calls wait
+    for a single load. The refiner is only loaded once an agent asks for it.
+    """
+    with _models_lock:
+        if not _models:
+            # Check CUDA availability and set device accordingly
+            device = "cuda" if torch.cuda.is_available() else "cpu"
+            print(f"Using device: {device}")
+            dtype = _inference_dtype(device)
+            print(f"Using dtype: {dtype}")
+
+            processor, model = _load_detector(device, dtype)
+            _models.update(device=device, dtype=dtype, processor=processor, model=model,
+                           pipe_pix2pix=_load_pix2pix(device, dtype))
+            if device != "cuda":
+                print("Warning: Running on CPU. This will be significantly slower than GPU.")
+        if enable_refiner and "pipe" not in _models:
+            _models["pipe"] = _load_refiner(_models["device"], _models["dtype"])
+        return _models
+
+class LocalEditAgent:
+    """Handles object detection and local edits like inpainting
+
+    The SDXL refiner pass over the whole edited image is the most expensive step and
+    most local edits don't need it, so it is off by default; enable_refiner loads it
+    and runs it for refiner_steps steps.
+    """
+    def __init__(self, client=None, enable_refiner: bool = False, refiner_steps: int = REFINER_STEPS):
+        models = _get_models(enable_refiner)
+        self.device = models["device"]
+        self.dtype = models["dtype"]
+        self.processor = models["processor"]
+        self.model = models["model"]
+        self.pipe_pix2pix = models["pipe_pix2pix"]
+        self.pipe = models["pipe"] if enable_refiner else None
+        self._text_embeds_cache = VisionCache(maxsize=TEXT_EMBED_CACHE_SIZE)
+
+        self.enable_refiner = enable_refiner
+        self.refiner_steps = refiner_steps
+
+    def _refine(self, image, **kwargs):
+        with _pipeline_lock:
+            if max(image.size) > REFINER_TILE_SIZE:
+                return [_run_refiner_tiled(self.pipe, image, self.refiner_steps)]
+            return _run_refiner(self.pipe, image, self.refiner_steps, **kwargs)
+
+    def _detect_classes(self, prompt: str) -> Tuple[Tuple[str, ...], Tuple[str, ...]]:
+        """Ask Gemini which object classes the request targets; returns (classes, action prompts)
+
+        The answer only depends on the prompt, so it is cached and repeated requests
+        skip the round trip.
+        """
+        key = ('detection_classes', prompt)
+        cached = vision_cache.get(key)
+        if cached is not None:
+            print("Using cached detection classes")
+            return cached
+
+        response = generate_with_schema(
+            prompt=DETECTION_PROMPT_TEMPLATE.format(prompt=prompt),
+            schema_class=DetectionPromptResult,
+            system_instruction="You are an object detection assistant. Analyze this prompt and always respond with valid JSON.",
+            # Cached above in vision_cache; a second reply cache could disagree
+            no_cache=True
+        )
+        result = json.loads(response.strip())
+        detected = (tuple(result["name"]), tuple(result["action_prompt"]))
+        # Empty answers may be transient failures, so they are not cached
+        if detected[0]:
+            vision_cache.set(key, detected)
+        return detected
+
+    def _text_embeds(self, classes: tuple) -> torch.Tensor:
+        """OWLv2 query embeddings (1, n_classes, dim) for a tuple of class names
+
+        Users keep asking about the same few classes, so the text tower only runs
+        for class sets that aren't cached yet. Call under inference_mode.
+        """
+        embeds = self._text_embeds_cache.get(classes)
+        if embeds is None:
+            inputs = self.processor(text=[["a photo of " + c for c in classes]], return_tensors="pt")
+            inputs = {k: v.to(self.device, non_blocking=True) for k, v in inputs.items()}
+            embeds = self.model.owlv2.get_text_features(**inputs).unsqueeze(0)
+            self._text_embeds_cache.set(classes, embeds)
+        return embeds
+
+    def _image_features(self, image: Image.Image) -> torch.Tensor:
+        """OWLv2 vision tower feature map for one image; independent of the queried classes"""
+        pixel_values = self.processor(images=image, return_tensors="pt")["pixel_values"]
+        with torch.inference_mode(), torch.autocast(self.device, dtype=self.dtype, enabled=self.device == "cuda"):
+            return self.model.image_embedder(pixel_values=pixel_values.to(self.device, non_blocking=True))[0]
+
+    def _detect(self, feature_map: torch.Tensor, query_embeds: torch.Tensor) -> Owlv2ObjectDetectionOutput:
+        """The rest of Owlv2ForObjectDetection.forward, for precomputed image features and query embeddings"""
+        batch_size, height, width, hidden_dim = feature_map.shape
+        image_feats = feature_map.reshape(batch_size, height * width, hidden_dim)
+        query_mask = torch.ones(query_embeds.shape[:2], dtype=torch.bool, device=query_embeds.device)
+        logits, _ = self.model.class_predictor(image_feats, query_embeds, query_mask)
+        pred_boxes = self.model.box_predictor(image_feats, feature_map)
+        return Owlv2ObjectDetectionOutput(logits=logits, pred_boxes=pred_boxes, image_embeds=feature_map, text_embeds=query_embeds)
+
+    def warmup(self) -> None:
+        """Run the detector once on a blank image
+
+        The diffusion UNets are already warmed while loading; this moves the detector's
+        first-call costs (kernel selection, allocator growth) out of the first request.
+        """
+        dummy = Image.new("RGB", (PIX2PIX_SIZE, PIX2PIX_SIZE), (128, 128, 128))
+        feature_map = self._image_features(dummy)
+        with torch.inference_mode(), torch.autocast(self.device, dtype=self.dtype, enabled=self.device == "cuda"):
+            self._detect(feature_map, self._text_embeds(("object",)))
+
+    def process_local_edit(self, image_path: str, prompt: str, ctx: Optional[ImageContext] = None) -> dict:
+        """Process local edit request with object detection and inpainting"""
+        try:
+            # Use the merged function
+            edited_path = self.detect_and_inpaint(image_path, prompt, ctx)
+            
+            # Check if editing was successful
+            if edited_path == image_path:
+                return {
+                    "edited_image_path": image_path,
+                    "detected_objects": [],
+                    "edited_regions": [],
+                    "message": "No objects detected for local editing. Please be more specific about what you want to edit."
+                }
+            else:
+                return {
+                    "edited_image_path": edited_path,
+                    "detected_objects": [],  # Could extract this info if needed
+                    "edited_regions": [],    # Could extract this info if needed
+                    "message": f"Successfully processed local edit request: '{prompt}'"
+                }
+
+        except Exception as e:
+            return {
+                "edited_image_path": image_path,
+                "detected_objects": [],
+                "edited_regions": [],
+                "message": f"Local edit failed: {str(e)}"
+            }
+
+    def detect_and_inpaint(self, image_path: str, prompt: str, ctx: Optional[ImageContext] = None) -> str:
+        """Detect objects and inpaint them in one function
+        
+        ctx is the request's shared image context; image_path then only names the output file.
+        """
+        ctx = ctx or ImageContext.from_path(image_path)
+        print("Starting detection and inpainting process...")
+        
+        # DETECTION PHASE
+        try:
+            # Ask Gemini for the classes while the OWLv2 vision tower runs; only the
+            # text tower and prediction heads need the answer
+            with ThreadPoolExecutor(max_workers=1) as pool:
+                classes_future = pool.submit(self._detect_classes, prompt)
+
+                # Load image
+                image = ctx.pil_image
+                img_width, img_height = image.size
+                feature_map = self._image_features(image)
+
+                list_object_class, list_action_prompt = classes_future.result()
+
+            # One query list for the one image: every class is scored in a single
+            # forward pass and post-processing labels index straight into it
+            classes = tuple(str(object_) for object_ in list_object_class)
+            texts = [["a photo of " + c for c in classes]]
+            action_prompts = [[str(object_) for object_ in list_action_prompt]]
+
+            # Run object detection
+            with torch.inference_mode(), torch.autocast(self.device, dtype=self.dtype, enabled=self.device == "cuda"):
+                query_embeds = self._text_embeds(classes)
+                outputs = self._detect(feature_map, query_embeds)
+
+            # Process detection results (on the model's device)
+            target_sizes = torch.tensor([image.size[::-1]], device=self.device)
+            results = self.processor.post_process_object_detection(
+                outputs=outputs, 
+                target_sizes=target_sizes, 
+                threshold=0.5
+            )
+            
+            # Extract bounding boxes
+            i = 0  # First image
+            bboxes = []
+            edit_prompts = []  # action prompt for each box
+            text = texts[i]
+            action_prompt = action_prompts[i]
+            boxes, scores, labels = results[i]["boxes"], results[i]["scores"], results[i]["labels"]
+            
+            for box, score, label in zip(boxes, scores, labels):
+                bbox = BoundingBox(
+                    x1=int(box[0]),
+                    y1=int(box[1]),
+                    x2=int(box[2]),
+                    y2=int(box[3]),
+                    label=classes[label],
+                    confidence=float(score)
+                )
+                bboxes.append(bbox)
+                edit_prompts.append(action_prompt[label])
+                print(f"Detected {text[label]} with confidence {round(score.item(), 3)} at location {box} with action prompt: {action_prompt[label]}")
+
+            print(f"Detected {len(bboxes)} objects")
+            
+            # Check if any objects were detected
+            if len(bboxes) < 1:
+                print("No objects detected for inpainting")
+                return image_path
+
+            # INPAINTING PHASE
+            print("Starting inpainting phase...")
+            
+            # Crops are read from the (RGB) source image; edits are written into a
+            # single copy of the context's shared read-only RGB view (already decoded
+            # for JPEGs), so the original is left untouched
+            source = image if image.mode == "RGB" else image.convert("RGB")
+            pixels = ctx.np_array_rgb_uint8.copy()
+            w, h = source.size
+            
+            # Validate bounding boxes: (N, 4) x, y, width, height clipped to the image
+            boxes = np.array([[b.x1, b.y1, b.x2 - b.x1, b.y2 - b.y1] for b in bboxes], dtype=np.int32)
+            boxes[:, 0] = np.clip(boxes[:, 0], 0, w - 1)
+            boxes[:, 1] = np.clip(boxes[:, 1], 0, h - 1)
+            boxes[:, 2] = np.clip(boxes[:, 2], 1, w - boxes[:, 0])
+            boxes[:, 3] = np.clip(boxes[:, 3], 1, h - boxes[:, 1])
+            regions = [tuple(region) for region in boxes.tolist()]
+            for edit_prompt, (x, y, width, height) in zip(edit_prompts, regions):
+                print(f"Processing region: ({x}, {y}, {width}, {height}) with prompt: {edit_prompt}")
+
+            # Apply the diffusion model to every crop in one batched denoising loop. Every
+            # crop has the same canonical size, so the compiled / captured UNet is reused
+            # (resize's box crops and scales in one pass)
+            crops = [
+                source.resize((PIX2PIX_SIZE, PIX2PIX_SIZE), Image.LANCZOS, box=(x, y, x + width, y + height))
+                for x, y, width, height in regions
+            ]
+            with torch.inference_mode():
+                with _pipeline_lock:
+                    images = self.pipe_pix2pix(
+                        edit_prompts,
+                        image=crops,
+                        num_inference_steps=PIX2PIX_STEPS,
+                        image_guidance_scale=1,
+                        generator=torch.Generator(self.device).manual_seed(PIX2PIX_SEED)
+                    ).images
+
+                # Paste the edited regions back
+                for edit_prompt, (x, y, width, height), edited in zip(edit_prompts, regions, images):
+                    pixels[y:y + height, x:x + width] = np.asarray(edited.resize((width, height), Image.LANCZOS))
+                    print(f"Applied edit for: {edit_prompt}")
+
+                img_pil = Image.fromarray(pixels)
+                if self.enable_refiner:
+                    img_pil = self._refine(img_pil)[0]
+                    pixels = np.asarray(img_pil)
+            # Save the result
+            task_name = "detect_inpaint_"
+            base_name, ext = os.path.splitext(image_path)
+            output_path = f"{base_name}_{task_name}{ext}"
+            is_jpeg = ext.lower() in ['.jpg', '.jpeg']
+            # TurboJPEG encodes straight from the pixel buffer when it's installed
+            encoded = encode_jpeg(pixels, OUTPUT_JPEG_QUALITY) if is_jpeg else None
+            if encoded is not None:
+                with open(output_path, 'wb') as f:
+                    f.write(encoded)
+            else:
+                img_pil.save(output_path, quality=OUTPUT_JPEG_QUALITY if is_jpeg else None,
+                             compress_level=OUTPUT_PNG_COMPRESS_LEVEL)
+            print(f"Saved edited image to {output_path}")
+            return output_path
+
+        except Exception as e:
+            print(f"Detection and inpainting error: {e}")
             return image_path
\ No newline at end of file
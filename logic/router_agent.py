@@ -1,6 +1,8 @@
-from model.gemini import generate_with_schema
+from model.gemini import generate_with_schema, generate_with_schema_async
 import enum
+import re
 import logging
+from typing import Optional
 from pydantic import BaseModel
 
 class ActionType(str, enum.Enum):
@@ -14,6 +16,42 @@ class ActionType(str, enum.Enum):
 class RouterResponse(BaseModel):
     action: ActionType
 
+ROUTER_INSTRUCTIONS = "You are a routing agent that determines the appropriate action for image editing requests. Always respond with valid JSON containing one of the specified actions."
+
+# Prompts whose intent is unmistakable are routed without calling Gemini. Exactly
+# one category has to match; prompts matching none or several go to the model.
+# Each rule may name words that make it ambiguous (leaving the prompt to the model
+# too). INFO only takes questions, so "increase the resolution" isn't answered with
+# metadata; global edits only cover what GlobalEditAgent can do; removing a tint,
+# noise or other whole-image property is not an object edit. Edits only take plain
+# instructions: questions ("is the contrast good?"), negations and undo requests
+# name an edit without asking for one.
+_NOT_AN_INSTRUCTION = (r"\?\s*$|^\s*(?:what|which|why|how|is|are|does|do|can|could|should|would|will)\b|"
+                       r"\b(?:don'?t|do not|not|never|no longer|undo|revert|reset|restore)\b")
+_LOCAL_ROUTES = (
+    (ActionType.INFO, re.compile(
+        r"\b(describe|what(?:'s| is) in|tell me about|"
+        r"(?:what|how big)(?:'s| is| are)? (?:the |its )?(?:resolution|dimensions|size|metadata|exif|histogram)|"
+        r"show (?:me )?(?:the |its )?(?:resolution|dimensions|metadata|exif|histogram))\b", re.I), None),
+    (ActionType.GLOBAL_EDIT, re.compile(
+        r"\b(brighten|brighter|darken|darker|brightness|contrast|saturation|saturate|desaturate|vibrant|"
+        r"warmer|cooler|temperature)\b", re.I), re.compile(_NOT_AN_INSTRUCTION, re.I)),
+    (ActionType.LOCAL_EDIT, re.compile(
+        r"\b(remove|delete|erase|inpaint|replace)\s+(?:the\s+|this\s+|that\s+|an?\s+)?\w+", re.I), re.compile(
+        r"\b(tint|cast|noise|grain|blur|haze|glare|colou?rs?|tones?|exposure|shadows?|highlights?|"
+        r"vignette|filter|red|green|blue|yellow|orange|purple|pink|cyan|magenta)\b|" + _NOT_AN_INSTRUCTION, re.I)),
+)
+
+def _local_route(prompt: str) -> Optional[ActionType]:
+    """Action for an obvious prompt, or None when the model has to decide"""
+    matches = []
+    for action, pattern, ambiguous in _LOCAL_ROUTES:
+        if pattern.search(prompt):
+            if ambiguous is not None and ambiguous.search(prompt):
+                return None
+            matches.append(action)
+    return matches[0] if len(matches) == 1 else None
+
 class AgentRouter:
     """Routes requests to appropriate agents based on user intent"""
     
@@ -28,7 +66,48 @@ class AgentRouter:
         
         self.logger.info(f"Routing request - Prompt: {prompt[:50]}...")
         
-        routing_prompt = f"""
+        action = _local_route(prompt)
+        if action is not None:
+            self.logger.info(f"Routing completed locally - Action determined: {action}")
+            return action
+        
+        try:
+            self.logger.info("Calling Gemini API for request routing")
+            response = generate_with_schema(
+                prompt=self._routing_prompt(prompt),
+                schema_class=RouterResponse,
+                system_instruction=ROUTER_INSTRUCTIONS
+            )
+            return self._parse_action(response)
+            
+        except Exception as e:
+            return self._routing_failed(e)
+    
+    async def route_request_async(self, image_path: str, prompt: str) -> ActionType:
+        """Async version of route_request"""
+        
+        self.logger.info(f"Routing request - Prompt: {prompt[:50]}...")
+        
+        action = _local_route(prompt)
+        if action is not None:
+            self.logger.info(f"Routing completed locally - Action determined: {action}")
+            return action
+        
+        try:
+            self.logger.info("Calling Gemini API for request routing")
+            response = await generate_with_schema_async(
+                prompt=self._routing_prompt(prompt),
+                schema_class=RouterResponse,
+                system_instruction=ROUTER_INSTRUCTIONS
+            )
+            return self._parse_action(response)
+            
+        except Exception as e:
+            return self._routing_failed(e)
+    
+    @staticmethod
+    def _routing_prompt(prompt: str) -> str:
+        return f"""
         Analyze this user request and determine the appropriate action:
         User prompt: "{prompt}"
         
@@ -47,22 +126,15 @@ class AgentRouter:
         - "Hello" -> answer
         - "Can you help me?" -> clarify
         """
-        
-        try:
-            self.logger.info("Calling Gemini API for request routing")
-            response = generate_with_schema(
-                prompt=routing_prompt,
-                schema_class=RouterResponse,
-                system_instruction="You are a routing agent that determines the appropriate action for image editing requests. Always respond with valid JSON containing one of the specified actions."
-            )
-            
-            # Parse the response as a RouterResponse object
-            router_response = RouterResponse.model_validate_json(response)
-            self.logger.info(f"Routing completed - Action determined: {router_response.action}")
-            return router_response.action
-            
-        except Exception as e:
-            self.logger.error(f"Router error: {e}", exc_info=True)
-            # Default to clarify if routing fails
-            self.logger.info("Defaulting to CLARIFY action due to routing failure")
-            return ActionType.CLARIFY
\ No newline at end of file
+    
+    def _parse_action(self, response: str) -> ActionType:
+        # Parse the response as a RouterResponse object
+        router_response = RouterResponse.model_validate_json(response)
+        self.logger.info(f"Routing completed - Action determined: {router_response.action}")
+        return router_response.action
+    
+    def _routing_failed(self, e: Exception) -> ActionType:
+        self.logger.error(f"Router error: {e}", exc_info=True)
+        # Default to clarify if routing fails
+        self.logger.info("Defaulting to CLARIFY action due to routing failure")
+        return ActionType.CLARIFY
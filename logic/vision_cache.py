@@ -0,0 +1,88 @@
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+from typing import Any, Hashable, Optional
+from PIL import Image
+
+try:
+    from cachetools import LRUCache
+except ImportError:  # cachetools is only a transitive dependency
+    LRUCache = None
+
+VISION_CACHE_SIZE = 256
+
+class _OrderedDictLRU(OrderedDict):
+    """Minimal LRU used when cachetools is not installed"""
+
+    def __init__(self, maxsize: int):
+        super().__init__()
+        self.maxsize = maxsize
+
+    def __getitem__(self, key):
+        value = super().__getitem__(key)
+        self.move_to_end(key)
+        return value
+
+    def __setitem__(self, key, value):
+        super().__setitem__(key, value)
+        self.move_to_end(key)
+        if len(self) > self.maxsize:
+            self.popitem(last=False)
+
+def image_hash(image_path: Optional[str] = None, image: Optional[Image.Image] = None,
+               data: Optional[bytes] = None) -> Optional[str]:
+    """sha256 of the image file bytes, or of the pixels for an in-memory image
+
+    Pass data when the file bytes are already in memory to avoid reading the file again.
+    Returns None when there is nothing to hash, so callers can skip the cache.
+    """
+    hasher = hashlib.sha256()
+    if image is not None:
+        hasher.update(f"{image.mode}{image.size}".encode())
+        hasher.update(image.tobytes())
+    elif data is not None:
+        hasher.update(data)
+    elif image_path and os.path.isfile(image_path):
+        # Streamed through a fixed buffer instead of reading the whole file
+        with open(image_path, 'rb') as f:
+            hasher = hashlib.file_digest(f, 'sha256')
+    else:
+        return None
+    return hasher.hexdigest()
+
+def prompt_key(image_key: str, prompt: str) -> str:
+    """Cache key for prompt-dependent results on one image"""
+    return image_key + ':' + hashlib.sha256(prompt.encode()).hexdigest()
+
+class VisionCache:
+    """Thread-safe LRU of per-image vision results (detections, analysis stats)
+
+    Shared by the agents so repeated questions about the same image skip both the
+    local computation and the Gemini round trip.
+    """
+
+    def __init__(self, maxsize: int = VISION_CACHE_SIZE):
+        self._cache = LRUCache(maxsize=maxsize) if LRUCache is not None else _OrderedDictLRU(maxsize)
+        self._lock = threading.Lock()
+
+    def get(self, key: Hashable) -> Optional[Any]:
+        with self._lock:
+            try:
+                return self._cache[key]
+            except KeyError:
+                return None
+
+    def set(self, key: Hashable, value: Any) -> None:
+        with self._lock:
+            self._cache[key] = value
+
+    def clear(self) -> None:
+        with self._lock:
+            self._cache.clear()
+
+    def __len__(self) -> int:
+        return len(self._cache)
+
+# Process-wide cache shared across agents
+vision_cache = VisionCache()
@@ -1,9 +1,60 @@
 import os
+import asyncio
 import logging
 import argparse
 from logic.assistant import ImageEditingAssistant
 from logic.router_agent import ActionType
 
+QUIT_COMMANDS = frozenset({"quit", "bye", "exit"})
+
+# Response printers return False when the response lacks the data for its action
+
+def _print_info(response) -> bool:
+    if not response.info_data:
+        return False
+    # Format and display image information
+    print(f"Assistant: {response.info_data.description}")
+    return True
+
+def _print_edit(response) -> bool:
+    if not response.edit_data:
+        return False
+    # Show global or local edit result
+    print(f"Assistant: {response.edit_data.message}")
+    print(f"[Edited image saved to: {response.edit_data.edited_image_path}]")
+    return True
+
+def _print_clarify(response) -> bool:
+    if not response.clarify_data:
+        return False
+    # Show clarification message and suggestions
+    print(f"Assistant: {response.clarify_data.message}")
+    if response.clarify_data.suggested_prompts:
+        print("Suggested prompts:")
+        for i, suggestion in enumerate(response.clarify_data.suggested_prompts, 1):
+            print(f"  {i}. {suggestion}")
+    return True
+
+def _print_nothing(response) -> bool:
+    return False
+
+def _print_fallback(response) -> None:
+    if response.error:
+        # Show error message
+        print(f"[Error] {response.error.error}")
+        if response.error.details:
+            print(f"Details: {response.error.details}")
+    else:
+        # Generic response for simple answers
+        print(f"Assistant: I'll help you with that request.")
+
+RESPONSE_PRINTERS = {
+    ActionType.INFO: _print_info,
+    ActionType.GLOBAL_EDIT: _print_edit,
+    ActionType.LOCAL_EDIT: _print_edit,
+    ActionType.CLARIFY: _print_clarify,
+}
+
 def main():
     """Simple CLI for chatting with the Image Editing Assistant and managing images."""
     
@@ -47,6 +98,10 @@ def main():
     print("  quit/bye           Exit the app")
     print("Type any other text to chat with the assistant.\n")
     
+    # One event loop for the whole session, so the async Gemini client's connections
+    # are reused between requests
+    runner = asyncio.Runner()
+    
     while True:
         try:
             user_input = input("You: ").strip()
@@ -58,12 +113,13 @@ def main():
         if not user_input:
             continue
             
-        if user_input.lower() in ["quit", "bye", "exit"]:
+        command = user_input.lower()
+        if command in QUIT_COMMANDS:
             logger.info("User requested quit")
             print("Goodbye!")
             break
             
-        elif user_input.lower().startswith("load "):
+        elif command.startswith("load "):
             path = user_input[5:].strip()
             if not os.path.isfile(path):
                 print(f"[Error] File not found: {path}")
@@ -71,57 +127,42 @@ def main():
                 loaded_image = path
                 print(f"[Loaded] {path}")
                 
-        elif user_input.lower() == "clear":
+        elif command == "clear":
             loaded_image = None
             print("[Image cleared]")
             
         else:
             try:
-                # Process request using the multi-agent system
-                response = assistant.process_request(image_path=loaded_image, prompt=user_input)
+                # Process request using the multi-agent system; an image description
+                # is printed while Gemini streams it
+                streamed = []
+                def print_chunk(text):
+                    if not streamed:
+                        print("Assistant: ", end="")
+                    streamed.append(text)
+                    print(text, end="", flush=True)
+                
+                response = runner.run(assistant.process_request_async(
+                    image_path=loaded_image, prompt=user_input, on_text=print_chunk))
+                if streamed:
+                    print()
                 
                 # Handle QUIT action from assistant
                 if response.action == ActionType.QUIT:
                     print("Goodbye!")
                     break
                 
-                # Handle different response types based on the action
-                elif response.action == ActionType.INFO and response.info_data:
-                    # Format and display image information
-                    print(f"Assistant: {response.info_data.description}")
-                    
-                elif response.action == ActionType.GLOBAL_EDIT and response.edit_data:
-                    # Show global edit result
-                    print(f"Assistant: {response.edit_data.message}")
-                    print(f"[Edited image saved to: {response.edit_data.edited_image_path}]")
-                    
-                elif response.action == ActionType.LOCAL_EDIT and response.edit_data:
-                    # Show local edit result
-                    print(f"Assistant: {response.edit_data.message}")
-                    print(f"[Edited image saved to: {response.edit_data.edited_image_path}]")
-                    
-                elif response.action == ActionType.CLARIFY and response.clarify_data:
-                    # Show clarification message and suggestions
-                    print(f"Assistant: {response.clarify_data.message}")
-                    if response.clarify_data.suggested_prompts:
-                        print("Suggested prompts:")
-                        for i, suggestion in enumerate(response.clarify_data.suggested_prompts, 1):
-                            print(f"  {i}. {suggestion}")
-                            
-                elif response.error:
-                    # Show error message
-                    print(f"[Error] {response.error.error}")
-                    if response.error.details:
-                        print(f"Details: {response.error.details}")
-                        
-                else:
-                    # Generic response for simple answers
-                    print(f"Assistant: I'll help you with that request.")
+                # Show the result for the action (unless it was just streamed), else any error
+                shown = bool(streamed) and response.info_data is not None and \
+                    response.info_data.description == "".join(streamed).strip()
+                if not shown and not RESPONSE_PRINTERS.get(response.action, _print_nothing)(response):
+                    _print_fallback(response)
                     
             except Exception as e:
                 logger.error(f"Error processing request: {e}", exc_info=True)
                 print(f"[Error] {e}")
 
+    runner.close()
     logger.info("Image Editing Assistant session ended")
 
 
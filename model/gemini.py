@@ -1,12 +1,27 @@
 import os
 import mimetypes
 import json
+import random
+import asyncio
+import hashlib
 import logging
-from pathlib import Path
-from typing import Dict, Any, Optional, Union
+import threading
+import time
+import weakref
+from io import BytesIO
+from functools import lru_cache
+import httpx
+from typing import AsyncIterator, Dict, Any, Optional, Tuple
 from dotenv import load_dotenv
+from PIL import Image
 from google import genai
-from google.genai import types
+from google.genai import types, errors
+from model.prompt_cache import prompt_cache, namespace_key
+
+try:
+    from orjson import loads as _json_loads
+except ImportError:  # orjson is optional (gradio pulls it in); the stdlib parser is the fallback
+    _json_loads = json.loads
 
 load_dotenv()
 
@@ -23,78 +38,377 @@ except Exception as e:
 
 MODEL_NAME = "gemini-2.5-flash-preview-05-20"
 
-def generate(prompt="", image=None, system_instruction="", response_schema=None, response_mime_type=None):
+_JSON_DECODER = json.JSONDecoder()
+
+# Retry policy for transient failures: rate limits (HTTP 429), server errors and timeouts
+MAX_RETRIES = 5
+RETRY_BASE_DELAY = 1.0
+RETRY_MAX_DELAY = 30.0
+RETRYABLE_STATUS_CODES = frozenset({429, 500, 502, 503, 504})
+# Distinct request configs kept prebuilt
+CONFIG_CACHE_SIZE = 32
+# Image files kept in memory as ready-to-send Parts, for repeated calls on the same path
+IMAGE_PART_CACHE_SIZE = 32
+# generate_async calls in flight at once per event loop, to stay within rate limits
+MAX_CONCURRENT_REQUESTS = 8
+
+# One semaphore per event loop: asyncio primitives can't be shared across loops,
+# and every asyncio.run() call starts a new one
+_request_slots: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, asyncio.Semaphore]" = weakref.WeakKeyDictionary()
+
+def _request_semaphore() -> asyncio.Semaphore:
+    loop = asyncio.get_running_loop()
+    semaphore = _request_slots.get(loop)
+    if semaphore is None:
+        semaphore = _request_slots[loop] = asyncio.Semaphore(MAX_CONCURRENT_REQUESTS)
+    return semaphore
+
+# Explicit context caching of long system instructions. Gemini rejects caches
+# below a minimum size, so shorter instructions keep being sent inline.
+CONTEXT_CACHE_MIN_TOKENS = 2048
+CONTEXT_CACHE_TTL = 600  # seconds
+CHARS_PER_TOKEN = 4  # rough estimate, only used to skip instructions that are clearly too short
+
+# sha256 of system instruction -> (cached content name, or None if creation failed; expiry)
+_cache_handles: Dict[str, Tuple[Optional[str], float]] = {}
+_cache_handles_lock = threading.Lock()
+
+def _is_cacheable(system_instruction) -> bool:
+    return isinstance(system_instruction, str) and \
+        len(system_instruction) >= CONTEXT_CACHE_MIN_TOKENS * CHARS_PER_TOKEN
+
+def _get_or_create_cache(system_instruction: str) -> Optional[str]:
+    """
+    Name of a cached content holding system_instruction, or None to send it inline
+
+    Handles are created on first use and their TTL is extended once they are past
+    half of it. A failed creation (e.g. the instruction is under Gemini's minimum
+    cache size after all) is remembered for one TTL so it isn't retried on every call.
+    """
+    if not _is_cacheable(system_instruction):
+        return None
+    key = hashlib.sha256(system_instruction.encode()).hexdigest()
+    ttl = f"{CONTEXT_CACHE_TTL}s"
+    with _cache_handles_lock:
+        now = time.monotonic()
+        name, expires = _cache_handles.get(key, (None, 0.0))
+        if expires > now:
+            if name is not None and expires - now < CONTEXT_CACHE_TTL / 2:
+                try:
+                    client.caches.update(name=name, config=types.UpdateCachedContentConfig(ttl=ttl))
+                    _cache_handles[key] = (name, now + CONTEXT_CACHE_TTL)
+                except Exception as e:
+                    logger.warning(f"Failed to extend context cache {name}: {e}")
+            return name
+        try:
+            cache = client.caches.create(
+                model=MODEL_NAME,
+                config=types.CreateCachedContentConfig(system_instruction=system_instruction, ttl=ttl)
+            )
+            logger.info(f"Created context cache {cache.name} for a {len(system_instruction)} character system instruction")
+            _cache_handles[key] = (cache.name, now + CONTEXT_CACHE_TTL)
+            return cache.name
+        except Exception as e:
+            logger.warning(f"Context caching unavailable, sending system instruction inline: {e}")
+            _cache_handles[key] = (None, now + CONTEXT_CACHE_TTL)
+            return None
+
+def _use_context_cache(config: Optional[types.GenerateContentConfig]) -> Optional[types.GenerateContentConfig]:
+    """Swap a long system instruction in config for a reference to its cached content"""
+    if config is None or not _is_cacheable(config.system_instruction):
+        return config
+    name = _get_or_create_cache(config.system_instruction)
+    if name is None:
+        return config
+    return config.model_copy(update={'system_instruction': None, 'cached_content': name})
+
+def _log_usage(response) -> None:
+    usage = getattr(response, "usage_metadata", None)
+    if usage is not None and usage.cached_content_token_count:
+        logger.info(f"Gemini reused {usage.cached_content_token_count} cached prompt tokens")
+
+def _is_retryable(e: Exception) -> bool:
+    if isinstance(e, errors.APIError):
+        return e.code in RETRYABLE_STATUS_CODES
+    return isinstance(e, httpx.TimeoutException)
+
+def _retry_delay(attempt: int) -> float:
+    """Exponential backoff with jitter, capped at RETRY_MAX_DELAY"""
+    return min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * (2 ** attempt) + random.uniform(0, RETRY_BASE_DELAY))
+
+@lru_cache(maxsize=IMAGE_PART_CACHE_SIZE)
+def _load_image(path: str, mtime_ns: int, size: int) -> types.Part:
+    """Read an image file into a Part; mtime and size are part of the key so a changed file is read again"""
+    # Get the MIME type of the image
+    mime_type, _ = mimetypes.guess_type(path)
+    if not mime_type or not mime_type.startswith('image/'):
+        raise ValueError(f"File is not a recognized image format: {path}")
+    
+    # Read the image file as bytes
+    with open(path, 'rb') as f:
+        image_data = f.read()
+    
+    logger.info(f"Image loaded successfully - MIME type: {mime_type}, Size: {len(image_data)} bytes")
+    
+    # Create image part for Gemini API
+    return types.Part.from_bytes(mime_type=mime_type, data=image_data)
+
+def _image_part(path: str) -> types.Part:
+    """Part for an image path, read from disk only when the file is new or has changed"""
+    logger.info(f"Processing image: {path}")
+    # Check if the image file exists
+    if not os.path.isfile(path):
+        raise FileNotFoundError(f"Image file not found: {path}")
+    stat = os.stat(path)
+    return _load_image(path, stat.st_mtime_ns, stat.st_size)
+
+def _pil_part(image: Image.Image) -> types.Part:
+    """Encode an in-memory image as a PNG inline_data part, as the SDK does for PIL images"""
+    buffer = BytesIO()
+    image.save(buffer, format="PNG")
+    return types.Part.from_bytes(mime_type="image/png", data=buffer.getvalue())
+
+def _build_request(prompt="", image=None, system_instruction="", response_schema=None, response_mime_type=None):
+    """Build the contents list and config shared by the sync and async generate calls"""
+    # Create contents list based on whether image is provided
+    contents = []
+    
+    # Load image if provided
+    if isinstance(image, Image.Image):
+        # In-memory image - the SDK encodes it directly, no file round trip
+        logger.info(f"Processing in-memory image - Size: {image.size}, Mode: {image.mode}")
+        contents.append(image)
+    elif isinstance(image, types.Part):
+        # Caller already holds the encoded bytes
+        contents.append(image)
+    elif image is not None:
+        contents.append(_image_part(image))
+        
+    # Add text prompt if provided
+    if prompt:
+        contents.append(prompt)
+    
+    # Ensure contents list is not empty
+    if not contents:
+        raise ValueError("Either prompt or image must be provided")
+    
+    # Create config with optional structured output
+    if response_schema:
+        logger.info("Using structured output with response schema")
+    try:
+        config = _make_config(system_instruction, response_schema, response_mime_type)
+    except TypeError:  # unhashable schema (e.g. a dict); build it every time
+        config = _make_config.__wrapped__(system_instruction, response_schema, response_mime_type)
+    return contents, config
+
+@lru_cache(maxsize=CONFIG_CACHE_SIZE)
+def _make_config(system_instruction, response_schema, response_mime_type) -> Optional[types.GenerateContentConfig]:
+    """
+    Config for one (system instruction, schema, MIME type) combination
+    
+    Agents send the same few combinations on every turn, so each config is built
+    and validated once and then shared. Callers must copy it before changing it.
+    """
+    config_kwargs = {}
+    if system_instruction:
+        config_kwargs['system_instruction'] = system_instruction
+    if response_schema:
+        config_kwargs['response_schema'] = response_schema
+    if response_mime_type:
+        config_kwargs['response_mime_type'] = response_mime_type
+        
+    return types.GenerateContentConfig(**config_kwargs) if config_kwargs else None
+
+def _cache_lookup(prompt, image, system_instruction, response_schema, response_mime_type):
+    """Return (namespace, semantic, cached reply or None) for a generate call
+
+    With the opt-in semantic layer, free-form replies may be reused for near-duplicate
+    prompts; structured ones (edit parameters, routing, detections) only ever for the
+    exact same prompt, since "brighter" and "darker" read alike but must not share an answer.
+    """
+    namespace = namespace_key(MODEL_NAME, image, system_instruction, response_schema, response_mime_type)
+    semantic = response_schema is None and response_mime_type is None
+    cached = prompt_cache.get(namespace, prompt or "", semantic=semantic)
+    if cached is not None:
+        logger.info("Returning cached Gemini response")
+    return namespace, semantic, cached
+
+def generate(prompt="", image=None, system_instruction="", response_schema=None, response_mime_type=None,
+             no_cache=False):
     """
     Generate content using Gemini API with support for structured output
     
+    Replies are cached by prompt, image and config (see model.prompt_cache). System
+    instructions long enough for Gemini context caching are sent as a cached content reference.
+    
     Args:
         prompt: Text prompt
-        image: Path to image file or None
+        image: Path to image file, in-memory PIL Image, types.Part, or None
         system_instruction: System instruction for the model
         response_schema: Pydantic model for structured output
         response_mime_type: MIME type for response (e.g., 'application/json')
+        no_cache: Always call Gemini and don't store the reply (e.g. for sensitive prompts)
+    
+    Rate limits (HTTP 429), server errors (5xx) and timeouts are retried with exponential
+    backoff; any other error, or the last one once retries run out, is raised.
     """
     logger.info(f"Starting Gemini API call - Model: {MODEL_NAME}, Has image: {image is not None}, Prompt length: {len(prompt) if prompt else 0}")
     
+    if isinstance(image, str):
+        # The cache key and the request both use the file's bytes; read them once
+        image = _image_part(image)
+    if not no_cache:
+        namespace, semantic, cached = _cache_lookup(prompt, image, system_instruction, response_schema, response_mime_type)
+        if cached is not None:
+            return cached
+    
+    contents, config = _build_request(prompt, image, system_instruction, response_schema, response_mime_type)
+    config = _use_context_cache(config)
+    
+    for attempt in range(MAX_RETRIES + 1):
+        try:
+            logger.info("Making API call to Gemini")
+            response = client.models.generate_content(
+                model=MODEL_NAME,
+                contents=contents,
+                config=config
+            )
+            break
+        except Exception as e:
+            if not _is_retryable(e) or attempt == MAX_RETRIES:
+                logger.error(f"Gemini API call failed: {e}", exc_info=True)
+                raise
+            delay = _retry_delay(attempt)
+            logger.warning(f"Gemini API call failed ({e}), retrying in {delay:.1f}s (attempt {attempt + 1}/{MAX_RETRIES})")
+            time.sleep(delay)
+    
+    _log_usage(response)
+    logger.info(f"Gemini API call completed successfully - Response length: {len(response.text) if response.text else 0}")
+    if not no_cache and response.text:
+        prompt_cache.set(namespace, prompt or "", response.text, semantic=semantic)
+    return response.text
+
+async def generate_async(prompt="", image=None, system_instruction="", response_schema=None, response_mime_type=None,
+                         no_cache=False):
+    """
+    Async version of generate using the client's aio interface
+    
+    Many calls can be awaited concurrently (e.g. with asyncio.gather); at most
+    MAX_CONCURRENT_REQUESTS are sent at a time. Arguments, retries and errors are
+    the same as generate.
+    """
+    logger.info(f"Starting async Gemini API call - Model: {MODEL_NAME}, Has image: {image is not None}, Prompt length: {len(prompt) if prompt else 0}")
+    
+    if isinstance(image, str):
+        image = await asyncio.to_thread(_image_part, image)
+    if not no_cache:
+        # Hashing the image and embedding the prompt are CPU work; keep them off the event loop
+        namespace, semantic, cached = await asyncio.to_thread(
+            _cache_lookup, prompt, image, system_instruction, response_schema, response_mime_type)
+        if cached is not None:
+            return cached
+    
+    if isinstance(image, Image.Image):
+        # The SDK would encode it inside the call, blocking the event loop
+        image = await asyncio.to_thread(_pil_part, image)
+    contents, config = _build_request(prompt, image, system_instruction, response_schema, response_mime_type)
+    if _is_cacheable(system_instruction):
+        # Creating or extending the cache is a blocking API call
+        config = await asyncio.to_thread(_use_context_cache, config)
+    
+    for attempt in range(MAX_RETRIES + 1):
+        try:
+            async with _request_semaphore():
+                response = await client.aio.models.generate_content(
+                    model=MODEL_NAME,
+                    contents=contents,
+                    config=config
+                )
+            break
+        except Exception as e:
+            if not _is_retryable(e) or attempt == MAX_RETRIES:
+                logger.error(f"Async Gemini API call failed: {e}", exc_info=True)
+                raise
+            delay = _retry_delay(attempt)
+            logger.warning(f"Gemini API call failed ({e}), retrying in {delay:.1f}s (attempt {attempt + 1}/{MAX_RETRIES})")
+            await asyncio.sleep(delay)
+    
+    _log_usage(response)
+    logger.info(f"Async Gemini API call completed successfully - Response length: {len(response.text) if response.text else 0}")
+    if not no_cache and response.text:
+        await asyncio.to_thread(prompt_cache.set, namespace, prompt or "", response.text, semantic)
+    return response.text
+
+async def generate_stream_async(prompt="", image=None, system_instruction="", no_cache=False) -> AsyncIterator[str]:
+    """
+    Async generator over the text of a free-form reply, chunk by chunk as Gemini produces it
+    
+    For replies shown to the user while they arrive; structured output has to be parsed
+    whole, so there is no schema argument. A cached reply comes back as a single chunk
+    and a complete reply is cached like generate's. Failures before the first chunk
+    are retried as in generate; errors mid-stream are raised.
+    """
+    logger.info(f"Starting streaming Gemini API call - Model: {MODEL_NAME}, Has image: {image is not None}, Prompt length: {len(prompt) if prompt else 0}")
+    
+    if isinstance(image, str):
+        image = await asyncio.to_thread(_image_part, image)
+    if not no_cache:
+        namespace, semantic, cached = await asyncio.to_thread(
+            _cache_lookup, prompt, image, system_instruction, None, None)
+        if cached is not None:
+            yield cached
+            return
+    
+    if isinstance(image, Image.Image):
+        image = await asyncio.to_thread(_pil_part, image)
+    contents, config = _build_request(prompt, image, system_instruction)
+    if _is_cacheable(system_instruction):
+        config = await asyncio.to_thread(_use_context_cache, config)
+    
+    # A slot is taken per attempt, so backing off between attempts doesn't hold one
+    # idle; the successful attempt keeps its slot until the stream is read to the end
+    semaphore = _request_semaphore()
+    for attempt in range(MAX_RETRIES + 1):
+        await semaphore.acquire()
+        try:
+            stream = await client.aio.models.generate_content_stream(
+                model=MODEL_NAME,
+                contents=contents,
+                config=config
+            )
+            # The request only fails once the stream is read
+            chunk = await anext(stream, None)
+            break
+        except BaseException as e:
+            # Failed or cancelled, this attempt's slot goes back either way
+            semaphore.release()
+            if not isinstance(e, Exception):
+                raise
+            if not _is_retryable(e) or attempt == MAX_RETRIES:
+                logger.error(f"Streaming Gemini API call failed: {e}", exc_info=True)
+                raise
+            delay = _retry_delay(attempt)
+            logger.warning(f"Gemini API call failed ({e}), retrying in {delay:.1f}s (attempt {attempt + 1}/{MAX_RETRIES})")
+            await asyncio.sleep(delay)
+    
     try:
-        # Create contents list based on whether image is provided
-        contents = []
-        
-        # Load image if provided
-        if image is not None:
-            logger.info(f"Processing image: {image}")
-            # Check if the image file exists
-            if not os.path.isfile(image):
-                raise FileNotFoundError(f"Image file not found: {image}")
-                
-            # Get the MIME type of the image
-            mime_type, _ = mimetypes.guess_type(image)
-            if not mime_type or not mime_type.startswith('image/'):
-                raise ValueError(f"File is not a recognized image format: {image}")
-                
-            # Read the image file as bytes
-            with open(image, 'rb') as f:
-                image_data = f.read()
-                
-            logger.info(f"Image loaded successfully - MIME type: {mime_type}, Size: {len(image_data)} bytes")
-            
-            # Create image part for Gemini API
-            image_part = types.Part.from_bytes(mime_type=mime_type, data=image_data)
-            contents.append(image_part)
-            
-        # Add text prompt if provided
-        if prompt:
-            contents.append(prompt)
-        
-        # Ensure contents list is not empty
-        if not contents:
-            raise ValueError("Either prompt or image must be provided")
-        
-        # Create config with optional structured output
-        config_kwargs = {}
-        if system_instruction:
-            config_kwargs['system_instruction'] = system_instruction
-        if response_schema:
-            config_kwargs['response_schema'] = response_schema
-            logger.info("Using structured output with response schema")
-        if response_mime_type:
-            config_kwargs['response_mime_type'] = response_mime_type
-            
-        config = types.GenerateContentConfig(**config_kwargs) if config_kwargs else None
-        
-        logger.info("Making API call to Gemini")
-        response = client.models.generate_content(
-            model=MODEL_NAME,
-            contents=contents,
-            config=config
-        )
-        
-        logger.info(f"Gemini API call completed successfully - Response length: {len(response.text) if response.text else 0}")
-        return response.text
-        
-    except Exception as e:
-        logger.error(f"Gemini API call failed: {e}", exc_info=True)
-        return str(e)
+        text = []
+        last = chunk
+        while chunk is not None:
+            if chunk.text:
+                text.append(chunk.text)
+                yield chunk.text
+            last = chunk
+            chunk = await anext(stream, None)
+    finally:
+        semaphore.release()
+    
+    # Usage totals arrive with the last chunk
+    if last is not None:
+        _log_usage(last)
+    logger.info(f"Streaming Gemini API call completed successfully - Response length: {sum(map(len, text))}")
+    if not no_cache and text:
+        await asyncio.to_thread(prompt_cache.set, namespace, prompt or "", "".join(text), semantic)
 
 def create_chat_session(model=MODEL_NAME):
     """Create a new chat session"""
@@ -103,35 +417,58 @@ def create_chat_session(model=MODEL_NAME):
     except Exception as e:
         raise ValueError(f"Failed to create chat session: {e}")
 
-def generate_with_schema(prompt="", image=None, schema_class=None, system_instruction=""):
+def generate_with_schema(prompt="", image=None, schema_class=None, system_instruction="", no_cache=False):
     """
     Generate structured output using a Pydantic schema
     
     Args:
         prompt: Text prompt
-        image: Path to image file or None
+        image: Path to image file, in-memory PIL Image, types.Part, or None
         schema_class: Pydantic model class for structured output
         system_instruction: System instruction for the model
+        no_cache: Bypass the reply cache
     """
     return generate(
         prompt=prompt,
         image=image,
         system_instruction=system_instruction,
         response_schema=schema_class,
-        response_mime_type='application/json'
+        response_mime_type='application/json',
+        no_cache=no_cache
+    )
+
+async def generate_with_schema_async(prompt="", image=None, schema_class=None, system_instruction="", no_cache=False):
+    """Async version of generate_with_schema"""
+    return await generate_async(
+        prompt=prompt,
+        image=image,
+        system_instruction=system_instruction,
+        response_schema=schema_class,
+        response_mime_type='application/json',
+        no_cache=no_cache
     )
 
 def parse_json_response(response_text: str) -> Dict[str, Any]:
-    """Parse JSON response with error handling"""
+    """Parse JSON response with error handling
+    
+    A reply that isn't JSON as a whole yields the first JSON object embedded in it.
+    """
+    text = response_text.strip()
     try:
-        return json.loads(response_text.strip())
-    except json.JSONDecodeError as e:
-        # Try to extract JSON from response if it's wrapped in other text
-        import re
-        json_match = re.search(r'\{.*\}', response_text, re.DOTALL)
-        if json_match:
-            try:
-                return json.loads(json_match.group())
-            except json.JSONDecodeError:
-                pass
-        raise ValueError(f"Failed to parse JSON response: {e}")
\ No newline at end of file
+        return _json_loads(text)
+    except ValueError as e:
+        error = e
+    
+    # Try to extract JSON from response if it's wrapped in other text. Decoding from
+    # each "{" in turn stops at the end of the first complete object, with none of
+    # the backtracking a greedy regex does on long replies
+    start = text.find('{')
+    while start != -1:
+        try:
+            obj, _ = _JSON_DECODER.raw_decode(text, start)
+            if isinstance(obj, dict):
+                return obj
+        except json.JSONDecodeError:
+            pass
+        start = text.find('{', start + 1)
+    raise ValueError(f"Failed to parse JSON response: {error}")
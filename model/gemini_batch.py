@@ -0,0 +1,98 @@
+import time
+import logging
+from typing import List, Optional
+from PIL import Image
+from google.genai import types
+from model.gemini import client, MODEL_NAME, _build_request, _pil_part
+
+# Initialize logging
+logger = logging.getLogger(__name__)
+
+# Seconds between batch.state polls and the default overall wait. Batch jobs
+# trade latency for throughput, so they can take minutes (or hours) to finish.
+BATCH_POLL_INTERVAL = 10.0
+BATCH_TIMEOUT = 24 * 60 * 60
+
+COMPLETED_STATES = {
+    types.JobState.JOB_STATE_SUCCEEDED,
+    types.JobState.JOB_STATE_FAILED,
+    types.JobState.JOB_STATE_CANCELLED,
+    types.JobState.JOB_STATE_EXPIRED,
+}
+
+def build_inline_request(prompt="", image=None, system_instruction="", response_schema=None,
+                         response_mime_type=None, response_modalities=None,
+                         model=MODEL_NAME) -> types.InlinedRequest:
+    """
+    Build one batch entry with the same contents/config a generate() call would send
+
+    Args:
+        prompt: Text prompt
+        image: Path to image file, in-memory PIL Image, or None
+        response_modalities: e.g. ['TEXT', 'IMAGE'] for image generation entries
+        model: Model the entry is addressed to
+    """
+    if isinstance(image, Image.Image):
+        # Batch requests carry raw bytes, not PIL objects
+        image = _pil_part(image)
+    contents, config = _build_request(
+        prompt,
+        None if isinstance(image, types.Part) else image,
+        system_instruction,
+        response_schema,
+        response_mime_type
+    )
+    if isinstance(image, types.Part):
+        contents.insert(0, image)
+    if response_modalities:
+        # The config from _build_request is shared; extend a copy
+        config = config.model_copy(update={'response_modalities': response_modalities}) if config \
+            else types.GenerateContentConfig(response_modalities=response_modalities)
+    return types.InlinedRequest(model=model, contents=contents, config=config)
+
+def submit_batch(requests: List[types.InlinedRequest], model=MODEL_NAME, display_name=None) -> str:
+    """Submit inline requests as one batch prediction job and return the job name"""
+    if not hasattr(client, "batches"):
+        raise RuntimeError("Batch prediction needs a google-genai release with client.batches")
+    if not requests:
+        raise ValueError("At least one request is required")
+
+    config = types.CreateBatchJobConfig(display_name=display_name) if display_name else None
+    job = client.batches.create(model=model, src=requests, config=config)
+    logger.info(f"Submitted Gemini batch job {job.name} with {len(requests)} requests")
+    return job.name
+
+def wait_for_batch(name: str, poll_interval: float = BATCH_POLL_INTERVAL,
+                   timeout: float = BATCH_TIMEOUT) -> types.BatchJob:
+    """Poll a batch job until it reaches a terminal state"""
+    deadline = time.monotonic() + timeout
+    while True:
+        job = client.batches.get(name=name)
+        if job.state in COMPLETED_STATES:
+            logger.info(f"Gemini batch job {name} finished with state {job.state}")
+            return job
+        if time.monotonic() >= deadline:
+            raise TimeoutError(f"Gemini batch job {name} did not finish within {timeout}s (state {job.state})")
+        time.sleep(poll_interval)
+
+def run_batch(requests: List[types.InlinedRequest], model=MODEL_NAME, display_name=None,
+              poll_interval: float = BATCH_POLL_INTERVAL,
+              timeout: float = BATCH_TIMEOUT) -> List[Optional[types.GenerateContentResponse]]:
+    """
+    Submit requests as one batch, wait for it and return the responses in request order
+
+    Entries that failed individually come back as None.
+    """
+    job = wait_for_batch(submit_batch(requests, model, display_name), poll_interval, timeout)
+    if job.state != types.JobState.JOB_STATE_SUCCEEDED:
+        raise RuntimeError(f"Gemini batch job {job.name} ended with state {job.state}: {job.error}")
+
+    inlined = (job.dest.inlined_responses if job.dest else None) or []
+    responses = []
+    for entry in inlined:
+        if entry.error:
+            logger.error(f"Batch entry failed: {entry.error}")
+        responses.append(entry.response if not entry.error else None)
+    # Pad so callers can always zip responses with their requests
+    responses.extend([None] * (len(requests) - len(responses)))
+    return responses
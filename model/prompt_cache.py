@@ -0,0 +1,147 @@
+import hashlib
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Optional
+import numpy as np
+from PIL import Image
+from google.genai import types
+
+# Initialize logging
+logger = logging.getLogger(__name__)
+
+PROMPT_CACHE_SIZE = 512
+PROMPT_CACHE_TTL = 60 * 60  # seconds
+# Cosine similarity above which two free-form prompts count as the same question
+SEMANTIC_THRESHOLD = 0.92
+# The semantic layer is opt-in (SEMANTIC_PROMPT_CACHE=1): a near paraphrase such as
+# "how many people..." / "how many dogs..." can clear the threshold and get the wrong
+# answer, and the embedding model is loaded (possibly downloaded) on first use
+SEMANTIC_CACHE_ENABLED = os.getenv("SEMANTIC_PROMPT_CACHE", "").lower() in ("1", "true", "yes")
+EMBEDDING_MODEL = "sentence-transformers/all-MiniLM-L6-v2"
+
+def image_digest(image) -> str:
+    """sha256 of what an image argument to generate() sends: Part bytes, PIL pixels or file bytes"""
+    hasher = hashlib.sha256()
+    if isinstance(image, types.Part) and image.inline_data is not None:
+        hasher.update(image.inline_data.data)
+    elif isinstance(image, Image.Image):
+        hasher.update(f"{image.mode}{image.size}".encode())
+        hasher.update(image.tobytes())
+    elif image is not None and os.path.isfile(image):
+        # Streamed through a fixed buffer instead of reading the whole file
+        with open(image, 'rb') as f:
+            hasher = hashlib.file_digest(f, 'sha256')
+    elif image is not None:
+        # Missing file: generate() fails before calling Gemini, nothing gets cached
+        hasher.update(str(image).encode())
+    return hasher.hexdigest()
+
+def namespace_key(model: str, image=None, system_instruction="", response_schema=None,
+                  response_mime_type=None) -> str:
+    """Everything but the prompt that shapes a reply; only prompts in the same namespace can match"""
+    schema_name = getattr(response_schema, "__name__", None) or str(response_schema)
+    parts = (model, image_digest(image) if image is not None else "", system_instruction or "",
+             schema_name, response_mime_type or "")
+    return hashlib.sha256("\0".join(parts).encode()).hexdigest()
+
+class PromptCache:
+    """Thread-safe TTL/LRU cache of Gemini replies with an optional semantic layer
+
+    Exact hits are keyed by (namespace, prompt). When the semantic layer is enabled,
+    lookups with semantic=True also match earlier prompts in the same namespace whose
+    sentence embedding is within the cosine threshold, so rephrasings like "describe
+    this" / "what's in this image" share one reply. Embeddings come from
+    sentence-transformers, loaded by warmup() or on first use; without it only exact
+    matching is done.
+    """
+
+    def __init__(self, maxsize: int = PROMPT_CACHE_SIZE, ttl: float = PROMPT_CACHE_TTL,
+                 threshold: float = SEMANTIC_THRESHOLD, semantic_enabled: bool = SEMANTIC_CACHE_ENABLED):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.threshold = threshold
+        self.semantic_enabled = semantic_enabled
+        # (namespace, prompt) -> (expires, embedding or None, reply text)
+        self._entries: "OrderedDict[tuple, tuple]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._embedder = None
+        self._embedder_lock = threading.Lock()
+
+    def _embed(self, prompt: str) -> Optional[np.ndarray]:
+        with self._embedder_lock:
+            if self._embedder is None:
+                try:
+                    from sentence_transformers import SentenceTransformer
+                    self._embedder = SentenceTransformer(EMBEDDING_MODEL)
+                except Exception as e:
+                    logger.warning(f"Semantic prompt cache disabled, could not load {EMBEDDING_MODEL}: {e}")
+                    self._embedder = False
+            embedder = self._embedder
+        if not embedder:
+            return None
+        return embedder.encode(prompt, normalize_embeddings=True).astype(np.float32)
+
+    def warmup(self) -> None:
+        """Load the embedding model up front instead of inside the first request"""
+        if self.semantic_enabled:
+            self._embed("")
+
+    def _evict_expired(self, now: float) -> None:
+        for key in [key for key, (expires, _, _) in self._entries.items() if expires <= now]:
+            del self._entries[key]
+
+    def get(self, namespace: str, prompt: str, semantic: bool = False) -> Optional[str]:
+        semantic = semantic and self.semantic_enabled
+        now = time.monotonic()
+        key = (namespace, prompt)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] > now:
+                self._entries.move_to_end(key)
+                return entry[2]
+            if entry is not None:
+                del self._entries[key]
+            if not semantic:
+                return None
+            candidates = [(k, e) for k, e in self._entries.items()
+                          if k[0] == namespace and e[1] is not None and e[0] > now]
+        if not candidates:
+            return None
+
+        embedding = self._embed(prompt)
+        if embedding is None:
+            return None
+        similarities = np.stack([e[1] for _, e in candidates]) @ embedding
+        best = int(np.argmax(similarities))
+        if similarities[best] < self.threshold:
+            return None
+        best_key, best_entry = candidates[best]
+        logger.info(f"Semantic prompt cache hit (similarity {similarities[best]:.3f})")
+        with self._lock:
+            if best_key in self._entries:
+                self._entries.move_to_end(best_key)
+        return best_entry[2]
+
+    def set(self, namespace: str, prompt: str, text: str, semantic: bool = False) -> None:
+        embedding = self._embed(prompt) if semantic and self.semantic_enabled else None
+        now = time.monotonic()
+        with self._lock:
+            self._entries[(namespace, prompt)] = (now + self.ttl, embedding, text)
+            self._entries.move_to_end((namespace, prompt))
+            if len(self._entries) > self.maxsize:
+                self._evict_expired(now)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+# Process-wide cache used by model.gemini
+prompt_cache = PromptCache()
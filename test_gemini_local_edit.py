@@ -5,6 +5,7 @@ Test script for the Gemini Local Edit Agent
 
 import os
 import sys
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 from dotenv import load_dotenv
 
@@ -16,9 +17,32 @@ sys.path.insert(0, str(project_root))
 load_dotenv()
 
 from logic.gemini_local_edit_agent import GeminiLocalEditAgent
+from logic.image_context import ImageContext
 
-def test_gemini_local_edit():
-    """Test the Gemini local edit agent with a sample image"""
+# Prompts sent to Gemini at once when running them all
+MAX_WORKERS = 4
+
+# Extensions a test image may have, most preferred first
+TEST_IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.bmp')
+
+def find_test_image(test_images_dir):
+    """First image in test_images_dir with the most preferred extension, from one directory scan"""
+    rank = {ext: i for i, ext in enumerate(TEST_IMAGE_EXTENSIONS)}
+    if not test_images_dir.is_dir():
+        return None
+    candidates = [p for p in test_images_dir.iterdir() if p.suffix in rank and not p.name.startswith('.')]
+    # min keeps directory order among equally ranked files, as the per-extension glob did
+    return str(min(candidates, key=lambda p: rank[p.suffix])) if candidates else None
+
+def attempt(fn, *args):
+    """(result, None), or (None, exception) if fn raised"""
+    try:
+        return fn(*args), None
+    except Exception as e:
+        return None, e
+
+def test_gemini_local_edit(run_all=False):
+    """Test the Gemini local edit agent with a sample image; run_all tries every prompt, not just the first"""
     
     # Check if GEMINI_API_KEY is set
     if not os.getenv("GEMINI_API_KEY"):
@@ -37,13 +61,7 @@ def test_gemini_local_edit():
     test_images_dir = project_root / "test_images"
     
     # Look for test images
-    test_image = None
-    for ext in ['.jpg', '.jpeg', '.png', '.bmp']:
-        for img_file in test_images_dir.glob(f"*{ext}"):
-            test_image = str(img_file)
-            break
-        if test_image:
-            break
+    test_image = find_test_image(test_images_dir)
     
     if not test_image:
         print("No test images found in test_images directory")
@@ -61,34 +79,44 @@ def test_gemini_local_edit():
         "Make the sky more dramatic with clouds"
     ]
     
-    for i, prompt in enumerate(test_prompts):
+    # Only run one test by default to avoid API quota issues
+    prompts = test_prompts if run_all else test_prompts[:1]
+    # One shared context, decoded up front so the worker threads only read it
+    ctx = ImageContext.from_path(test_image)
+    ctx.pil_image.load()
+    base_name, ext = os.path.splitext(test_image)
+    
+    def edit(i, prompt):
+        # Concurrent edits would all write <image>_gemini_edited; give each its own name
+        # (with a context, the path only names the output)
+        image_path = f"{base_name}_test{i+1}{ext}" if run_all else test_image
+        return agent.process_local_edit(image_path, prompt, ctx)
+    
+    # The Gemini calls are I/O-bound, so the prompts run side by side
+    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as pool:
+        results = list(pool.map(lambda args: attempt(edit, *args), enumerate(prompts)))
+    
+    for i, (prompt, (result, error)) in enumerate(zip(prompts, results)):
         print(f"\n--- Test {i+1}: {prompt} ---")
         
-        try:
-            # Process the local edit request
-            result = agent.process_local_edit(test_image, prompt)
-            
-            print(f"✓ Edit completed")
-            print(f"  Original image: {test_image}")
-            print(f"  Edited image: {result['edited_image_path']}")
-            print(f"  Detected objects: {len(result['detected_objects'])}")
-            print(f"  Message: {result['message']}")
-            
-            # Print detected objects
-            for j, obj in enumerate(result['detected_objects']):
-                print(f"    Object {j+1}: {obj.label} (confidence: {obj.confidence:.3f})")
-            
-        except Exception as e:
-            print(f"✗ Test failed: {e}")
+        if error is not None:
+            print(f"✗ Test failed: {error}")
             continue
         
-        # Only run one test for now to avoid API quota issues
-        break
+        print(f"✓ Edit completed")
+        print(f"  Original image: {test_image}")
+        print(f"  Edited image: {result['edited_image_path']}")
+        print(f"  Detected objects: {len(result['detected_objects'])}")
+        print(f"  Message: {result['message']}")
+        
+        # Print detected objects
+        for j, obj in enumerate(result['detected_objects']):
+            print(f"    Object {j+1}: {obj.label} (confidence: {obj.confidence:.3f})")
     
     return True
 
-def test_object_detection_only():
-    """Test only the object detection functionality"""
+def test_object_detection_only(run_all=False):
+    """Test only the object detection functionality; run_all tries every prompt, not just the first"""
     
     if not os.getenv("GEMINI_API_KEY"):
         print("Error: GEMINI_API_KEY environment variable not set")
@@ -103,13 +131,7 @@ def test_object_detection_only():
     
     # Find test image
     test_images_dir = project_root / "test_images"
-    test_image = None
-    for ext in ['.jpg', '.jpeg', '.png', '.bmp']:
-        for img_file in test_images_dir.glob(f"*{ext}"):
-            test_image = str(img_file)
-            break
-        if test_image:
-            break
+    test_image = find_test_image(test_images_dir)
     
     if not test_image:
         print("No test images found")
@@ -125,35 +147,41 @@ def test_object_detection_only():
         "Find faces in the image"
     ]
     
-    for prompt in detection_prompts:
+    # Only run one detection test by default
+    prompts = detection_prompts if run_all else detection_prompts[:1]
+    ctx = ImageContext.from_path(test_image)
+    ctx.pil_image.load()
+    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as pool:
+        results = list(pool.map(
+            lambda prompt: attempt(agent._detect_objects_with_gemini, test_image, prompt, ctx), prompts))
+    
+    for prompt, (detected_objects, error) in zip(prompts, results):
         print(f"\n--- Detection Test: {prompt} ---")
         
-        try:
-            detected_objects = agent._detect_objects_with_gemini(test_image, prompt)
-            print(f"✓ Detected {len(detected_objects)} objects")
-            
-            for i, obj in enumerate(detected_objects):
-                print(f"  {i+1}. {obj.label} at ({obj.x1}, {obj.y1}, {obj.x2}, {obj.y2}) - confidence: {obj.confidence:.3f}")
-                
-        except Exception as e:
-            print(f"✗ Detection failed: {e}")
+        if error is not None:
+            print(f"✗ Detection failed: {error}")
+            continue
         
-        # Only run one detection test
-        break
+        print(f"✓ Detected {len(detected_objects)} objects")
+        for i, obj in enumerate(detected_objects):
+            print(f"  {i+1}. {obj.label} at ({obj.x1}, {obj.y1}, {obj.x2}, {obj.y2}) - confidence: {obj.confidence:.3f}")
     
     return True
 
 if __name__ == "__main__":
+    # --all runs every prompt (concurrently) instead of one, at the cost of more API calls
+    run_all = "--all" in sys.argv[1:]
+    
     print("=== Gemini Local Edit Agent Test ===\n")
     
     # Test object detection first
     print("1. Testing object detection...")
-    test_object_detection_only()
+    test_object_detection_only(run_all)
     
     print("\n" + "="*50 + "\n")
     
     # Test full local edit functionality
     print("2. Testing full local edit...")
-    test_gemini_local_edit()
+    test_gemini_local_edit(run_all)
     
     print("\n=== Test completed ===")
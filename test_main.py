@@ -1,31 +1,105 @@
 import os
-from logic.assistant import ImageEditingAssistant
+import sys
+from pathlib import Path
+from logic.image_context import ImageContext
+
+try:
+    import pytest
+except ImportError:  # pytest is optional; `python test_main.py` runs the demo without it
+    pytest = None
+
+TEST_IMAGE = "test_images/test.png"
+TEST_REQUESTS = [
+    ("What's in this image?", "Image Analysis"),
+    ("Make it brighter and more vibrant", "Global Edit - Brightness & Saturation"),
+    ("Remove the person in the background", "Local Edit - Object Removal"),
+    ("Add more contrast and make it warmer", "Global Edit - Contrast & Temperature"),
+]
 
 def run_tests():
     """Run demo/test requests for the Image Editing Assistant."""
+    from logic.assistant import ImageEditingAssistant
     assistant = ImageEditingAssistant()
-    image_path = "test_images/test.png"
-    if not os.path.exists(image_path):
+    # Keep one-time model setup out of the first request
+    assistant.warmup()
+    image_path = TEST_IMAGE
+    if not Path(image_path).is_file():
         print(f"Warning: {image_path} not found. Using placeholder for demonstration.")
         image_path = "placeholder.jpg"  # You'll need to provide an actual image
     print("=== Image Editing Assistant Demo ===\n")
-    test_requests = [
-        ("What's in this image?", "Image Analysis"),
-        ("Make it brighter and more vibrant", "Global Edit - Brightness & Saturation"),
-        ("Remove the person in the background", "Local Edit - Object Removal"),
-        ("Add more contrast and make it warmer", "Global Edit - Contrast & Temperature"),
+    # One shared image load; the requests run concurrently
+    results = assistant.process_batch(image_path, [prompt for prompt, _ in TEST_REQUESTS])
+    # Results are all in by now, so the report goes out in a single write
+    lines = []
+    for (prompt, description), result in zip(TEST_REQUESTS, results):
+        lines.append(f"\U0001F4CB Test: {description}")
+        lines.append(f"\U0001F4AC Prompt: '{prompt}'")
+        if result.error:
+            # Failures go straight to stderr, not into the buffered report
+            sys.stderr.write(f"\u274C Error in '{prompt}': {result.error.details}\n")
+        lines.append(f"\u2705 Result: {result}")
+        if result.edit_data:
+            lines.append(f"\U0001F5BC\uFE0F  Edited image saved: {result.edit_data.edited_image_path}")
+        lines.append("-" * 50)
+    sys.stdout.write("\n".join(lines) + "\n")
+    sys.stdout.flush()
+
+if pytest is not None:
+    # The same requests as a parametrized suite (`pytest test_main.py`, or spread
+    # over processes with pytest-xdist's `-n auto`); each prompt is its own test
+    @pytest.fixture(scope="session")
+    def assistant():
+        if not os.getenv("GEMINI_API_KEY"):
+            pytest.skip("GEMINI_API_KEY environment variable not set")
+        # Imported here: model.gemini refuses to load without an API key
+        from logic.assistant import ImageEditingAssistant
+        assistant = ImageEditingAssistant()
+        assistant.warmup()
+        return assistant
+
+    @pytest.fixture(scope="session")
+    def image_context():
+        if not Path(TEST_IMAGE).is_file():
+            pytest.skip(f"Test image not found: {TEST_IMAGE}")
+        # Read, decode and hash once for every request in the session
+        ctx = ImageContext.from_path(TEST_IMAGE)
+        ctx.sha256
+        ctx.pil_image.load()
+        return ctx
+
+    @pytest.mark.parametrize("prompt,description", TEST_REQUESTS, ids=[d for _, d in TEST_REQUESTS])
+    def test_request(assistant, image_context, prompt, description):
+        result = assistant.process_request(TEST_IMAGE, prompt, image_context)
+        assert result.error is None, result.error.details
+        if result.edit_data:
+            assert Path(result.edit_data.edited_image_path).is_file()
+
+    # Prompts the router settles without Gemini; None means the model decides
+    ROUTING_CASES = [
+        ("What's in this image?", "INFO"),
+        ("Make it brighter and more vibrant", "GLOBAL_EDIT"),
+        ("Remove the person in the background", "LOCAL_EDIT"),
+        ("Add more contrast and make it warmer", "GLOBAL_EDIT"),
+        ("Make this image brighter", "GLOBAL_EDIT"),
+        ("Remove the person from this image", "LOCAL_EDIT"),
+        ("Hello", None),
+        ("I'm not sure what I want", None),
+        ("What is the brightness of this image?", None),
+        ("Is the contrast good?", None),
+        ("What does saturation mean?", None),
+        ("How do I adjust the contrast?", None),
+        ("Don't make it brighter", None),
+        ("Undo the contrast change", None),
+        ("Don't remove the dog", None),
+        ("Remove the blue tint", None),
     ]
-    for prompt, description in test_requests:
-        print(f"\U0001F4CB Test: {description}")
-        print(f"\U0001F4AC Prompt: '{prompt}'")
-        try:
-            result = assistant.process_request(image_path, prompt)
-            print(f"\u2705 Result: {result}")
-            if "edited_image" in result:
-                print(f"\U0001F5BC\uFE0F  Edited image saved: {result['edited_image']}")
-        except Exception as e:
-            print(f"\u274C Error: {e}")
-        print("-" * 50)
+
+    @pytest.mark.parametrize("prompt,expected", ROUTING_CASES)
+    def test_local_route(prompt, expected):
+        if not os.getenv("GEMINI_API_KEY"):
+            pytest.skip("GEMINI_API_KEY environment variable not set")
+        from logic.router_agent import ActionType, _local_route
+        assert _local_route(prompt) == (ActionType[expected] if expected else None)
 
 if __name__ == "__main__":
     run_tests()